@@ -0,0 +1,57 @@
+import logging
+import threading
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+
+class PeriodicTask:
+    """
+    Периодический запуск функции в отдельном потоке
+    """
+
+    def __init__(self, func: Callable, interval: float, name: str = None):
+        """
+        Args:
+            func: Функция без аргументов
+            interval: Интервал между запусками, сек
+            name: Название задачи для логов
+        """
+        self.func = func
+        self.interval = interval
+        self.name = name or func.__name__
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Запуск задачи
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.func()
+            except Exception as e:
+                logger.error(f"Ошибка фоновой задачи {self.name}: {e}")
+
+    def stop(self, run_once: bool = False):
+        """
+        Остановка задачи
+
+        Args:
+            run_once: Выполнить функцию последний раз после остановки
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if run_once:
+            try:
+                self.func()
+            except Exception as e:
+                logger.error(f"Ошибка фоновой задачи {self.name}: {e}")
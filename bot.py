@@ -1,3 +1,4 @@
+import heapq
 import os
 import vk_api
 from vk_api.longpoll import VkLongPoll, VkEventType
@@ -8,6 +9,9 @@ import requests
 import json
 from typing import List, Dict, Optional
 import logging
+from vk_batch import VkRequestBatcher
+from vk_ratelimit import RateLimitedVkApi
+from session_store import create_session_store
 
 # Загружаем переменные окружения
 load_dotenv()
@@ -47,14 +51,22 @@ class VKinderBot:
         self.user_token = user_token
 
         # Инициализация API для группы (отправка сообщений)
-        self.vk_group = vk_api.VkApi(token=group_token)
+        # Все запросы токена проходят через общий ограничитель частоты
+        self.vk_group = RateLimitedVkApi(vk_api.VkApi(token=group_token),
+                                         rate=float(os.getenv('VK_GROUP_RPS', 20)), name='vk_group')
         self.longpoll = VkLongPoll(self.vk_group)
 
         # Инициализация API для пользователя (поиск людей)
-        self.vk_user = vk_api.VkApi(token=user_token)
+        self.vk_user = RateLimitedVkApi(vk_api.VkApi(token=user_token),
+                                        rate=float(os.getenv('VK_USER_RPS', 3)), name='vk_user')
+        # Объединение запросов пользовательского токена в execute
+        self.vk_user_batch = VkRequestBatcher(self.vk_user)
 
-        # Состояние пользователей бота
-        self.user_sessions = {}
+        # Состояние диалога пользователей бота (простые значения, в памяти или в общей БД;
+        # истекает и вытесняется, поэтому избранное хранится отдельно)
+        self.sessions = create_session_store()
+        # Избранное: ID пользователя бота -> профили (id, first_name, last_name, city, age, profile_url)
+        self.favorites = {}
 
         # TODO: Инициализация подключения к БД
         # self.db = DatabaseManager()
@@ -191,43 +203,82 @@ class VKinderBot:
             Список популярных фотографий
         """
         try:
-            photos = self.vk_user.method('photos.get', {
-                'owner_id': user_id,
-                'album_id': 'profile',
-                'extended': 1,
-                'count': 200  # Получаем больше фото для анализа
-            })
+            photos = self.vk_user_batch.method('photos.get', self._photos_request(user_id))
 
-            if not photos['items']:
-                return []
+            return self._select_popular_photos(photos['items'], count)
 
-            # Сортируем по количеству лайков
-            sorted_photos = sorted(
-                photos['items'],
-                key=lambda x: x.get('likes', {}).get('count', 0),
-                reverse=True
-            )
+        except Exception as e:
+            logger.error(f"Ошибка получения фотографий пользователя {user_id}: {e}")
+            return []
 
-            popular_photos = []
-            for photo in sorted_photos[:count]:
-                # Получаем URL максимального размера
-                sizes = photo.get('sizes', [])
-                if sizes:
-                    max_size = max(sizes, key=lambda x: x['width'] * x['height'])
-                    popular_photos.append({
-                        'id': photo['id'],
-                        'owner_id': photo['owner_id'],
-                        'url': max_size['url'],
-                        'likes': photo.get('likes', {}).get('count', 0),
-                        'attachment': f"photo{photo['owner_id']}_{photo['id']}"
-                    })
+    def get_popular_photos_many(self, user_ids: List[int], count: int = 3) -> Dict[int, List[Dict]]:
+        """
+        Получает популярные фотографии нескольких пользователей
+        через execute (до 25 пользователей за один запрос)
 
-            return popular_photos
+        Args:
+            user_ids: ID пользователей
+            count: Количество фотографий
 
-        except Exception as e:
-            logger.error(f"Ошибка получения фотографий пользователя {user_id}: {e}")
+        Returns:
+            Словарь {ID пользователя: список популярных фотографий}
+        """
+        results = self.vk_user_batch.call_many(
+            [('photos.get', self._photos_request(user_id)) for user_id in user_ids]
+        )
+
+        photos = {}
+        for user_id, result in zip(user_ids, results):
+            if isinstance(result, Exception):
+                logger.error(f"Ошибка получения фотографий пользователя {user_id}: {result}")
+                continue
+            photos[user_id] = self._select_popular_photos(result['items'], count)
+        return photos
+
+    def _photos_request(self, user_id: int) -> Dict:
+        """
+        Параметры запроса photos.get для фотографий профиля
+        """
+        return {
+            'owner_id': user_id,
+            'album_id': 'profile',
+            'extended': 1,
+            'count': 200  # Получаем больше фото для анализа
+        }
+
+    def _select_popular_photos(self, items: List[Dict], count: int) -> List[Dict]:
+        """
+        Отбирает самые популярные фотографии из ответа photos.get
+
+        Args:
+            items: Фотографии из ответа photos.get
+            count: Количество фотографий
+
+        Returns:
+            Список популярных фотографий
+        """
+        if not items:
             return []
 
+        # Отбираем лучшие по количеству лайков без сортировки всего списка
+        top_photos = heapq.nlargest(count, items, key=lambda x: x.get('likes', {}).get('count', 0))
+
+        popular_photos = []
+        for photo in top_photos:
+            # Получаем URL максимального размера
+            sizes = photo.get('sizes', [])
+            if sizes:
+                max_size = max(sizes, key=lambda x: x['width'] * x['height'])
+                popular_photos.append({
+                    'id': photo['id'],
+                    'owner_id': photo['owner_id'],
+                    'url': max_size['url'],
+                    'likes': photo.get('likes', {}).get('count', 0),
+                    'attachment': f"photo{photo['owner_id']}_{photo['id']}"
+                })
+
+        return popular_photos
+
     def send_user_profile(self, user_id: int, user_profile: Dict, photos: List[Dict]):
         """
         Отправляет профиль пользователя в чат
@@ -284,15 +335,11 @@ class VKinderBot:
             # TODO: Сохранение в БД
             # self.db.add_favorite(user_id, target_user)
 
-            # Временно сохраняем в памяти
-            if user_id not in self.user_sessions:
-                self.user_sessions[user_id] = {'favorites': []}
-
+            # Временно сохраняем в памяти (не в сессии: сессия истекает и вытесняется)
             # Проверяем, не добавлен ли уже
-            favorites = self.user_sessions[user_id].get('favorites', [])
+            favorites = self.favorites.setdefault(user_id, [])
             if not any(fav['id'] == target_user['id'] for fav in favorites):
                 favorites.append(target_user)
-                self.user_sessions[user_id]['favorites'] = favorites
 
                 self.send_message(user_id, "✅ Пользователь добавлен в избранное!")
             else:
@@ -312,8 +359,8 @@ class VKinderBot:
             # TODO: Получение из БД
             # favorites = self.db.get_favorites(user_id)
 
-            # Временно получаем из памяти
-            favorites = self.user_sessions.get(user_id, {}).get('favorites', [])
+            # Временно получаем из памяти (профили сохранены при добавлении)
+            favorites = self.favorites.get(user_id, [])
 
             if not favorites:
                 self.send_message(user_id, "📋 Ваш список избранного пуст")
@@ -383,12 +430,16 @@ class VKinderBot:
                 self.send_message(user_id, "😔 Никого не найдено. Попробуйте позже.")
                 return
 
-            # Сохраняем результаты поиска в сессию
-            self.user_sessions[user_id] = {
-                'search_results': found_users,
-                'current_index': 0,
-                'favorites': self.user_sessions.get(user_id, {}).get('favorites', [])
-            }
+            # Фотографии всех найденных пользователей - одним запросом
+            photos = self.get_popular_photos_many([user['id'] for user in found_users])
+
+            # Сохраняем результаты поиска в сессию: профили для показа и вложения фотографий
+            self.sessions.update(user_id,
+                                 search_results=found_users,
+                                 photos={str(target_id): [photo['attachment'] for photo in target_photos]
+                                         for target_id, target_photos in photos.items()},
+                                 current_index=0,
+                                 current_user=None)
 
             # Показываем первого пользователя
             self.show_next_user(user_id)
@@ -405,8 +456,8 @@ class VKinderBot:
             user_id: ID пользователя бота
         """
         try:
-            session = self.user_sessions.get(user_id)
-            if not session or 'search_results' not in session:
+            session = self.sessions.get(user_id)
+            if 'search_results' not in session:
                 self.send_message(user_id, "🔍 Сначала запустите поиск командой /start")
                 return
 
@@ -418,13 +469,19 @@ class VKinderBot:
                 return
 
             current_user = search_results[current_index]
+            target_id = current_user['id']
 
-            # Получаем популярные фотографии
-            photos = self.get_popular_photos(current_user['id'])
+            # Получаем популярные фотографии (загружены при поиске)
+            attachments = session.get('photos', {}).get(str(target_id))
+            if attachments is None:
+                photos = self.get_popular_photos(target_id)
+            else:
+                photos = [{'attachment': attachment} for attachment in attachments]
 
             # Сохраняем текущего пользователя в сессию
             session['current_user'] = current_user
             session['current_index'] = current_index + 1
+            self.sessions.set(user_id, session)
 
             # Отправляем профиль
             self.send_user_profile(user_id, current_user, photos)
@@ -513,9 +570,9 @@ class VKinderBot:
                 self.show_next_user(user_id)
 
             elif payload == 'add_favorite':
-                session = self.user_sessions.get(user_id)
-                if session and 'current_user' in session:
-                    self.add_to_favorites(user_id, session['current_user'])
+                current_user = self.sessions.get(user_id).get('current_user')
+                if current_user:
+                    self.add_to_favorites(user_id, current_user)
                 else:
                     self.send_message(user_id, "❌ Нет активного пользователя для добавления")
 
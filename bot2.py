@@ -1,19 +1,34 @@
+import asyncio
+import heapq
 import os
 from pyexpat.errors import messages
 
 import vk_api
 from vk_api.longpoll import VkLongPoll, VkEventType
-from vk_api.keyboard import VkKeyboard, VkKeyboardColor
-from vk_api.utils import get_random_id
 from dotenv import load_dotenv
 import requests
 import json
 from typing import List, Dict, Optional
 import logging
-from query import SessionLocal, get_user, create_new_user, update_user, get_favorites, add_favorite, get_blacklist, \
-    add_blacklist, get_photo, add_photo, get_match, add_match, get_interest, add_interest, get_user_interest, \
-    add_user_interest, find_match, get_user_full_info
-from models import Gender
+from concurrent.futures import ThreadPoolExecutor
+from query import get_user, update_user, add_favorite, add_blacklist, add_match, get_interest, add_interest, \
+    get_user_interest, add_user_interest, find_match, get_user_full_info, onboard_user, add_photos, \
+    get_favorites_page, get_blacklist_page, sweep_blacklisted_matches, push_new_user_matches, has_pending_matches, \
+    enqueue_match_jobs
+from models import Gender, session_scope
+from dispatcher import KeyedDispatcher
+from vk_async import AsyncVkApi, AsyncVkLongPoll
+from vk_batch import VkRequestBatcher
+from outbox import Outbox
+from callback_server import CallbackServer, create_event_log
+from vk_ratelimit import RateLimitedVkApi
+from prefetch import MatchPrefetcher, PreparedMatch
+from background import PeriodicTask
+from candidate_index import candidate_index
+from profile_refresh import ProfileRefresher
+from photo_refresh import PhotoRefresher
+from session_store import create_session_store
+from keyboards import keyboards, build_keyboard, render_profile
 
 # Загружаем переменные окружения
 load_dotenv()
@@ -41,36 +56,94 @@ class VKinderBot:
     - Система избранного
     """
 
-    def __init__(self, group_token: str, user_token: str):
+    def __init__(self, group_token: str, user_token: str, use_async: bool = False, use_callback: bool = False):
         """
         Инициализация бота
         
         Args:
             group_token: Токен группы для отправки сообщений
             user_token: Токен пользователя для поиска людей
+            use_async: Работать через асинхронный клиент VK API (запуск через run_async)
+            use_callback: Получать события через Callback API вместо LongPoll (запуск через run_callback)
         """
         self.group_token = group_token
         self.user_token = user_token
-
+        self.use_async = use_async
+        self.use_callback = use_callback
+
+        if use_async:
+            # Асинхронные клиенты: longpoll создается в run_async,
+            # обработчики вызывают API через синхронный метод method()
+            self.group_api = AsyncVkApi(group_token)
+            self.user_api = AsyncVkApi(user_token)
+        else:
+            self.group_api = vk_api.VkApi(token=group_token)
+            self.user_api = vk_api.VkApi(token=user_token)
+
+        # Все запросы токена проходят через общий ограничитель частоты
         # Инициализация API для группы (отправка сообщений)
-        self.vk_group = vk_api.VkApi(token=group_token)
-        self.longpoll = VkLongPoll(self.vk_group)
-
+        self.vk_group = RateLimitedVkApi(self.group_api, rate=float(os.getenv('VK_GROUP_RPS', 20)), name='vk_group')
         # Инициализация API для пользователя (поиск людей)
-        self.vk_user = vk_api.VkApi(token=user_token)
-
-        # Состояние пользователей бота
-        self.user_sessions = {}
-
-        # Инициализация подключения к БД
-        session = SessionLocal()
-        # self.db = DatabaseManager()
+        self.vk_user = RateLimitedVkApi(self.user_api, rate=float(os.getenv('VK_USER_RPS', 3)), name='vk_user')
+
+        self.longpoll = None if use_async or use_callback else VkLongPoll(self.vk_group)
+
+        # Объединение запросов пользовательского токена в execute
+        self.vk_user_batch = VkRequestBatcher(self.vk_user)
+
+        # Исходящие сообщения отправляются отдельным потоком, пачками через execute
+        self.outbox = Outbox(VkRequestBatcher(self.vk_group), retries=int(os.getenv('OUTBOX_RETRIES', 3)))
+
+        # Состояние диалога пользователей бота (только ID, в памяти или в общей БД)
+        self.sessions = create_session_store()
+
+        # Параллельная обработка событий разных пользователей
+        self.dispatcher = KeyedDispatcher(
+            self.handle_event,
+            workers=int(os.getenv('BOT_WORKERS', 8)),
+            max_pending=int(os.getenv('BOT_MAX_PENDING', 1000))
+        )
+
+        # Фоновые задачи, не влияющие на ответ пользователю
+        self.background = ThreadPoolExecutor(
+            max_workers=int(os.getenv('BOT_BACKGROUND_WORKERS', 2)),
+            thread_name_prefix='background'
+        )
+
+        # Готовые к показу совпадения, отметки о показе пишутся в БД пачками
+        self.prefetcher = MatchPrefetcher(
+            self.render_profile,
+            self.background,
+            depth=int(os.getenv('PREFETCH_DEPTH', 5))
+        )
+        self.prefetch_flush = PeriodicTask(self.flush_shown_matches,
+                                           interval=float(os.getenv('PREFETCH_FLUSH_INTERVAL', 5)))
+        # Удаление из очереди совпадений с пользователями, добавленными в ЧС
+        self.match_sweep = PeriodicTask(self.sweep_matches, interval=float(os.getenv('MATCH_SWEEP_INTERVAL', 60)))
+        # Перестроение индекса кандидатов (учитывает пользователей, добавленных другими процессами)
+        self.index_rebuild = PeriodicTask(candidate_index.rebuild,
+                                          interval=float(os.getenv('CANDIDATE_INDEX_REBUILD_INTERVAL', 600)))
+        # Обновление устаревших профилей из VK пачками
+        self.profile_refresher = ProfileRefresher(self.vk_group, self._parse_user_info)
+        self.profile_refresh = PeriodicTask(self.profile_refresher.run,
+                                            interval=float(os.getenv('PROFILE_REFRESH_INTERVAL', 10)))
+        # Обновление фото из VK, начиная с чаще всего показываемых пользователей
+        self.photo_refresher = PhotoRefresher(self.vk_user_batch, self._photos_request, self._select_popular_photos)
+        self.photo_refresh = PeriodicTask(self.photo_refresher.run,
+                                          interval=float(os.getenv('PHOTO_REFRESH_INTERVAL', 60)))
+        # Удаление истёкших сессий
+        self.session_cleanup = PeriodicTask(self.sessions.cleanup,
+                                            interval=float(os.getenv('SESSION_CLEANUP_INTERVAL', 300)))
+        # Совпадения ищет отдельный процесс worker.py
+        self.match_worker = os.getenv('MATCH_WORKER') == '1'
+        # Размер страницы списков избранного и ЧС
+        self.list_page_size = int(os.getenv('LIST_PAGE_SIZE', 20))
 
         logger.info("VKinder Bot инициализирован")
 
-    def create_keyboard(self, buttons: List[Dict[str, str]]) -> dict:
+    def create_keyboard(self, buttons: List[Dict[str, str]]) -> str:
         """
-        Создает клавиатуру с кнопками
+        Создает клавиатуру с кнопками (постоянные раскладки - keyboards.LAYOUTS)
         
         Args:
             buttons: Список кнопок [{'text': 'Текст', 'color': 'color', 'payload': 'payload'}]
@@ -78,20 +151,7 @@ class VKinderBot:
         Returns:
             JSON строка клавиатуры
         """
-        keyboard = VkKeyboard(one_time=True)
-
-        for i, button in enumerate(buttons):
-            if i > 0 and i % 2 == 0:  # Новая строка каждые 2 кнопки
-                keyboard.add_line()
-
-            color = getattr(VkKeyboardColor, button.get('color', 'PRIMARY'))
-            keyboard.add_button(
-                button['text'],
-                color=color,
-                payload=json.dumps(button.get('payload', button['text']))
-            )
-
-        return keyboard.get_keyboard()
+        return build_keyboard(buttons)
 
     def get_user_info(self, user_id: int) -> Dict:
         """
@@ -109,18 +169,30 @@ class VKinderBot:
                 'fields': 'city,age,sex,bdate'
             })[0]
 
-            return {
-                'id': user_info.get('id', 0),
-                'first_name': user_info.get('first_name', 'Скрыто'),
-                'last_name': user_info.get('last_name', 'Скрыто'),
-                'city': user_info.get('city', {'id': 1, 'title': 'Москва'}),
-                'age': self._calculate_age(user_info.get('bdate', '')),
-                'sex': user_info.get('sex', 0)
-            }
+            return self._parse_user_info(user_info)
         except Exception as e:
             logger.error(f"Ошибка получения информации о пользователе {user_id}: {e}")
             return
 
+    def _parse_user_info(self, user_info: Dict) -> Dict:
+        """
+        Приводит ответ users.get к словарю профиля
+
+        Args:
+            user_info: Элемент ответа users.get
+
+        Returns:
+            Словарь с информацией о пользователе
+        """
+        return {
+            'id': user_info.get('id', 0),
+            'first_name': user_info.get('first_name', 'Скрыто'),
+            'last_name': user_info.get('last_name', 'Скрыто'),
+            'city': user_info.get('city', {'id': 1, 'title': 'Москва'}),
+            'age': self._calculate_age(user_info.get('bdate', '')),
+            'sex': user_info.get('sex', 0)
+        }
+
     def _calculate_age(self, bdate: str) -> int:
         """
         Вычисляет возраст по дате рождения
@@ -198,216 +270,280 @@ class VKinderBot:
             Список популярных фотографий
         """
         try:
-            photos = self.vk_user.method('photos.get', {
-                'owner_id': user_id,
-                'album_id': 'profile',
-                'extended': 1,
-                'count': 200  # Получаем больше фото для анализа
-            })
+            # запросы разных пользователей объединяются в execute
+            photos = self.vk_user_batch.method('photos.get', self._photos_request(user_id))
 
-            if not photos['items']:
-                return []
-
-            # Сортируем по количеству лайков
-            sorted_photos = sorted(
-                photos['items'],
-                key=lambda x: x.get('likes', {}).get('count', 0),
-                reverse=True
-            )
-
-            popular_photos = []
-            for photo in sorted_photos[:count]:
-                # Получаем URL максимального размера
-                sizes = photo.get('sizes', [])
-                if sizes:
-                    max_size = max(sizes, key=lambda x: x['width'] * x['height'])
-                    popular_photos.append({
-                        'id': photo['id'],
-                        'owner_id': photo['owner_id'],
-                        'url': max_size['url'],
-                        'likes': photo.get('likes', {}).get('count', 0),
-                        'attachment': f"photo{photo['owner_id']}_{photo['id']}"
-                    })
-
-            return popular_photos
+            return self._select_popular_photos(photos['items'], count)
 
         except Exception as e:
             logger.error(f"Ошибка получения фотографий пользователя {user_id}: {e}")
             return []
 
-    def send_user_profile(self, user_id: int, user_profile: Dict, photos: List[Dict]):
+    def _photos_request(self, user_id: int) -> Dict:
+        """
+        Параметры запроса photos.get для фотографий профиля
+        """
+        return {
+            'owner_id': user_id,
+            'album_id': 'profile',
+            'extended': 1,
+            'count': 200  # Получаем больше фото для анализа
+        }
+
+    def _select_popular_photos(self, items: List[Dict], count: int) -> List[Dict]:
+        """
+        Отбирает самые популярные фотографии из ответа photos.get
+
+        Args:
+            items: Фотографии из ответа photos.get
+            count: Количество фотографий
+
+        Returns:
+            Список популярных фотографий
+        """
+        if not items:
+            return []
+
+        # Отбираем лучшие по количеству лайков без сортировки всего списка
+        top_photos = heapq.nlargest(count, items, key=lambda x: x.get('likes', {}).get('count', 0))
+
+        popular_photos = []
+        for photo in top_photos:
+            # Получаем URL максимального размера
+            sizes = photo.get('sizes', [])
+            if sizes:
+                max_size = max(sizes, key=lambda x: x['width'] * x['height'])
+                popular_photos.append({
+                    'id': photo['id'],
+                    'owner_id': photo['owner_id'],
+                    'url': max_size['url'],
+                    'likes': photo.get('likes', {}).get('count', 0),
+                    'attachment': f"photo{photo['owner_id']}_{photo['id']}"
+                })
+
+        return popular_photos
+
+    def ingest_photos(self, user_id: int):
+        """
+        Загружает популярные фотографии пользователя из VK и сохраняет в БД (фоновая задача)
+
+        Args:
+            user_id: ID пользователя
+        """
+        try:
+            photos = self.get_popular_photos(user_id)
+            if photos:
+                with session_scope():
+                    add_photos(user_id, photos)
+        except Exception as e:
+            logger.error(f"Ошибка сохранения фотографий пользователя {user_id}: {e}")
+
+    def push_new_user(self, user_id: int):
+        """
+        Добавляет нового пользователя в совпадения уже искавших пользователей (фоновая задача)
+
+        Args:
+            user_id: ID нового пользователя
+        """
+        try:
+            with session_scope():
+                count = push_new_user_matches(user_id)
+            if count:
+                logger.info(f"Пользователь {user_id} добавлен в совпадения {count} пользователей")
+        except Exception as e:
+            logger.error(f"Ошибка добавления пользователя {user_id} в совпадения: {e}")
+
+    def render_profile(self, user_profile: Dict) -> str:
+        """
+        Формирует текст профиля пользователя по шаблону
+
+        Args:
+            user_profile: Профиль пользователя (name, surname, city_name, age)
+
+        Returns:
+            Текст сообщения
+        """
+        return render_profile(user_profile)
+
+    def flush_shown_matches(self):
+        """
+        Записывает накопленные отметки о показе совпадений в БД
+        """
+        with session_scope():
+            self.prefetcher.flush()
+
+    def sweep_matches(self):
+        """
+        Удаляет непоказанные совпадения с пользователями из ЧС
+        """
+        with session_scope():
+            count = sweep_blacklisted_matches()
+        if count:
+            logger.info(f"Удалено совпадений с пользователями из ЧС: {count}")
+
+    def start_background_tasks(self):
+        """
+        Запускает фоновые задачи: отправку сообщений, построение индекса кандидатов, запись отметок о показе,
+        очистку совпадений с пользователями из ЧС, обновление профилей и фото из VK, удаление истёкших сессий
+        """
+        self.outbox.start()
+        # холодный старт индекса - пока он строится, кандидаты ищутся через БД
+        self.background.submit(candidate_index.rebuild)
+        if self.index_rebuild.interval > 0:
+            self.index_rebuild.start()
+        self.prefetch_flush.start()
+        self.match_sweep.start()
+        self.profile_refresh.start()
+        if self.photo_refresh.interval > 0:
+            self.photo_refresh.start()
+        self.session_cleanup.start()
+
+    def stop_background_tasks(self):
+        """
+        Останавливает фоновые задачи: записывает оставшиеся отметки о показе,
+        возвращает непоказанные совпадения из буфера в очередь и отправляет накопленные сообщения
+        """
+        self.index_rebuild.stop()
+        self.profile_refresh.stop()
+        self.photo_refresh.stop()
+        self.session_cleanup.stop()
+        self.match_sweep.stop()
+        self.prefetch_flush.stop(run_once=True)
+        try:
+            with session_scope():
+                self.prefetcher.release_all()
+        except Exception as e:
+            logger.error(f"Ошибка возврата совпадений из буфера: {e}")
+        self.outbox.stop()
+
+    def send_user_profile(self, user_id: int, prepared: PreparedMatch):
         """
         Отправляет профиль пользователя в чат
 
         Args:
             user_id: ID пользователя
-            user_profile: Профиль пользователя
-            photos: Список фотографий
+            prepared: Совпадение с готовым текстом профиля и фотографиями
         """
         try:
-            # Формируем сообщение
-            message = f"👤 {user_profile.name} {user_profile.surname}\n"
-            message += f"📍 {user_profile.city.city_name}\n"
-            if user_profile.age:
-                message += f"🎂 {user_profile.age} лет\n"
-
-            # Создаем клавиатуру с кнопками
-            keyboard_buttons = [
-                {'text': '❤️ В избранное', 'color': 'POSITIVE', 'payload': 'add_favorite'},
-                {'text': '🙈 В ЧС', 'color': 'NEGATIVE', 'payload': 'add_blacklist'},
-                {'text': '➡️ Следующий', 'color': 'PRIMARY', 'payload': 'next_user'},
-                {'text': '📋 Избранное', 'color': 'SECONDARY', 'payload': 'show_favorites'},
-                {'text': '🔕 Черный список', 'color': 'SECONDARY', 'payload': 'show_blacklist'},
-                {'text': '🔍 Новый поиск', 'color': 'SECONDARY', 'payload': 'new_search'}
-            ]
-
-            keyboard = self.create_keyboard(keyboard_buttons)
-
-            # Формируем вложения (фотографии)
-            attachments = []
-            for photo in photos:
-                attachments.append(photo.attachment)
-
-            # Отправляем сообщение
-            self.vk_group.method('messages.send', {
-                'user_id': user_id,
-                'message': message,
-                'keyboard': keyboard,
-                'attachment': ','.join(attachments) if attachments else None,
-                'random_id': get_random_id()
-            })
+            # Клавиатура собрана при запуске
+            keyboard = keyboards['profile']
+
+            # Отправляем сообщение (через очередь отправки)
+            self.outbox.send(user_id, prepared.message, keyboard,
+                             ','.join(prepared.attachments) if prepared.attachments else None)
 
         except Exception as e:
             logger.error(f"Ошибка отправки профиля: {e}")
 
-    def add_to_favorites(self, user_id: int, target_user: dict):
+    def add_to_favorites(self, user_id: int, target_id: int):
         """
         Добавляет пользователя в избранное
         
         Args:
             user_id: ID пользователя бота
-            target_user: Профиль добавляемого пользователя
+            target_id: ID добавляемого пользователя
         """
         try:
             # Сохранение в БД
-            message = add_favorite(user_id, target_user.id_VK_user)
-
-            # Создаем клавиатуру с кнопками
-            keyboard_buttons = [
-                {'text': '➡️ Следующий', 'color': 'PRIMARY', 'payload': 'next_user'},
-                {'text': '📋 Избранное', 'color': 'SECONDARY', 'payload': 'show_favorites'},
-                {'text': '🔕 Черный список', 'color': 'SECONDARY', 'payload': 'show_blacklist'},
-                {'text': '🔍 Новый поиск', 'color': 'SECONDARY', 'payload': 'new_search'}
-            ]
-
-            keyboard = self.create_keyboard(keyboard_buttons)
-
-            # Отправляем сообщение
-            self.vk_group.method('messages.send', {
-                'user_id': user_id,
-                'message': message,
-                'keyboard': keyboard,
-                'random_id': get_random_id()
-            })
+            message = add_favorite(user_id, target_id)
+
+            # Клавиатура собрана при запуске
+            keyboard = keyboards['after_action']
+
+            # Отправляем сообщение (через очередь отправки)
+            self.outbox.send(user_id, message, keyboard)
 
         except Exception as e:
             logger.error(f"Ошибка добавления в избранное: {e}")
 
-    def show_favorites(self, user_id: int):
+    def show_favorites(self, user_id: int, after: int = None, number: int = 1):
         """
-        Показывает список избранных пользователей
-        
+        Показывает страницу списка избранных пользователей
+
         Args:
             user_id: ID пользователя бота
+            after: ID последнего пользователя предыдущей страницы
+            number: Номер первого пользователя на странице
         """
         try:
-            # Получение из БД
-            favorites = get_favorites(user_id)
-
-            if isinstance(favorites, str):
-                message = "📋 Ваш список избранного пуст"
-            else:
-                message = "📋 Избранные пользователи:\n\n"
-                for i, fav in enumerate(favorites, 1):
-                    cur_fav = get_user(fav[0])
-                    message += f"{i}. {cur_fav.name} {cur_fav.surname}\n"
-                    message += f"   https://vk.com/id{cur_fav.id_VK_user}\n\n"
-
-            keyboard_buttons = [
-                {'text': '🔍 Начать поиск', 'color': 'POSITIVE', 'payload': 'start_search'},
-                {'text': '❤️ Избранное', 'color': 'SECONDARY', 'payload': 'show_favorites'},
-                {'text': '🔕 Черный список', 'color': 'SECONDARY', 'payload': 'show_blacklist'}
-            ]
-
-            keyboard = self.create_keyboard(keyboard_buttons)
-
-            self.send_message(user_id, message, keyboard)
+            # Имена получаем тем же запросом, что и список
+            page, next_after = get_favorites_page(user_id, after, self.list_page_size)
+            self._show_list(user_id, page, next_after, number, 'show_favorites',
+                            "📋 Избранные пользователи:\n\n", "📋 Ваш список избранного пуст")
 
         except Exception as e:
             logger.error(f"Ошибка показа избранного: {e}")
 
-    def add_to_blacklist(self, user_id: int, target_user: dict):
+    def _show_list(self, user_id: int, page: list, next_after: Optional[int], number: int, command: str,
+                   title: str, empty_message: str):
+        """
+        Отправляет страницу списка пользователей (избранное, ЧС)
+
+        Args:
+            user_id: ID пользователя бота
+            page: Строки (ID, имя, фамилия)
+            next_after: Курсор следующей страницы или None
+            number: Номер первого пользователя на странице
+            command: Команда кнопки следующей страницы
+            title: Заголовок списка
+            empty_message: Сообщение для пустого списка
+        """
+        if not page and number == 1:
+            message = empty_message
+        else:
+            message = title
+            for i, row in enumerate(page, number):
+                name = f"{row.name} {row.surname}" if row.name else "Пользователь"
+                message += f"{i}. {name}\n"
+                message += f"   https://vk.com/id{row.id_VK_user}\n\n"
+
+        if next_after is None:
+            keyboard = keyboards['menu']
+        else:
+            # кнопка следующей страницы зависит от курсора - такая клавиатура собирается заново
+            keyboard = keyboards.with_button('menu', {'text': '⏩ Ещё', 'color': 'PRIMARY',
+                                                      'payload': {'cmd': command, 'after': next_after,
+                                                                  'number': number + len(page)}})
+
+        self.send_message(user_id, message, keyboard)
+
+    def add_to_blacklist(self, user_id: int, target_id: int):
         """
         Добавляет пользователя в ЧС
 
         Args:
             user_id: ID пользователя бота
-            target_user: Профиль добавляемого пользователя
+            target_id: ID добавляемого пользователя
         """
         try:
             # Сохранение в БД
-            message = add_blacklist(user_id, target_user.id_VK_user)
-
-            # Создаем клавиатуру с кнопками
-            keyboard_buttons = [
-                {'text': '➡️ Следующий', 'color': 'PRIMARY', 'payload': 'next_user'},
-                {'text': '📋 Избранное', 'color': 'SECONDARY', 'payload': 'show_favorites'},
-                {'text': '🔕 Черный список', 'color': 'SECONDARY', 'payload': 'show_blacklist'},
-                {'text': '🔍 Новый поиск', 'color': 'SECONDARY', 'payload': 'new_search'}
-            ]
-
-            keyboard = self.create_keyboard(keyboard_buttons)
-
-            # Отправляем сообщение
-            self.vk_group.method('messages.send', {
-                'user_id': user_id,
-                'message': message,
-                'keyboard': keyboard,
-                'random_id': get_random_id()
-            })
+            message = add_blacklist(user_id, target_id)
+            # заблокированный пользователь больше не должен попасть в показ
+            self.prefetcher.invalidate(user_id, target_id)
+
+            # Клавиатура собрана при запуске
+            keyboard = keyboards['after_action']
+
+            # Отправляем сообщение (через очередь отправки)
+            self.outbox.send(user_id, message, keyboard)
 
         except Exception as e:
             logger.error(f"Ошибка добавления в избранное: {e}")
 
-    def show_blacklist(self, user_id: int):
+    def show_blacklist(self, user_id: int, after: int = None, number: int = 1):
         """
-        Показывает список пользователей в ЧС
+        Показывает страницу списка пользователей в ЧС
 
         Args:
             user_id: ID пользователя бота
+            after: ID последнего пользователя предыдущей страницы
+            number: Номер первого пользователя на странице
         """
         try:
-            # Получение из БД
-            blacklist = get_blacklist(user_id)
-
-            if isinstance(blacklist, str):
-                message = "📋 Ваш черный список пуст"
-            else:
-                message = "📋 пользователи в черном списке:\n\n"
-                for i, fav in enumerate(blacklist, 1):
-                    cur_fav = get_user(fav[0])
-                    message += f"{i}. {cur_fav.name} {cur_fav.surname}\n"
-                    message += f"   https://vk.com/id{cur_fav.id_VK_user}\n\n"
-
-            keyboard_buttons = [
-                {'text': '🔍 Начать поиск', 'color': 'POSITIVE', 'payload': 'start_search'},
-                {'text': '❤️ Избранное', 'color': 'SECONDARY', 'payload': 'show_favorites'},
-                {'text': '🔕 Черный список', 'color': 'SECONDARY', 'payload': 'show_blacklist'}
-            ]
-
-            keyboard = self.create_keyboard(keyboard_buttons)
-
-            self.send_message(user_id, message, keyboard)
+            # Имена получаем тем же запросом, что и список
+            page, next_after = get_blacklist_page(user_id, after, self.list_page_size)
+            self._show_list(user_id, page, next_after, number, 'show_blacklist',
+                            "📋 пользователи в черном списке:\n\n", "📋 Ваш черный список пуст")
 
         except Exception as e:
             logger.error(f"Ошибка показа избранного: {e}")
@@ -422,16 +558,8 @@ class VKinderBot:
             keyboard: Клавиатура (JSON)
         """
         try:
-            params = {
-                'user_id': user_id,
-                'message': message,
-                'random_id': get_random_id()
-            }
-
-            if keyboard:
-                params['keyboard'] = keyboard
-
-            self.vk_group.method('messages.send', params)
+            # обработчик не ждёт ответа VK, сообщение отправит поток очереди
+            self.outbox.send(user_id, message, keyboard)
 
         except Exception as e:
             logger.error(f"Ошибка отправки сообщения: {e}")
@@ -444,18 +572,29 @@ class VKinderBot:
             user_id: ID пользователя бота
         """
         try:
-            # Получаем информацию о пользователе
-            user_info = self.get_user_info(user_id)
-            if not user_info:
+            # Профиль берём из БД, устаревший обновится из VK в фоне
+            user = get_user(user_id)
+            if not user:
                 self.send_message(user_id, "❌ Не удалось получить информацию о вашем профиле")
                 return
+            self.profile_refresher.refresh_if_stale(user)
+
+            if self.match_worker:
+                # совпадения ищет worker.py, здесь только проверяем, что они есть
+                if not self.prefetcher.buffered(user_id) and not has_pending_matches(user_id):
+                    enqueue_match_jobs([user_id])
+                    if user.last_search_at is None:
+                        # первый поиск ещё не выполнен
+                        self.send_message(user_id, "⏳ Подбираем для вас людей, нажмите «Начать поиск» через минуту",
+                                          keyboards['menu'])
+                        return
+            else:
+                # поиск по БД среди участников чата
+                found_users = find_match(user_id)
 
-            # поиск по БД среди участников чата
-            found_users = find_match(user_id)
-
-            if isinstance(found_users, str):
-                self.send_message(user_id, found_users)
-                return
+                if isinstance(found_users, str):
+                    self.send_message(user_id, found_users)
+                    return
 
             # Показываем первого пользователя
             self.show_next_user(user_id)
@@ -472,26 +611,17 @@ class VKinderBot:
             user_id: ID пользователя бота
         """
         try:
-            match = get_match(user_id)
-            if isinstance(match, str):
-                keyboard_buttons = [
-                    {'text': '🔍 Начать поиск', 'color': 'POSITIVE', 'payload': 'start_search'},
-                    {'text': '❤️ Избранное', 'color': 'SECONDARY', 'payload': 'show_favorites'},
-                    {'text': '🔕 Черный список', 'color': 'SECONDARY', 'payload': 'show_blacklist'}
-                ]
-
-                keyboard = self.create_keyboard(keyboard_buttons)
-                self.send_message(user_id, match, keyboard)
+            # профиль, фото и текст уже подготовлены в буфере
+            prepared = self.prefetcher.pop(user_id)
+            if prepared is None:
+                keyboard = keyboards['menu']
+                self.send_message(user_id, '😔 Никого не нашлось.', keyboard)
                 return
 
-            current_user = get_user(match.id_target_user)
-            photos = get_photo(match.id_target_user)
-            self.user_sessions[user_id] = {
-                'current_user': current_user
-            }
+            self.sessions.set(user_id, {'current_user': prepared.id_VK_user})
 
             # Отправляем профиль
-            self.send_user_profile(user_id, current_user, photos)
+            self.send_user_profile(user_id, prepared)
 
         except Exception as e:
             logger.error(f"Ошибка показа следующего пользователя: {e}")
@@ -511,13 +641,18 @@ class VKinderBot:
             user = get_user(user_id)
             if not user:
                 user_VK = self.get_user_info(user_id)
-
-                create_new_user(user_id, user_VK['first_name'], user_VK['last_name'], user_VK['age'],
-                                (0, Gender.VALUE_TWO, Gender.VALUE_ONE)[user_VK['sex']], user_VK['city'])
-
-                photos = self.get_popular_photos(user_id)
-                for photo in photos:
-                    add_photo(user_id, photo['url'], photo['likes'], photo['attachment'], False)
+                if user_VK:
+                    # город и пользователь - одной транзакцией
+                    onboard_user(user_id, user_VK['first_name'], user_VK['last_name'], user_VK['age'],
+                                 (None, Gender.VALUE_TWO, Gender.VALUE_ONE)[user_VK['sex']], user_VK['city'])
+
+                    # фотографии загружаются в фоне, ответ пользователю не ждет их
+                    self.background.submit(self.ingest_photos, user_id)
+                    # новый пользователь сразу попадает в очереди тех, кому подходит
+                    self.background.submit(self.push_new_user, user_id)
+                    if self.match_worker:
+                        # а его собственные совпадения worker.py найдёт заранее
+                        enqueue_match_jobs([user_id])
 
             # Обработка команд
             if message == '/start' or message == 'начать':
@@ -534,13 +669,7 @@ class VKinderBot:
 Нажмите кнопку ниже, чтобы начать поиск!
                 """
 
-                keyboard_buttons = [
-                    {'text': '🔍 Начать поиск', 'color': 'POSITIVE', 'payload': 'start_search'},
-                    {'text': '❤️ Избранное', 'color': 'SECONDARY', 'payload': 'show_favorites'},
-                    {'text': '🔕 Черный список', 'color': 'SECONDARY', 'payload': 'show_blacklist'}
-                ]
-
-                keyboard = self.create_keyboard(keyboard_buttons)
+                keyboard = keyboards['menu']
                 self.send_message(user_id, welcome_message, keyboard)
 
             elif message == '/favorites':
@@ -587,23 +716,30 @@ class VKinderBot:
             user_id = event.user_id
             payload = json.loads(event.payload)
 
-            if payload == 'start_search':
+            if isinstance(payload, dict):
+                # кнопки с параметрами: {'cmd': команда, ...}
+                if payload.get('cmd') == 'show_favorites':
+                    self.show_favorites(user_id, payload.get('after'), payload.get('number', 1))
+                elif payload.get('cmd') == 'show_blacklist':
+                    self.show_blacklist(user_id, payload.get('after'), payload.get('number', 1))
+
+            elif payload == 'start_search':
                 self.start_search(user_id)
 
             elif payload == 'next_user':
                 self.show_next_user(user_id)
 
             elif payload == 'add_favorite':
-                user_session = self.user_sessions.get(user_id)
-                if user_session and 'current_user' in user_session:
-                    self.add_to_favorites(user_id, user_session['current_user'])
+                target_id = self.sessions.get(user_id).get('current_user')
+                if target_id:
+                    self.add_to_favorites(user_id, target_id)
                 else:
                     self.send_message(user_id, "❌ Нет активного пользователя для добавления")
 
             elif payload == 'add_blacklist':
-                user_session = self.user_sessions.get(user_id)
-                if user_session and 'current_user' in user_session:
-                    self.add_to_blacklist(user_id, user_session['current_user'])
+                target_id = self.sessions.get(user_id).get('current_user')
+                if target_id:
+                    self.add_to_blacklist(user_id, target_id)
                 else:
                     self.send_message(user_id, "❌ Нет активного пользователя для добавления")
 
@@ -619,26 +755,121 @@ class VKinderBot:
         except Exception as e:
             logger.error(f"Ошибка обработки нажатия кнопки: {e}")
 
+    def handle_event(self, event):
+        """
+        Обработка одного события в отдельной сессии БД
+
+        Args:
+            event: Событие VK LongPoll или Callback API (callback_server.CallbackEvent)
+        """
+        if event.type != VkEventType.MESSAGE_NEW or not event.to_me:
+            return
+
+        try:
+            with session_scope():
+                if hasattr(event, 'payload'):
+                    # Обработка нажатий кнопок
+                    self.handle_button_click(event)
+                else:
+                    # Обработка текстовых сообщений
+                    self.handle_message(event)
+        except Exception as e:
+            logger.error(f"Ошибка обработки события: {e}")
+
     def run(self):
         """
         Запуск бота
         """
         logger.info("Запуск VKinder Bot...")
+        self.start_background_tasks()
 
         try:
             for event in self.longpoll.listen():
                 if event.type == VkEventType.MESSAGE_NEW and event.to_me:
-                    if hasattr(event, 'payload'):
-                        # Обработка нажатий кнопок
-                        self.handle_button_click(event)
-                    else:
-                        # Обработка текстовых сообщений
-                        self.handle_message(event)
+                    # события одного пользователя обрабатываются по порядку
+                    self.dispatcher.submit(event.user_id, event)
 
         except KeyboardInterrupt:
             logger.info("Бот остановлен пользователем")
         except Exception as e:
             logger.error(f"Критическая ошибка: {e}")
+        finally:
+            # дожидаемся обработки уже полученных событий
+            self.dispatcher.shutdown()
+            self.background.shutdown()
+            self.stop_background_tasks()
+
+    def run_callback(self):
+        """
+        Запуск бота в режиме Callback API: события приходят HTTP-запросами VK
+        (VK_CALLBACK_CONFIRMATION, VK_CALLBACK_SECRET, VK_GROUP_ID, CALLBACK_HOST, CALLBACK_PORT).
+        Несколько экземпляров можно запустить за балансировщиком: общие сессии - SESSION_STORE=db,
+        общий журнал принятых событий - CALLBACK_DEDUP=db.
+        """
+        logger.info("Запуск VKinder Bot (Callback API)...")
+        group_id = os.getenv('VK_GROUP_ID')
+        submit_timeout = float(os.getenv('CALLBACK_SUBMIT_TIMEOUT', 1))
+        events = create_event_log()
+        # Удаление старых записей журнала событий
+        events_cleanup = PeriodicTask(events.cleanup, interval=float(os.getenv('SESSION_CLEANUP_INTERVAL', 300)),
+                                      name='callback_events_cleanup')
+        server = CallbackServer(
+            lambda user_id, event: self.dispatcher.submit(user_id, event, timeout=submit_timeout),
+            confirmation=os.getenv('VK_CALLBACK_CONFIRMATION', ''),
+            secret=os.getenv('VK_CALLBACK_SECRET', ''),
+            group_id=int(group_id) if group_id else None,
+            host=os.getenv('CALLBACK_HOST', '0.0.0.0'),
+            port=int(os.getenv('CALLBACK_PORT', 8080)),
+            events=events
+        )
+        self.start_background_tasks()
+        events_cleanup.start()
+
+        try:
+            server.serve_forever()
+
+        except KeyboardInterrupt:
+            logger.info("Бот остановлен пользователем")
+        except Exception as e:
+            logger.error(f"Критическая ошибка: {e}")
+        finally:
+            server.shutdown()
+            events_cleanup.stop()
+            # дожидаемся обработки уже принятых событий
+            self.dispatcher.shutdown()
+            self.background.shutdown()
+            self.stop_background_tasks()
+
+    async def run_async(self):
+        """
+        Запуск бота на асинхронном клиенте VK API.
+        Longpoll и все запросы к API выполняются в цикле событий,
+        обработчики событий - в потоках диспетчера.
+        """
+        logger.info("Запуск VKinder Bot (asyncio)...")
+        loop = asyncio.get_running_loop()
+        await self.group_api.start()
+        await self.user_api.start()
+        self.longpoll = AsyncVkLongPoll(self.group_api, api=self.vk_group)
+        self.start_background_tasks()
+
+        try:
+            async for event in self.longpoll.listen():
+                if event.type == VkEventType.MESSAGE_NEW and event.to_me:
+                    # submit может ждать места в очереди - не блокируем цикл событий
+                    await loop.run_in_executor(None, self.dispatcher.submit, event.user_id, event)
+
+        except asyncio.CancelledError:
+            logger.info("Бот остановлен")
+        except Exception as e:
+            logger.error(f"Критическая ошибка: {e}")
+        finally:
+            # обработчики еще используют клиентов API, закрываем их после диспетчера
+            await loop.run_in_executor(None, self.dispatcher.shutdown)
+            await loop.run_in_executor(None, self.background.shutdown)
+            await loop.run_in_executor(None, self.stop_background_tasks)
+            await self.group_api.close()
+            await self.user_api.close()
 
 
 def main():
@@ -654,8 +885,21 @@ def main():
         return
 
     # Создаем и запускаем бота
-    bot = VKinderBot(GROUP_TOKEN, USER_TOKEN)
-    bot.run()
+    if os.getenv('VK_CALLBACK') == '1':
+        if not os.getenv('VK_CALLBACK_SECRET'):
+            logger.error("Отсутствует секретный ключ Callback API. Установите переменную окружения VK_CALLBACK_SECRET")
+            return
+        bot = VKinderBot(GROUP_TOKEN, USER_TOKEN, use_callback=True)
+        bot.run_callback()
+    elif os.getenv('VK_ASYNC') == '1':
+        bot = VKinderBot(GROUP_TOKEN, USER_TOKEN, use_async=True)
+        try:
+            asyncio.run(bot.run_async())
+        except KeyboardInterrupt:
+            logger.info("Бот остановлен пользователем")
+    else:
+        bot = VKinderBot(GROUP_TOKEN, USER_TOKEN)
+        bot.run()
 
 
 if __name__ == "__main__":
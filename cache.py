@@ -0,0 +1,189 @@
+import logging
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Отличает "значения нет в кэше" от закэшированного None
+MISSING = object()
+
+
+class MemoryBackend:
+    """
+    Кэш в памяти процесса: LRU с ограничением размера и временем жизни записей
+    """
+
+    def __init__(self, max_size: int = 10000):
+        """
+        Args:
+            max_size: Максимум записей, при превышении вытесняются давно не использованные
+        """
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._data = OrderedDict()  # ключ -> (срок действия, значение)
+
+    def get(self, key: str):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return MISSING
+            expires, value = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return MISSING
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value, ttl: float):
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                metrics.incr('cache.evicted')
+
+    def delete(self, key: str):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class RedisBackend:
+    """
+    Общий кэш нескольких процессов бота в Redis (нужен пакет redis).
+    Значения сериализуются pickle, время жизни задаётся самим Redis.
+    """
+
+    def __init__(self, url: str, prefix: str = 'vkinder:'):
+        """
+        Args:
+            url: Адрес Redis (redis://host:port/db)
+            prefix: Префикс ключей
+        """
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError('Для общего кэша (CACHE_REDIS_URL) нужен пакет redis: pip install redis') from e
+
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key: str):
+        data = self.client.get(self.prefix + key)
+        return MISSING if data is None else pickle.loads(data)
+
+    def set(self, key: str, value, ttl: float):
+        self.client.set(self.prefix + key, pickle.dumps(value), px=int(ttl * 1000))
+
+    def delete(self, key: str):
+        self.client.delete(self.prefix + key)
+
+    def clear(self):
+        keys = list(self.client.scan_iter(self.prefix + '*'))
+        if keys:
+            self.client.delete(*keys)
+
+
+class Cache:
+    """
+    Кэш с чтением через загрузчик (read-through) для функций query.py.
+    Ключи разделены на пространства имён (user, city_name, ...), для каждого
+    считаются попадания и промахи. Хранилище (backend) можно заменить на общее.
+    """
+
+    def __init__(self, backend=None, ttl: float = 60):
+        """
+        Args:
+            backend: Хранилище с методами get/set/delete/clear (по умолчанию MemoryBackend)
+            ttl: Время жизни записей по умолчанию, сек
+        """
+        self.backend = backend or MemoryBackend()
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._stats = {}  # пространство имён -> [попадания, промахи]
+
+    def _count(self, namespace: str, hit: bool):
+        with self._lock:
+            stats = self._stats.setdefault(namespace, [0, 0])
+            stats[0 if hit else 1] += 1
+        metrics.incr(f'cache.{namespace}.{"hit" if hit else "miss"}')
+
+    def get_or_load(self, namespace: str, key, loader: Callable[[], Any], ttl: float = None):
+        """
+        Значение из кэша, а при его отсутствии - из loader() с сохранением в кэш
+
+        Args:
+            namespace: Пространство имён
+            key: Ключ внутри пространства имён
+            loader: Функция загрузки значения (обычно запрос к БД)
+            ttl: Время жизни записи, сек (по умолчанию self.ttl)
+        """
+        full_key = f'{namespace}:{key}'
+        try:
+            value = self.backend.get(full_key)
+        except Exception as e:
+            # недоступный кэш не должен ломать бота
+            logger.error(f"Ошибка чтения кэша: {e}")
+            value = MISSING
+        if value is not MISSING:
+            self._count(namespace, True)
+            return value
+
+        self._count(namespace, False)
+        value = loader()
+        try:
+            self.backend.set(full_key, value, self.ttl if ttl is None else ttl)
+        except Exception as e:
+            logger.error(f"Ошибка записи в кэш: {e}")
+        return value
+
+    def invalidate(self, namespace: str, *keys):
+        """
+        Удаление записей из кэша
+        """
+        for key in keys:
+            try:
+                self.backend.delete(f'{namespace}:{key}')
+            except Exception as e:
+                logger.error(f"Ошибка удаления из кэша: {e}")
+
+    def clear(self):
+        """
+        Очистка кэша
+        """
+        self.backend.clear()
+
+    def stats(self) -> dict:
+        """
+        Статистика попаданий по пространствам имён
+
+        Returns:
+            Словарь {пространство имён: {'hits', 'misses', 'hit_rate'}}
+        """
+        with self._lock:
+            return {namespace: {'hits': hits, 'misses': misses, 'hit_rate': hits / (hits + misses)}
+                    for namespace, (hits, misses) in self._stats.items()}
+
+
+def create_cache() -> Cache:
+    """
+    Кэш с настройками из переменных окружения:
+    CACHE_TTL - время жизни, сек; CACHE_MAX_SIZE - размер кэша в памяти;
+    CACHE_REDIS_URL - адрес Redis для общего кэша нескольких процессов
+    """
+    redis_url = os.getenv('CACHE_REDIS_URL')
+    backend = RedisBackend(redis_url) if redis_url else MemoryBackend(int(os.getenv('CACHE_MAX_SIZE', 10000)))
+    return Cache(backend, ttl=float(os.getenv('CACHE_TTL', 60)))
+
+
+# Кэш процесса для query.py
+cache = create_cache()
@@ -0,0 +1,318 @@
+import hmac
+import json
+import logging
+import os
+import sys
+import threading
+import urllib.error
+import urllib.request
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict
+
+from sqlalchemy import delete, insert
+from sqlalchemy.exc import IntegrityError
+from vk_api.longpoll import VkEventType
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Сколько последних event_id помнить для отбрасывания повторных доставок
+SEEN_EVENTS_LIMIT = 10000
+
+
+class CallbackEvent:
+    """
+    Событие Callback API message_new с теми же полями, что и событие VkLongPoll
+    (type, to_me, user_id, text, payload), - обработчики бота работают с обоими
+    """
+
+    def __init__(self, message: Dict):
+        """
+        Args:
+            message: Объект message из события message_new
+        """
+        self.type = VkEventType.MESSAGE_NEW
+        self.to_me = True
+        self.from_me = False
+        self.user_id = message.get('from_id')
+        self.peer_id = message.get('peer_id')
+        self.message_id = message.get('id')
+        self.text = message.get('text', '')
+        # как и у VkLongPoll, payload есть только у нажатий кнопок
+        if message.get('payload'):
+            self.payload = message['payload']
+
+
+class MemoryEventLog:
+    """
+    Принятые события в памяти процесса (последние limit event_id).
+    Подходит для одного экземпляра бота: другой экземпляр повторную доставку не распознает.
+    """
+
+    def __init__(self, limit: int = SEEN_EVENTS_LIMIT):
+        """
+        Args:
+            limit: Сколько последних event_id помнить
+        """
+        self.limit = limit
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, event_id: str) -> bool:
+        """
+        Запись принятого события
+
+        Returns:
+            True, если событие новое, False - повторная доставка
+        """
+        with self._lock:
+            if event_id in self._seen:
+                return False
+            self._seen[event_id] = None
+            if len(self._seen) > self.limit:
+                self._seen.popitem(last=False)
+        return True
+
+    def forget(self, event_id: str):
+        with self._lock:
+            self._seen.pop(event_id, None)
+
+    def cleanup(self) -> int:
+        return 0
+
+
+class DbEventLog:
+    """
+    Принятые события в таблице callback_events: повторную доставку распознаёт
+    любой экземпляр бота за балансировщиком. Записи старше ttl удаляет cleanup().
+    """
+
+    def __init__(self, bind=None, ttl: float = 3600):
+        """
+        Args:
+            bind: engine БД (по умолчанию engine из models)
+            ttl: Сколько хранить event_id, сек (VK повторяет доставку в течение нескольких минут)
+        """
+        from models import engine
+
+        self.bind = bind or engine
+        self.ttl = ttl
+
+    def add(self, event_id: str) -> bool:
+        from models import CallbackEvents
+
+        try:
+            with self.bind.begin() as conn:
+                conn.execute(insert(CallbackEvents).values(event_id=event_id, received_at=datetime.now()))
+            return True
+        except IntegrityError:
+            return False
+
+    def forget(self, event_id: str):
+        from models import CallbackEvents
+
+        with self.bind.begin() as conn:
+            conn.execute(delete(CallbackEvents).where(CallbackEvents.event_id == event_id))
+
+    def cleanup(self) -> int:
+        from models import CallbackEvents
+
+        with self.bind.begin() as conn:
+            return conn.execute(delete(CallbackEvents).where(
+                CallbackEvents.received_at < datetime.now() - timedelta(seconds=self.ttl))).rowcount
+
+
+def create_event_log():
+    """
+    Журнал принятых событий с настройками из переменных окружения:
+    CALLBACK_DEDUP - memory (по умолчанию, один экземпляр бота) или db (таблица callback_events,
+    общая для нескольких экземпляров); CALLBACK_DEDUP_TTL - сколько хранить event_id в БД, сек
+    """
+    kind = os.getenv('CALLBACK_DEDUP', 'memory')
+    if kind == 'db':
+        return DbEventLog(ttl=float(os.getenv('CALLBACK_DEDUP_TTL', 3600)))
+    if kind == 'memory':
+        return MemoryEventLog()
+    raise ValueError(f'Неизвестный журнал событий Callback API: {kind}')
+
+
+class CallbackServer:
+    """
+    HTTP-сервер Callback API VK: альтернатива LongPoll для запуска нескольких
+    экземпляров бота за балансировщиком.
+
+    Сервер проверяет секретный ключ (обязателен: без него любой, кто знает адрес,
+    может отправлять боту события от имени пользователей), отвечает строкой подтверждения на confirmation,
+    а события message_new сразу подтверждает ответом "ok" и передаёт в submit
+    (очередь диспетчера, обрабатывается пулом потоков). Если очередь переполнена,
+    VK получает ошибку и повторит доставку позже.
+
+    Повторные доставки отбрасываются по event_id через журнал событий: MemoryEventLog
+    видит только события своего процесса, для нескольких экземпляров нужен DbEventLog
+    (CALLBACK_DEDUP=db). Порядок обработки событий одного пользователя сохраняется только
+    внутри экземпляра (очередь диспетчера по ID пользователя): события, которые балансировщик
+    направил на разные экземпляры, могут обрабатываться одновременно (VK и сам не гарантирует
+    порядок доставки). Состояние диалога при этом общее - SESSION_STORE=db.
+    """
+
+    def __init__(self, submit: Callable[[int, CallbackEvent], bool], confirmation: str, secret: str,
+                 group_id: int = None, host: str = '0.0.0.0', port: int = 8080, events=None):
+        """
+        Args:
+            submit: Постановка события в очередь: submit(ID пользователя, событие) -> принято ли
+            confirmation: Строка подтверждения адреса сервера (VK_CALLBACK_CONFIRMATION)
+            secret: Секретный ключ из настроек Callback API (VK_CALLBACK_SECRET), без него сервер не запускается
+            group_id: ID сообщества, события других сообществ отклоняются
+            host: Адрес прослушивания
+            port: Порт прослушивания
+            events: Журнал принятых событий с методами add/forget/cleanup (по умолчанию MemoryEventLog)
+        """
+        if not secret:
+            raise ValueError('Не задан секретный ключ Callback API (VK_CALLBACK_SECRET)')
+        self.submit = submit
+        self.confirmation = confirmation
+        self.secret = secret
+        self.group_id = group_id
+        self.events = MemoryEventLog() if events is None else events
+        self._serving = threading.Event()  # serve_forever выполняется
+        self.httpd = ThreadingHTTPServer((host, port), _CallbackHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.callback = self
+
+    @property
+    def address(self):
+        return self.httpd.server_address
+
+    def serve_forever(self):
+        """
+        Обработка запросов до вызова shutdown()
+        """
+        logger.info(f"Callback API: приём событий на {self.address[0]}:{self.address[1]}")
+        self._serving.set()
+        try:
+            self.httpd.serve_forever()
+        finally:
+            self._serving.clear()
+
+    def shutdown(self):
+        """
+        Остановка сервера (можно вызывать и до запуска serve_forever)
+        """
+        # httpd.shutdown() ждёт выхода из serve_forever и без него завис бы навсегда
+        if self._serving.is_set():
+            self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _is_duplicate(self, event_id: str) -> bool:
+        """
+        Повторная доставка уже принятого события
+        """
+        if not event_id:
+            return False
+        return not self.events.add(event_id)
+
+    def _forget(self, event_id: str):
+        if event_id:
+            self.events.forget(event_id)
+
+    def handle(self, body: Dict) -> tuple:
+        """
+        Обработка одного запроса VK
+
+        Args:
+            body: Тело запроса
+
+        Returns:
+            (HTTP статус, текст ответа)
+        """
+        if not hmac.compare_digest(str(body.get('secret', '')).encode(), self.secret.encode()):
+            metrics.incr('callback.forbidden')
+            return 403, 'forbidden'
+        if self.group_id is not None and body.get('group_id') != self.group_id:
+            metrics.incr('callback.forbidden')
+            return 403, 'forbidden'
+
+        event_type = body.get('type')
+        if event_type == 'confirmation':
+            return 200, self.confirmation
+
+        metrics.incr(f'callback.{event_type}')
+        if event_type != 'message_new':
+            # остальные события бот не обрабатывает, но VK должен получить "ok"
+            return 200, 'ok'
+
+        event_id = body.get('event_id')
+        if self._is_duplicate(event_id):
+            metrics.incr('callback.duplicate')
+            return 200, 'ok'
+
+        obj = body.get('object') or {}
+        # с версии API 5.103 сообщение вложено в object.message
+        event = CallbackEvent(obj.get('message', obj))
+        if not self.submit(event.user_id, event):
+            # очередь переполнена - VK повторит доставку
+            self._forget(event_id)
+            return 503, 'busy'
+        return 200, 'ok'
+
+
+class _CallbackHandler(BaseHTTPRequestHandler):
+    """
+    Разбор HTTP-запроса и ответ (логика - в CallbackServer.handle)
+    """
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(length) or b'{}')
+            if not isinstance(body, dict):
+                raise ValueError('ожидается JSON-объект')
+            status, text = self.server.callback.handle(body)
+        except ValueError as e:
+            logger.error(f"Callback API: некорректный запрос: {e}")
+            status, text = 400, 'bad request'
+        except Exception as e:
+            logger.error(f"Callback API: ошибка обработки запроса: {e}")
+            status, text = 500, 'error'
+
+        data = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug(f"Callback API: {self.address_string()} {format % args}")
+
+
+def replay(path: str, url: str):
+    """
+    Повторная отправка записанных событий (по одному JSON в строке) на сервер бота
+
+    Args:
+        path: Файл с событиями
+        url: Адрес сервера Callback API
+    """
+    with open(path, encoding='utf-8') as file:
+        for line in file:
+            if not line.strip():
+                continue
+            request = urllib.request.Request(url, data=line.strip().encode('utf-8'),
+                                             headers={'Content-Type': 'application/json'})
+            try:
+                with urllib.request.urlopen(request) as response:
+                    print(response.status, response.read().decode('utf-8'))
+            except urllib.error.HTTPError as e:
+                print(e.code, e.read().decode('utf-8'))
+
+
+if __name__ == '__main__':
+    # Проверка сервера бота записанными событиями: python callback_server.py replay events.jsonl [url]
+    if len(sys.argv) < 3 or sys.argv[1] != 'replay':
+        print('Использование: python callback_server.py replay events.jsonl [http://localhost:8080/]')
+        sys.exit(2)
+    replay(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else 'http://localhost:8080/')
@@ -0,0 +1,190 @@
+import logging
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left, bisect_right, insort
+from typing import List, Optional
+
+from sqlalchemy import select
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class CandidateIndex:
+    """
+    Индекс кандидатов в памяти процесса: ID пользователей, разложенные по (город, пол)
+    и отсортированные по возрасту. Выборка диапазона возрастов - два бинарных поиска, без SQL.
+
+    Индекс строится из БД (rebuild) и поддерживается в актуальном состоянии вызовами
+    add/remove из query.py при регистрации и обновлении пользователей. Пока индекс
+    не построен или превышен лимит памяти, range() возвращает None и поиск идёт через БД.
+    """
+
+    def __init__(self, max_users: int = None):
+        """
+        Args:
+            max_users: Максимум пользователей в индексе (ограничение памяти), 0 - индекс отключён
+        """
+        self.max_users = int(os.getenv('CANDIDATE_INDEX_MAX_USERS', 1_000_000)) if max_users is None else max_users
+        self._lock = threading.RLock()
+        self._buckets = {}  # (ID города, пол) -> отсортированный список (возраст, ID пользователя)
+        self._users = {}  # ID пользователя -> (ID города, пол, возраст)
+        self.ready = False  # индекс построен и содержит всех пользователей
+        self._pending = None  # изменения, пришедшие во время rebuild
+
+    def __len__(self):
+        return len(self._users)
+
+    def _disable(self, reason: str):
+        """
+        Отключение индекса до следующего rebuild (поиск переходит на БД)
+        """
+        self._buckets.clear()
+        self._users.clear()
+        self.ready = False
+        metrics.incr('candidate_index.disabled')
+        logger.warning(f"Индекс кандидатов отключён: {reason}")
+
+    def add(self, user_id: int, id_city: int, gender, age: int):
+        """
+        Добавление или обновление пользователя в индексе
+
+        Args:
+            user_id: ID пользователя
+            id_city: ID города
+            gender: Пол (models.Gender)
+            age: Возраст
+        """
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((user_id, (id_city, gender, age)))
+            if not self.ready:
+                return
+            entry = (id_city, gender, age)
+            old = self._users.get(user_id)
+            if old == entry:
+                return
+            if old is not None:
+                self._discard(user_id, old)
+            # пользователи без города, пола или возраста не подходят ни под один поиск
+            if None in entry:
+                return
+            if len(self._users) >= self.max_users:
+                self._disable(f'превышен лимит {self.max_users} пользователей')
+                return
+            self._users[user_id] = entry
+            insort(self._buckets.setdefault((id_city, gender), []), (age, user_id))
+
+    def remove(self, user_id: int):
+        """
+        Удаление пользователя из индекса
+        """
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((user_id, None))
+            entry = self._users.get(user_id)
+            if entry is not None:
+                self._discard(user_id, entry)
+
+    def _discard(self, user_id: int, entry: tuple):
+        id_city, gender, age = entry
+        del self._users[user_id]
+        bucket = self._buckets.get((id_city, gender))
+        position = bisect_left(bucket, (age, user_id))
+        del bucket[position]
+        if not bucket:
+            del self._buckets[(id_city, gender)]
+
+    def range(self, id_city: int, gender, age_from: int, age_to: int) -> Optional[List[int]]:
+        """
+        Кандидаты из города с указанным полом и возрастом в диапазоне [age_from, age_to]
+
+        Returns:
+            Список ID пользователей или None, если индекс не готов
+        """
+        with self._lock:
+            if not self.ready:
+                metrics.incr('candidate_index.miss')
+                return None
+            metrics.incr('candidate_index.hit')
+            bucket = self._buckets.get((id_city, gender))
+            if not bucket:
+                return []
+            start = bisect_left(bucket, (age_from,))
+            end = bisect_right(bucket, (age_to, float('inf')))
+            return [user_id for _, user_id in bucket[start:end]]
+
+    def rebuild(self, bind=None) -> bool:
+        """
+        Построение индекса из таблицы users (холодный старт)
+
+        Args:
+            bind: engine БД (по умолчанию engine из models)
+
+        Returns:
+            True, если индекс построен, False - пользователей больше лимита
+        """
+        from models import engine, Users
+
+        if self.max_users <= 0:
+            return False
+
+        start = time.perf_counter()
+        # пока идёт построение, поиск использует прежний индекс (если он был)
+        with self._lock:
+            self._pending = []
+        buckets, users = {}, {}
+        query = (select(Users.id_VK_user, Users.id_city, Users.gender, Users.age)
+                 .where(Users.id_city.is_not(None), Users.gender.is_not(None), Users.age.is_not(None)))
+        with (bind or engine).connect() as conn:
+            for user_id, id_city, gender, age in conn.execution_options(yield_per=10000).execute(query):
+                if len(users) >= self.max_users:
+                    with self._lock:
+                        self._pending = None
+                        self._disable(f'в БД больше {self.max_users} пользователей')
+                    return False
+                users[user_id] = (id_city, gender, age)
+                buckets.setdefault((id_city, gender), []).append((age, user_id))
+        for bucket in buckets.values():
+            bucket.sort()
+
+        with self._lock:
+            self._buckets, self._users = buckets, users
+            self.ready = True
+            # изменения, сделанные во время чтения таблицы, применяем поверх снимка
+            pending, self._pending = self._pending, None
+            for user_id, entry in pending:
+                if entry is None:
+                    self.remove(user_id)
+                else:
+                    self.add(user_id, *entry)
+        metrics.observe('candidate_index.rebuild', time.perf_counter() - start)
+        logger.info(f"Индекс кандидатов построен: {len(users)} пользователей, "
+                    f"{len(buckets)} групп за {time.perf_counter() - start:.2f} с")
+        return True
+
+
+# Индекс процесса, используется в query.find_match
+candidate_index = CandidateIndex()
+
+
+if __name__ == '__main__':
+    # Размер и время построения индекса на текущей БД (индекс процесса бота строится при его запуске):
+    # python candidate_index.py rebuild
+    logging.basicConfig(level=logging.INFO)
+    command = sys.argv[1] if len(sys.argv) > 1 else 'rebuild'
+    if command != 'rebuild':
+        print('Использование: python candidate_index.py rebuild')
+        sys.exit(2)
+    from models import engine
+
+    start = time.perf_counter()
+    if not candidate_index.rebuild(engine):
+        print(f'Индекс кандидатов не построен: пользователей больше CANDIDATE_INDEX_MAX_USERS '
+              f'({candidate_index.max_users})')
+        sys.exit(1)
+    print(f'Индекс кандидатов: {len(candidate_index)} пользователей, {len(candidate_index._buckets)} групп '
+          f'(город, пол), построен за {time.perf_counter() - start:.2f} с')
@@ -0,0 +1,123 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Hashable
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class KeyedDispatcher:
+    """
+    Параллельная обработка событий пулом потоков.
+
+    События с одним ключом (ID пользователя) обрабатываются строго по очереди,
+    события разных пользователей - параллельно. Количество принятых,
+    но ещё не обработанных событий ограничено: при переполнении submit()
+    ждёт освобождения места (обратное давление на источник событий).
+    """
+
+    def __init__(self, handler: Callable, workers: int = 8, max_pending: int = 1000, batch: int = 10):
+        """
+        Args:
+            handler: Функция обработки одного события
+            workers: Количество потоков-обработчиков
+            max_pending: Максимум событий в очереди и в обработке
+            batch: Сколько событий одного пользователя обработать подряд,
+                   прежде чем уступить поток другим пользователям
+        """
+        self.handler = handler
+        self.batch = batch
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='dispatcher')
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._queues = {}  # ключ -> очередь событий (item, время постановки)
+        self._closed = False
+
+    def submit(self, key: Hashable, item, timeout: float = None) -> bool:
+        """
+        Постановка события в очередь пользователя
+
+        Args:
+            key: Ключ упорядочивания (ID пользователя)
+            item: Событие
+            timeout: Сколько ждать места в очереди (None - без ограничения)
+
+        Returns:
+            True, если событие принято
+        """
+        if not self._slots.acquire(timeout=timeout):
+            metrics.incr('dispatcher.rejected')
+            return False
+
+        with self._lock:
+            if self._closed:
+                self._slots.release()
+                raise RuntimeError('Диспетчер остановлен')
+
+            queue = self._queues.get(key)
+            if queue is not None:
+                # очередь пользователя уже обрабатывается - событие подхватит тот же поток
+                queue.append((item, time.perf_counter()))
+                return True
+            self._queues[key] = deque([(item, time.perf_counter())])
+
+        self._executor.submit(self._drain, key)
+        return True
+
+    def _drain(self, key: Hashable):
+        """
+        Обработка очереди одного пользователя
+        """
+        for _ in range(self.batch):
+            with self._lock:
+                queue = self._queues[key]
+                if not queue:
+                    del self._queues[key]
+                    return
+                item, enqueued_at = queue.popleft()
+
+            metrics.observe('dispatcher.queue_wait', time.perf_counter() - enqueued_at)
+            try:
+                self.handler(item)
+            except Exception as e:
+                logger.error(f"Ошибка обработки события пользователя {key}: {e}")
+            finally:
+                self._slots.release()
+                metrics.observe('dispatcher.latency', time.perf_counter() - enqueued_at)
+
+        # уступаем поток другим пользователям, оставшиеся события обработаются позже
+        with self._lock:
+            if not self._queues[key]:
+                del self._queues[key]
+                return
+        self._executor.submit(self._drain, key)
+
+    def pending(self) -> int:
+        """
+        Количество событий в очередях
+        """
+        with self._lock:
+            return sum(len(queue) for queue in self._queues.values())
+
+    def shutdown(self, wait: bool = True):
+        """
+        Остановка приёма событий и обработка уже принятых
+
+        Args:
+            wait: Дождаться обработки всех принятых событий
+        """
+        with self._lock:
+            self._closed = True
+        if wait:
+            # очереди пользователей могут перепланировать себя, ждём их опустошения
+            while True:
+                with self._lock:
+                    if not self._queues:
+                        break
+                time.sleep(0.05)
+        self._executor.shutdown(wait=wait)
+        logger.info("Диспетчер событий остановлен")
@@ -0,0 +1,111 @@
+import json
+import sys
+from typing import Dict, List
+
+from vk_api.keyboard import VkKeyboard, VkKeyboardColor
+
+# Раскладки клавиатур бота: название -> кнопки [{'text', 'color', 'payload'}]
+LAYOUTS = {
+    # под профилем предлагаемого пользователя
+    'profile': [
+        {'text': '❤️ В избранное', 'color': 'POSITIVE', 'payload': 'add_favorite'},
+        {'text': '🙈 В ЧС', 'color': 'NEGATIVE', 'payload': 'add_blacklist'},
+        {'text': '➡️ Следующий', 'color': 'PRIMARY', 'payload': 'next_user'},
+        {'text': '📋 Избранное', 'color': 'SECONDARY', 'payload': 'show_favorites'},
+        {'text': '🔕 Черный список', 'color': 'SECONDARY', 'payload': 'show_blacklist'},
+        {'text': '🔍 Новый поиск', 'color': 'SECONDARY', 'payload': 'new_search'}
+    ],
+    # после добавления в избранное или ЧС
+    'after_action': [
+        {'text': '➡️ Следующий', 'color': 'PRIMARY', 'payload': 'next_user'},
+        {'text': '📋 Избранное', 'color': 'SECONDARY', 'payload': 'show_favorites'},
+        {'text': '🔕 Черный список', 'color': 'SECONDARY', 'payload': 'show_blacklist'},
+        {'text': '🔍 Новый поиск', 'color': 'SECONDARY', 'payload': 'new_search'}
+    ],
+    # главное меню: приветствие, списки, нет совпадений
+    'menu': [
+        {'text': '🔍 Начать поиск', 'color': 'POSITIVE', 'payload': 'start_search'},
+        {'text': '❤️ Избранное', 'color': 'SECONDARY', 'payload': 'show_favorites'},
+        {'text': '🔕 Черный список', 'color': 'SECONDARY', 'payload': 'show_blacklist'}
+    ],
+}
+
+# Шаблоны карточки профиля (см. render_profile)
+PROFILE_TEMPLATE = '👤 {name} {surname}\n📍 {city_name}\n'
+AGE_TEMPLATE = '🎂 {age} лет\n'
+
+_format_profile = PROFILE_TEMPLATE.format
+_format_age = AGE_TEMPLATE.format
+
+
+def build_keyboard(buttons: List[Dict], one_time: bool = True) -> str:
+    """
+    JSON клавиатуры по списку кнопок (по две кнопки в строке)
+
+    Args:
+        buttons: Список кнопок [{'text': 'Текст', 'color': 'color', 'payload': 'payload'}]
+        one_time: Скрывать клавиатуру после нажатия
+
+    Returns:
+        JSON строка клавиатуры
+    """
+    keyboard = VkKeyboard(one_time=one_time)
+
+    for i, button in enumerate(buttons):
+        if i > 0 and i % 2 == 0:  # Новая строка каждые 2 кнопки
+            keyboard.add_line()
+
+        color = getattr(VkKeyboardColor, button.get('color', 'PRIMARY'))
+        keyboard.add_button(
+            button['text'],
+            color=color,
+            payload=json.dumps(button.get('payload', button['text']))
+        )
+
+    return keyboard.get_keyboard()
+
+
+class KeyboardRegistry:
+    """
+    Готовые JSON клавиатур: каждая раскладка собирается один раз при запуске,
+    при отправке сообщения используется одна и та же строка
+    """
+
+    def __init__(self, layouts: Dict[str, List[Dict]] = None):
+        """
+        Args:
+            layouts: Раскладки {название: кнопки} (по умолчанию LAYOUTS)
+        """
+        self.layouts = layouts or LAYOUTS
+        self._keyboards = {name: sys.intern(build_keyboard(buttons)) for name, buttons in self.layouts.items()}
+
+    def __getitem__(self, name: str) -> str:
+        return self._keyboards[name]
+
+    def with_button(self, name: str, button: Dict) -> str:
+        """
+        Раскладка с дополнительной первой кнопкой (например, «Ещё» с параметрами страницы).
+        Такие клавиатуры зависят от параметров и собираются при каждом вызове.
+        """
+        return build_keyboard([button] + self.layouts[name])
+
+
+def render_profile(user_profile: Dict) -> str:
+    """
+    Текст карточки профиля по шаблону
+
+    Args:
+        user_profile: Профиль пользователя (name, surname, city_name, age)
+
+    Returns:
+        Текст сообщения
+    """
+    message = _format_profile(name=user_profile['name'], surname=user_profile['surname'],
+                              city_name=user_profile['city_name'])
+    if user_profile['age']:
+        message += _format_age(age=user_profile['age'])
+    return message
+
+
+# Клавиатуры процесса бота
+keyboards = KeyboardRegistry()
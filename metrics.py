@@ -0,0 +1,95 @@
+import threading
+from collections import deque
+
+
+class Metrics:
+    """
+    Простейший реестр метрик процесса: счётчики, текущие значения и замеры времени.
+    Для замеров хранится ограниченное окно последних значений,
+    по которому считаются перцентили.
+    """
+
+    def __init__(self, window: int = 1000):
+        """
+        :param window: количество последних замеров для расчёта перцентилей
+        """
+        self.window = window
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._timings = {}
+
+    def incr(self, name: str, value: int = 1):
+        """
+        Увеличение счётчика
+        :param name: название метрики
+        :param value: приращение
+        """
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def gauge(self, name: str, value: float):
+        """
+        Установка текущего значения (размер очереди и т.п.)
+        :param name: название метрики
+        :param value: значение
+        """
+        with self._lock:
+            self._counters[name] = value
+
+    def observe(self, name: str, seconds: float):
+        """
+        Сохранение замера времени
+        :param name: название метрики
+        :param seconds: длительность в секундах
+        """
+        with self._lock:
+            timing = self._timings.get(name)
+            if timing is None:
+                timing = self._timings[name] = {'count': 0, 'total': 0.0, 'max': 0.0,
+                                                'recent': deque(maxlen=self.window)}
+            timing['count'] += 1
+            timing['total'] += seconds
+            timing['max'] = max(timing['max'], seconds)
+            timing['recent'].append(seconds)
+
+    def counter(self, name: str) -> int:
+        """
+        Значение счётчика
+        :param name: название метрики
+        :return: значение
+        """
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def timing(self, name: str) -> dict:
+        """
+        Сводка по замерам времени
+        :param name: название метрики
+        :return: словарь count/avg/max/p50/p99 (секунды)
+        """
+        with self._lock:
+            timing = self._timings.get(name)
+            if not timing:
+                return {'count': 0, 'avg': 0.0, 'max': 0.0, 'p50': 0.0, 'p99': 0.0}
+            recent = sorted(timing['recent'])
+            return {'count': timing['count'],
+                    'avg': timing['total'] / timing['count'],
+                    'max': timing['max'],
+                    'p50': recent[int(len(recent) * 0.5)],
+                    'p99': recent[min(len(recent) - 1, int(len(recent) * 0.99))]}
+
+    def snapshot(self) -> dict:
+        """
+        Все метрики процесса
+        :return: словарь {название: значение счётчика / сводка замеров}
+        """
+        with self._lock:
+            names = list(self._timings)
+            result = dict(self._counters)
+        for name in names:
+            result[name] = self.timing(name)
+        return result
+
+
+# общий реестр метрик процесса
+metrics = Metrics()
@@ -0,0 +1,415 @@
+import json
+import logging
+import sys
+from datetime import datetime
+
+from sqlalchemy import MetaData, Table, Column, Index, ForeignKey, PrimaryKeyConstraint, Integer, BIGINT, SMALLINT, \
+    VARCHAR, TEXT, TIMESTAMP, Boolean, Float, Enum, select, insert, text, func, exists, and_, inspect
+from sqlalchemy.schema import CreateColumn
+
+from models import engine, Users, City, Interests, Matches, MatchJobs, BotSessions, Photos, Gender
+
+logger = logging.getLogger(__name__)
+
+# Таблица с номерами применённых миграций (не входит в модели бота)
+migrations_metadata = MetaData()
+schema_version = Table(
+    'schema_version', migrations_metadata,
+    Column('version', Integer, primary_key=True),  # номер миграции
+    Column('description', VARCHAR),  # описание миграции
+    Column('applied_at', TIMESTAMP),  # метка применения миграции
+)
+
+
+def _table(name: str, *columns, metadata: MetaData = None) -> Table:
+    """
+    Таблица в том виде, в каком её знает миграция. Определения объектов в миграциях
+    не берутся из models.py: изменение модели не должно менять уже выпущенные миграции
+    :param name: название таблицы
+    :param columns: колонки (Column или название колонки, тип которой миграции не важен)
+    :param metadata: MetaData (нужна общая, если таблица ссылается на другую таблицу)
+    :return: таблица
+    """
+    return Table(name, metadata or MetaData(),
+                 *(Column(column) if isinstance(column, str) else column for column in columns))
+
+
+def _create_index(conn, index: Index):
+    """
+    Создание индекса, если его ещё нет в БД
+    :param conn: соединение с БД
+    :param index: индекс по таблице из _table
+    """
+    index.create(conn, checkfirst=True)
+
+
+def _add_column(conn, table: Table, name: str):
+    """
+    Добавление колонки, если её ещё нет в таблице
+    :param conn: соединение с БД
+    :param table: таблица из _table с определением колонки
+    :param name: название колонки
+    """
+    if name in {column['name'] for column in inspect(conn).get_columns(table.name)}:
+        return
+    ddl = CreateColumn(table.c[name]).compile(dialect=conn.dialect)
+    conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {ddl}'))
+
+
+def _initial_schema(conn):
+    """
+    Миграция 1: таблицы бота в исходном виде (до версионных миграций).
+    На существующей БД таблицы уже есть и не изменяются, на пустой - создаются,
+    остальное добавляют следующие миграции, поэтому они проверяют наличие своих объектов.
+    """
+    metadata = MetaData()
+    _table('city', Column('id_city', BIGINT, primary_key=True), Column('city_name', VARCHAR),
+           metadata=metadata)
+    _table('users',
+           Column('id_VK_user', BIGINT, primary_key=True),
+           Column('name', VARCHAR),
+           Column('surname', VARCHAR),
+           Column('age', SMALLINT),
+           Column('gender', Enum('VALUE_ONE', 'VALUE_TWO', name='gender')),
+           Column('id_city', BIGINT, ForeignKey('city.id_city')),
+           metadata=metadata)
+    _table('interests', Column('id_interest', BIGINT, primary_key=True), Column('interest_name', VARCHAR),
+           metadata=metadata)
+    _table('users_interest',
+           Column('id_VK_user', BIGINT, ForeignKey('users.id_VK_user')),
+           Column('id_interest', BIGINT, ForeignKey('interests.id_interest')),
+           PrimaryKeyConstraint('id_VK_user', 'id_interest'),
+           metadata=metadata)
+    _table('blacklist',
+           Column('id_VK_user', BIGINT, ForeignKey('users.id_VK_user')),
+           Column('id_blocked', BIGINT),
+           PrimaryKeyConstraint('id_VK_user', 'id_blocked'),
+           metadata=metadata)
+    _table('favorites',
+           Column('id_VK_user', BIGINT, ForeignKey('users.id_VK_user')),
+           Column('id_target', BIGINT),
+           PrimaryKeyConstraint('id_VK_user', 'id_target'),
+           metadata=metadata)
+    _table('photos',
+           Column('id_user_photo', BIGINT, primary_key=True),
+           Column('id_VK_user', BIGINT, ForeignKey('users.id_VK_user')),
+           Column('url', TEXT),
+           Column('likes', SMALLINT),
+           Column('attachment', TEXT),
+           Column('is_profile_photo', Boolean),
+           metadata=metadata)
+    _table('matches',
+           Column('id_match', BIGINT, primary_key=True),
+           Column('id_VK_user', BIGINT, ForeignKey('users.id_VK_user')),
+           Column('id_target_user', BIGINT),
+           Column('matched_at', TIMESTAMP),
+           Column('match_shown', Boolean),
+           metadata=metadata)
+    metadata.create_all(conn)
+
+
+def _add_search_indexes(conn):
+    """
+    Миграция 2: индексы для горячих запросов query.py
+    """
+    users = _table('users', 'id_city', 'gender', 'age')
+    matches = _table('matches', 'id_VK_user', 'id_target_user', 'matched_at', Column('match_shown', Boolean))
+    city = _table('city', 'city_name')
+    interests = _table('interests', 'interest_name')
+    _create_index(conn, Index('ix_users_city_gender_age', users.c.id_city, users.c.gender, users.c.age))
+    # индекс очереди до появления score (миграция 3 пересоздаёт его с оценкой)
+    _create_index(conn, Index('ix_matches_user_pending', matches.c.id_VK_user, matches.c.matched_at,
+                              postgresql_where=matches.c.match_shown.is_(None),
+                              sqlite_where=matches.c.match_shown.is_(None)))
+    _create_index(conn, Index('ix_matches_user_target', matches.c.id_VK_user, matches.c.id_target_user))
+    _create_index(conn, Index('ix_city_city_name', city.c.city_name, unique=True))
+    _create_index(conn, Index('ix_interests_interest_name', interests.c.interest_name, unique=True))
+
+
+def _add_match_score(conn):
+    """
+    Миграция 3: оценка совпадений и индекс очереди в порядке оценки
+    """
+    matches = _table('matches', 'id_VK_user', 'matched_at', Column('match_shown', Boolean),
+                     Column('score', Float, nullable=False, server_default='0'))
+    _add_column(conn, matches, 'score')
+    conn.execute(text('DROP INDEX IF EXISTS ix_matches_user_pending'))
+    _create_index(conn, Index('ix_matches_user_pending', matches.c.id_VK_user, matches.c.score.desc(),
+                              matches.c.matched_at,
+                              postgresql_where=matches.c.match_shown.is_(None),
+                              sqlite_where=matches.c.match_shown.is_(None)))
+
+
+def _add_user_timestamps(conn):
+    """
+    Миграция 4: метки изменения пользователей и последнего поиска для инкрементального find_match
+    """
+    users = _table('users', Column('created_at', TIMESTAMP), Column('updated_at', TIMESTAMP),
+                   Column('last_search_at', TIMESTAMP))
+    for name in ('created_at', 'updated_at', 'last_search_at'):
+        _add_column(conn, users, name)
+    _create_index(conn, Index('ix_users_updated_at', users.c.updated_at))
+
+
+def _add_match_jobs(conn):
+    """
+    Миграция 5: очередь заданий фонового поиска совпадений (worker.py)
+    """
+    metadata = MetaData()
+    _table('users', Column('id_VK_user', BIGINT, primary_key=True), metadata=metadata)
+    match_jobs = _table('match_jobs',
+                        Column('id_VK_user', BIGINT, ForeignKey('users.id_VK_user'), primary_key=True),
+                        Column('status', VARCHAR, nullable=False),
+                        Column('requested_at', TIMESTAMP),
+                        Column('started_at', TIMESTAMP),
+                        Column('attempts', SMALLINT, nullable=False),
+                        Column('error', TEXT),
+                        metadata=metadata)
+    match_jobs.create(conn, checkfirst=True)
+    _create_index(conn, Index('ix_match_jobs_status_requested', match_jobs.c.status, match_jobs.c.requested_at))
+
+
+def _add_user_refreshed_at(conn):
+    """
+    Миграция 6: метка обновления профиля пользователя из VK
+    """
+    _add_column(conn, _table('users', Column('refreshed_at', TIMESTAMP)), 'refreshed_at')
+
+
+def _add_bot_sessions(conn):
+    """
+    Миграция 7: хранилище сессий бота (session_store.py)
+    """
+    bot_sessions = _table('bot_sessions',
+                          Column('id_VK_user', BIGINT, primary_key=True),
+                          Column('data', TEXT, nullable=False),
+                          Column('expires_at', TIMESTAMP, nullable=False))
+    bot_sessions.create(conn, checkfirst=True)
+    _create_index(conn, Index('ix_bot_sessions_expires_at', bot_sessions.c.expires_at))
+
+
+def _add_photo_likes_index(conn):
+    """
+    Миграция 8: индекс выбора лучших фото пользователя по лайкам
+    """
+    photos = _table('photos', 'id_VK_user', 'likes', 'attachment')
+    _create_index(conn, Index('ix_photos_user_likes', photos.c.id_VK_user, photos.c.likes.desc(),
+                              postgresql_include=['attachment']))
+
+
+def _add_user_photos_refreshed_at(conn):
+    """
+    Миграция 9: метка обновления фото пользователя из VK
+    """
+    _add_column(conn, _table('users', Column('photos_refreshed_at', TIMESTAMP)), 'photos_refreshed_at')
+
+
+def _add_match_reserved_at(conn):
+    """
+    Миграция 10: метка резервирования совпадений и индекс просроченных резервирований
+    """
+    matches = _table('matches', 'id_VK_user', Column('match_shown', Boolean), Column('reserved_at', TIMESTAMP))
+    _add_column(conn, matches, 'reserved_at')
+    _create_index(conn, Index('ix_matches_user_reserved', matches.c.id_VK_user, matches.c.reserved_at,
+                              postgresql_where=matches.c.match_shown == False,
+                              sqlite_where=matches.c.match_shown == False))
+
+
+def _add_callback_events(conn):
+    """
+    Миграция 11: принятые события Callback API, общие для нескольких экземпляров бота
+    """
+    callback_events = _table('callback_events',
+                             Column('event_id', VARCHAR, primary_key=True),
+                             Column('received_at', TIMESTAMP, nullable=False))
+    callback_events.create(conn, checkfirst=True)
+    _create_index(conn, Index('ix_callback_events_received_at', callback_events.c.received_at))
+
+
+def _add_match_target_shown_index(conn):
+    """
+    Миграция 12: индекс показанных совпадений по предлагаемому пользователю
+    """
+    matches = _table('matches', 'id_target_user', Column('match_shown', Boolean))
+    _create_index(conn, Index('ix_matches_target_shown', matches.c.id_target_user,
+                              postgresql_where=matches.c.match_shown.is_(True),
+                              sqlite_where=matches.c.match_shown.is_(True)))
+
+
+# Версионные миграции: (номер, описание, функция применения)
+MIGRATIONS = [
+    (1, 'Начальная схема', _initial_schema),
+    (2, 'Индексы поиска совпадений, уникальные названия городов и интересов', _add_search_indexes),
+    (3, 'Оценка совпадений по общим интересам', _add_match_score),
+    (4, 'Метки изменения пользователей и последнего поиска', _add_user_timestamps),
+    (5, 'Очередь заданий поиска совпадений', _add_match_jobs),
+    (6, 'Метка обновления профиля из VK', _add_user_refreshed_at),
+    (7, 'Сессии бота', _add_bot_sessions),
+    (8, 'Индекс лучших фото пользователя', _add_photo_likes_index),
+    (9, 'Метка обновления фото из VK', _add_user_photos_refreshed_at),
+    (10, 'Срок резервирования совпадений', _add_match_reserved_at),
+    (11, 'Принятые события Callback API', _add_callback_events),
+    (12, 'Индекс показов пользователей для обновления фото', _add_match_target_shown_index),
+]
+
+
+def current_version(conn) -> int:
+    """
+    Номер последней применённой миграции
+    :param conn: соединение с БД
+    :return: номер версии схемы (0 - миграции не применялись)
+    """
+    migrations_metadata.create_all(conn)
+    return conn.execute(select(func.coalesce(func.max(schema_version.c.version), 0))).scalar()
+
+
+def upgrade(bind=None, target: int = None):
+    """
+    Применение неприменённых миграций, каждая в своей транзакции
+    :param bind: engine БД (по умолчанию engine из models)
+    :param target: версия, до которой обновить схему (по умолчанию последняя)
+    :return: номер версии схемы после обновления
+    """
+    bind = bind or engine
+    with bind.begin() as conn:
+        version = current_version(conn)
+
+    for number, description, apply in MIGRATIONS:
+        if number <= version or (target and number > target):
+            continue
+        with bind.begin() as conn:
+            apply(conn)
+            conn.execute(insert(schema_version).values(version=number, description=description,
+                                                       applied_at=datetime.now()))
+        logger.info(f'Применена миграция {number}: {description}')
+        version = number
+    return version
+
+
+def hot_queries() -> dict:
+    """
+    Запросы query.py, которые должны выполняться по индексу
+    :return: словарь {название: (запрос, ожидаемый индекс)}
+    """
+    user_id = 1
+    candidate_filter = and_(Users.gender == Gender.VALUE_TWO,
+                            Users.age >= 25,
+                            Users.age <= 35,
+                            Users.id_city == 1)
+    return {
+        'find_match: кандидаты': (
+            select(func.count(Users.id_VK_user)).where(candidate_filter),
+            'ix_users_city_gender_age'),
+        'find_match: изменившиеся кандидаты': (
+            select(Users.id_VK_user).where(Users.updated_at > datetime(2024, 1, 1)),
+            'ix_users_updated_at'),
+        'find_match: совпадение уже найдено': (
+            select(exists().where(Matches.id_VK_user == user_id, Matches.id_target_user == 2)),
+            'ix_matches_user_target'),
+        'get_match: непоказанные совпадения': (
+            select(Matches).where(Matches.id_VK_user == user_id, Matches.match_shown.is_(None))
+            .order_by(Matches.score.desc(), Matches.matched_at).limit(1),
+            'ix_matches_user_pending'),
+        'claim_matches: просроченные резервирования': (
+            select(Matches.id_match).where(Matches.id_VK_user == user_id, Matches.match_shown == False,
+                                           Matches.reserved_at < datetime(2024, 1, 1)),
+            'ix_matches_user_reserved'),
+        'get_photo_refresh_queue: число показов пользователей': (
+            select(Matches.id_target_user, func.count()).where(Matches.match_shown.is_(True))
+            .group_by(Matches.id_target_user),
+            'ix_matches_target_shown'),
+        'worker: следующие задания': (
+            select(MatchJobs.id_VK_user).where(MatchJobs.status == 'queued')
+            .order_by(MatchJobs.requested_at).limit(10),
+            'ix_match_jobs_status_requested'),
+        'get_photo: лучшие фото пользователя': (
+            select(Photos.attachment).where(Photos.id_VK_user == user_id)
+            .order_by(Photos.likes.desc()).limit(3),
+            'ix_photos_user_likes'),
+        'session_store: истёкшие сессии': (
+            select(BotSessions.id_VK_user).where(BotSessions.expires_at <= datetime(2024, 1, 1)),
+            'ix_bot_sessions_expires_at'),
+        'get_city: город по названию': (
+            select(City.id_city).where(City.city_name == 'Москва'),
+            'ix_city_city_name'),
+        'get_interest: интерес по названию': (
+            select(Interests.id_interest).where(Interests.interest_name == 'поход'),
+            'ix_interests_interest_name'),
+    }
+
+
+def _plan_indexes(plan) -> set:
+    """
+    Названия индексов из плана PostgreSQL (EXPLAIN FORMAT JSON)
+    :param plan: узел плана
+    :return: множество названий индексов
+    """
+    found = set()
+    if isinstance(plan, dict):
+        if 'Index Name' in plan:
+            found.add(plan['Index Name'])
+        for value in plan.values():
+            found |= _plan_indexes(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            found |= _plan_indexes(value)
+    return found
+
+
+def explain_hot_queries(bind=None) -> dict:
+    """
+    Проверка через EXPLAIN, что горячие запросы используют индексы
+    :param bind: engine БД (по умолчанию engine из models)
+    :return: словарь {название запроса: (индекс используется?, план)}
+    """
+    bind = bind or engine
+    result = {}
+    with bind.connect() as conn:
+        dialect = conn.dialect.name
+        if dialect == 'postgresql':
+            # на маленьких таблицах планировщик выбирает seq scan,
+            # проверяем именно возможность выполнить запрос по индексу
+            conn.execute(text('SET enable_seqscan = off'))
+        for name, (query, index_name) in hot_queries().items():
+            sql = str(query.compile(dialect=conn.dialect, compile_kwargs={'literal_binds': True}))
+            if dialect == 'postgresql':
+                plan = conn.execute(text(f'EXPLAIN (FORMAT JSON) {sql}')).scalar()
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+                uses_index = index_name in _plan_indexes(plan)
+            else:
+                plan = [row[-1] for row in conn.execute(text(f'EXPLAIN QUERY PLAN {sql}'))]
+                uses_index = any(index_name in line for line in plan)
+            result[name] = (uses_index, plan)
+        conn.rollback()
+    return result
+
+
+def check_indexes(bind=None) -> bool:
+    """
+    Вывод результатов проверки индексов
+    :param bind: engine БД (по умолчанию engine из models)
+    :return: True, если все горячие запросы используют индексы
+    """
+    ok = True
+    for name, (uses_index, plan) in explain_hot_queries(bind).items():
+        print(f'{"✅" if uses_index else "❌"} {name}')
+        if not uses_index:
+            ok = False
+            print(f'   {plan}')
+    return ok
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    command = sys.argv[1] if len(sys.argv) > 1 else 'upgrade'
+    if command == 'upgrade':
+        print(f'Версия схемы БД: {upgrade()}')
+    elif command == 'version':
+        with engine.begin() as conn:
+            print(f'Версия схемы БД: {current_version(conn)}')
+    elif command == 'explain':
+        sys.exit(0 if check_indexes() else 1)
+    else:
+        print('Использование: python migrations.py [upgrade|version|explain]')
+        sys.exit(2)
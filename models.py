@@ -1,17 +1,97 @@
 import enum
+from contextlib import contextmanager
+from datetime import datetime
+import time
 
 from sqlalchemy import create_engine, Column, VARCHAR, ForeignKey, BIGINT, SMALLINT, TEXT, Boolean, TIMESTAMP, \
-    PrimaryKeyConstraint
+    PrimaryKeyConstraint, Index, Float
 from dotenv import load_dotenv
-from sqlalchemy.orm import declarative_base, sessionmaker, relationship
+from sqlalchemy.orm import declarative_base, sessionmaker, scoped_session, relationship
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.types import Enum as SQLEnum
 import os
 
+from metrics import metrics
+
 load_dotenv()
 
+
+class MeteredQueuePool(QueuePool):
+    """
+    Пул соединений, замеряющий время ожидания свободного соединения
+    """
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            return super().connect()
+        finally:
+            metrics.observe('db.pool.checkout_wait', time.perf_counter() - start)
+
+
+def create_db_engine(url: str = None, **overrides):
+    """
+    Создание engine БД с настройками пула из переменных окружения
+    :param url: строка подключения (по умолчанию DB_URL)
+    :param overrides: параметры create_engine, перекрывающие настройки окружения
+    :return: engine
+    """
+    url = url or os.getenv('DB_URL')
+    options = {'pool_pre_ping': os.getenv('DB_POOL_PRE_PING', '1') == '1'}
+
+    # SQLite использует собственные пулы без ограничения размера
+    if not url.startswith('sqlite'):
+        options.update(
+            poolclass=MeteredQueuePool,
+            pool_size=int(os.getenv('DB_POOL_SIZE', 5)),  # постоянные соединения
+            max_overflow=int(os.getenv('DB_MAX_OVERFLOW', 10)),  # дополнительные соединения при нагрузке
+            pool_timeout=float(os.getenv('DB_POOL_TIMEOUT', 30)),  # ожидание свободного соединения, сек
+            pool_recycle=int(os.getenv('DB_POOL_RECYCLE', 1800)),  # пересоздание соединения, сек
+        )
+        statement_timeout = int(os.getenv('DB_STATEMENT_TIMEOUT', 0))  # мс, 0 - без ограничения
+        if statement_timeout and url.startswith('postgresql'):
+            options['connect_args'] = {'options': f'-c statement_timeout={statement_timeout}'}
+
+    options.update(overrides)
+    return create_engine(url, **options)
+
+
+def pool_stats() -> dict:
+    """
+    Состояние пула соединений и время ожидания соединения
+    :return: словарь со статистикой
+    """
+    pool = engine.pool
+    stats = {'status': pool.status(), 'checkout_wait': metrics.timing('db.pool.checkout_wait')}
+    if isinstance(pool, QueuePool):
+        stats.update(size=pool.size(), checked_out=pool.checkedout(), overflow=pool.overflow())
+    return stats
+
+
 Base = declarative_base()
-engine = create_engine(os.getenv('DB_URL'))
-SessionLocal = sessionmaker(bind=engine)
+engine = create_db_engine()
+# объекты остаются доступны после закрытия сессии (их хранит бот между запросами)
+SessionLocal = sessionmaker(bind=engine, expire_on_commit=False)
+# сессия текущего запроса, своя в каждом потоке
+Session = scoped_session(SessionLocal)
+
+
+@contextmanager
+def session_scope():
+    """
+    Область одного запроса к боту: все функции query.py внутри блока
+    работают в одной сессии, которая закрывается (возвращает соединение в пул) при выходе.
+    При ошибке незафиксированные изменения откатываются.
+    """
+    session = Session()
+    try:
+        yield session
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        Session.remove()
 
 
 class Gender(enum.Enum):
@@ -27,12 +107,23 @@ class Users(Base):
     age = Column(SMALLINT)  # возраст пользователя
     gender = Column(SQLEnum(Gender))  # пол пользователя
     id_city = Column(BIGINT, ForeignKey('city.id_city'))  # ID города проживания пользователя
+    created_at = Column(TIMESTAMP, default=datetime.now)  # метка регистрации пользователя
+    updated_at = Column(TIMESTAMP, default=datetime.now, onupdate=datetime.now)  # метка изменения профиля или интересов
+    last_search_at = Column(TIMESTAMP)  # метка последнего поиска совпадений (см. find_match)
+    refreshed_at = Column(TIMESTAMP)  # метка последнего получения профиля из VK (см. profile_refresh.py)
+    photos_refreshed_at = Column(TIMESTAMP)  # метка последнего получения фото из VK (см. photo_refresh.py)
     interest = relationship('UsersInterest', back_populates='user')
     blacklist = relationship('BlackList', back_populates='user')
     favorite = relationship('Favorites', back_populates='user')
     photo = relationship('Photos', back_populates='user')
     match = relationship('Matches', back_populates='user')
     city = relationship('City', back_populates='user')
+    __table_args__ = (
+        # поиск кандидатов в find_match: город, пол, диапазон возраста
+        Index('ix_users_city_gender_age', 'id_city', 'gender', 'age'),
+        # пользователи, изменившиеся после последнего поиска (инкрементальный find_match)
+        Index('ix_users_updated_at', 'updated_at'),
+    )
 
     def __repr__(self):
         return f'<User(id_VK_user={self.id_VK_user}, name={self.name}, surname={self.surname}, age={self.age}, gender={self.gender}, city={self.city})>'
@@ -46,6 +137,7 @@ class City(Base):
     id_city = Column(BIGINT, primary_key=True)  # id города
     city_name = Column(VARCHAR)  # название города
     user = relationship('Users', back_populates='city')
+    __table_args__ = (Index('ix_city_city_name', 'city_name', unique=True),)
 
     def __repr__(self):
         return f'<City(id_city={self.id_city}, city_name={self.city_name})>'
@@ -59,6 +151,7 @@ class Interests(Base):
     id_interest = Column(BIGINT, primary_key=True)  # id интереса
     interest_name = Column(VARCHAR)  # название интереса
     interest = relationship('UsersInterest', back_populates='interest')
+    __table_args__ = (Index('ix_interests_interest_name', 'interest_name', unique=True),)
 
     def __repr__(self):
         return f'<Interests(id_interest={self.id_interest}, interest_name={self.interest_name})>'
@@ -122,6 +215,10 @@ class Photos(Base):
     attachment = Column(TEXT)  # аттачмент
     is_profile_photo = Column(Boolean)  # фото стоит на профиле?
     user = relationship('Users', back_populates='photo')
+    # лучшие фото пользователя по лайкам; в PostgreSQL attachment читается прямо из индекса
+    __table_args__ = (
+        Index('ix_photos_user_likes', 'id_VK_user', likes.desc(), postgresql_include=['attachment']),
+    )
 
     def __repr__(self):
         return f'<Photos(id_user_photo={self.id_user_photo}, id_VK_user={self.id_VK_user}, url={self.url}, likes={self.likes}, attachment={self.attachment}, is_profile_photo={self.is_profile_photo})>'
@@ -136,20 +233,80 @@ class Matches(Base):
     id_VK_user = Column(BIGINT, ForeignKey('users.id_VK_user'))  # id пользователя ВК - "инициатора"
     id_target_user = Column(BIGINT)  # id предлагаемого пользователя
     matched_at = Column(TIMESTAMP)  # метка добавления совпадения в таблицу
-    match_shown = Column(Boolean)  # Совпадение показано?
+    match_shown = Column(Boolean)  # Совпадение показано? (NULL - в очереди, False - зарезервировано для показа)
+    score = Column(Float, nullable=False, default=0, server_default='0')  # оценка по общим интересам (см. scoring.py)
+    reserved_at = Column(TIMESTAMP)  # метка резервирования (после MATCH_RESERVATION_LEASE совпадение возвращается в очередь)
     user = relationship('Users', back_populates='match')
+    __table_args__ = (
+        # непоказанные совпадения пользователя для get_match, лучшие первыми
+        Index('ix_matches_user_pending', 'id_VK_user', score.desc(), 'matched_at',
+              postgresql_where=match_shown.is_(None), sqlite_where=match_shown.is_(None)),
+        # проверка "совпадение уже найдено" в find_match
+        Index('ix_matches_user_target', 'id_VK_user', 'id_target_user'),
+        # просроченные резервирования пользователя для claim_matches
+        Index('ix_matches_user_reserved', 'id_VK_user', 'reserved_at',
+              postgresql_where=match_shown == False, sqlite_where=match_shown == False),
+        # число показов пользователя другим для get_photo_refresh_queue
+        Index('ix_matches_target_shown', 'id_target_user',
+              postgresql_where=match_shown.is_(True), sqlite_where=match_shown.is_(True)),
+    )
+
+    def __repr__(self):
+        return f'<Matches(id_match={self.id_match}, id_VK_user={self.id_VK_user}, id_target_user={self.id_target_user}, matched_at={self.matched_at}, match_shown={self.match_shown}, score={self.score})>'
+
+    def __str__(self):
+        return f'Matches: id_match={self.id_match}, id_VK_user={self.id_VK_user}, id_target_user={self.id_target_user}, matched_at={self.matched_at}, match_shown={self.match_shown}, score={self.score}'
+
+
+class MatchJobs(Base):
+    __tablename__ = 'match_jobs'
+    id_VK_user = Column(BIGINT, ForeignKey('users.id_VK_user'), primary_key=True)  # для кого искать совпадения
+    status = Column(VARCHAR, nullable=False, default='queued')  # queued - в очереди, running - выполняется, failed
+    requested_at = Column(TIMESTAMP)  # метка последней постановки в очередь
+    started_at = Column(TIMESTAMP)  # метка захвата задания обработчиком (после MATCH_JOB_LEASE захват истекает)
+    attempts = Column(SMALLINT, nullable=False, default=0)  # количество попыток выполнения
+    error = Column(TEXT)  # текст последней ошибки
+    # выбор следующих заданий в worker.py
+    __table_args__ = (Index('ix_match_jobs_status_requested', 'status', 'requested_at'),)
+
+    def __repr__(self):
+        return f'<MatchJobs(id_VK_user={self.id_VK_user}, status={self.status}, requested_at={self.requested_at}, attempts={self.attempts})>'
+
+    def __str__(self):
+        return f'MatchJobs: id_VK_user={self.id_VK_user}, status={self.status}, requested_at={self.requested_at}, attempts={self.attempts}'
+
+
+class BotSessions(Base):
+    __tablename__ = 'bot_sessions'
+    id_VK_user = Column(BIGINT, primary_key=True)  # id пользователя бота
+    data = Column(TEXT, nullable=False)  # состояние диалога в JSON (см. session_store.py)
+    expires_at = Column(TIMESTAMP, nullable=False)  # метка истечения сессии
+    # удаление истёкших сессий
+    __table_args__ = (Index('ix_bot_sessions_expires_at', 'expires_at'),)
+
+    def __repr__(self):
+        return f'<BotSessions(id_VK_user={self.id_VK_user}, expires_at={self.expires_at})>'
+
+    def __str__(self):
+        return f'BotSessions: id_VK_user={self.id_VK_user}, expires_at={self.expires_at}'
+
+
+class CallbackEvents(Base):
+    __tablename__ = 'callback_events'
+    event_id = Column(VARCHAR, primary_key=True)  # event_id принятого события Callback API
+    received_at = Column(TIMESTAMP, nullable=False)  # метка приёма (старые записи удаляются, см. callback_server.py)
+    # удаление старых записей
+    __table_args__ = (Index('ix_callback_events_received_at', 'received_at'),)
 
     def __repr__(self):
-        return f'<Matches(id_match={self.id_match}, id_VK_user={self.id_VK_user}, id_target_user={self.id_target_user}, matched_at={self.matched_at}, match_shown={self.match_shown})>'
+        return f'<CallbackEvents(event_id={self.event_id}, received_at={self.received_at})>'
 
     def __str__(self):
-        return f'Matches: id_match={self.id_match}, id_VK_user={self.id_VK_user}, id_target_user={self.id_target_user}, matched_at={self.matched_at}, match_shown={self.match_shown}'
+        return f'CallbackEvents: event_id={self.event_id}, received_at={self.received_at}'
 
 
 if __name__ == '__main__':
-    # Удаление таблиц, созданных ранее с другим набором полей
-    # после отладки закомментировать/удалить
-    Base.metadata.drop_all(engine)
+    # Создание/обновление таблиц в БД через версионные миграции (см. migrations.py)
+    from migrations import upgrade
 
-    # Создание таблиц в БД
-    Base.metadata.create_all(engine)
+    upgrade()
@@ -0,0 +1,280 @@
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+from vk_api.exceptions import ApiError
+from vk_api.utils import get_random_id
+
+from metrics import metrics
+from vk_batch import EXECUTE_LIMIT
+from vk_ratelimit import Priority
+
+logger = logging.getLogger(__name__)
+
+# Максимальная длина текста сообщения VK
+MESSAGE_LIMIT = 4096
+# Максимум получателей в одном messages.send с peer_ids
+PEER_IDS_LIMIT = 100
+# Ошибки, при которых повторная отправка бессмысленна (нет доступа к диалогу, запрещено и т.п.)
+PERMANENT_ERRORS = {7, 15, 900, 901, 902}
+
+
+@dataclass
+class OutgoingMessage:
+    """
+    Сообщение в очереди отправки.
+    random_id выдаётся при постановке в очередь и сохраняется при повторах:
+    если VK принял сообщение, но ответ не дошёл, повтор не создаст дубликат
+    """
+    message: str
+    keyboard: Optional[str] = None
+    attachment: Optional[str] = None
+    attempts: int = 0
+    random_id: int = field(default_factory=get_random_id)
+
+    def key(self) -> tuple:
+        return self.message, self.keyboard, self.attachment
+
+
+class Outbox:
+    """
+    Очередь исходящих сообщений: обработчики событий только ставят сообщения
+    в очередь, отправляет их отдельный поток в пределах ограничения частоты токена группы.
+
+    Подряд идущие сообщения одному получателю объединяются в одно (клавиатура - последняя),
+    одинаковые сообщения разным получателям уходят одним messages.send с peer_ids,
+    а вызовы одного прохода - одним execute (до 25 вызовов). Порядок сообщений
+    каждого получателя сохраняется, неудачная отправка повторяется с задержкой.
+    """
+
+    def __init__(self, vk_batch, retries: int = 3, backoff: float = 1.0):
+        """
+        Args:
+            vk_batch: Объединение запросов токена группы (VkRequestBatcher над RateLimitedVkApi)
+            retries: Попыток отправки сообщения
+            backoff: Задержка перед повтором, сек (удваивается с каждой попыткой)
+        """
+        self.vk_batch = vk_batch
+        self.retries = retries
+        self.backoff = backoff
+        self._cond = threading.Condition()
+        self._queues = OrderedDict()  # ID получателя -> deque[OutgoingMessage], в порядке поступления
+        self._not_before = {}  # ID получателя -> время повторной попытки (time.monotonic)
+        self._sending = 0  # сообщений в отправке
+        self._stop = False
+        self._thread = None
+
+    def start(self):
+        """
+        Запуск потока отправки
+        """
+        if self._thread is None:
+            self._stop = False
+            self._thread = threading.Thread(target=self._run, name='outbox', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout: float = 10):
+        """
+        Остановка после отправки накопленных сообщений
+
+        Args:
+            timeout: Сколько ждать отправки, сек
+        """
+        self.flush(timeout)
+        with self._cond:
+            self._stop = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def send(self, peer_id: int, message: str, keyboard: str = None, attachment: str = None):
+        """
+        Постановка сообщения в очередь (без ожидания отправки)
+
+        Args:
+            peer_id: ID получателя
+            message: Текст сообщения
+            keyboard: Клавиатура (JSON)
+            attachment: Вложения через запятую
+        """
+        with self._cond:
+            self._queues.setdefault(peer_id, deque()).append(OutgoingMessage(message, keyboard, attachment))
+            metrics.incr('outbox.queued')
+            self._cond.notify()
+
+    def pending(self) -> int:
+        """
+        Количество сообщений в очереди и в отправке
+        """
+        with self._cond:
+            return sum(len(queue) for queue in self._queues.values()) + self._sending
+
+    def flush(self, timeout: float = None) -> bool:
+        """
+        Ожидание отправки всех сообщений
+
+        Returns:
+            True, если очередь опустела
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._queues or self._sending:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining if remaining is not None else 1)
+        return True
+
+    def _coalesce(self, queue: deque) -> OutgoingMessage:
+        """
+        Объединение подряд идущих сообщений получателя в одно.
+        Вложения есть не больше чем у одного из объединяемых сообщений,
+        текст не длиннее ограничения VK. Объединённое сообщение получает новый random_id,
+        а уже отправлявшееся сообщение не меняется, чтобы повтор сохранил свой random_id.
+        """
+        merged = queue.popleft()
+        while queue and not merged.attempts:
+            following = queue[0]
+            if merged.attachment and following.attachment:
+                break
+            if len(merged.message) + len(following.message) + 2 > MESSAGE_LIMIT:
+                break
+            queue.popleft()
+            merged = OutgoingMessage('\n\n'.join(filter(None, (merged.message, following.message))),
+                                     following.keyboard or merged.keyboard,
+                                     merged.attachment or following.attachment,
+                                     max(merged.attempts, following.attempts))
+            metrics.incr('outbox.coalesced')
+        return merged
+
+    def _take(self) -> List[tuple]:
+        """
+        Выбор сообщений для одного прохода: по одному (объединённому) сообщению
+        на получателя, до EXECUTE_LIMIT вызовов
+
+        Returns:
+            Список (ID получателя, OutgoingMessage)
+        """
+        now = time.monotonic()
+        taken, calls = [], set()
+        for peer_id in list(self._queues):
+            if peer_id in self._not_before:
+                if self._not_before[peer_id] > now:
+                    continue
+                del self._not_before[peer_id]
+            queue = self._queues[peer_id]
+            message = self._coalesce(queue)
+            if not queue:
+                del self._queues[peer_id]
+            taken.append((peer_id, message))
+            calls.add(message.key())
+            if len(calls) >= EXECUTE_LIMIT:
+                break
+        return taken
+
+    def _next_wakeup(self) -> Optional[float]:
+        """
+        Через сколько секунд станет доступен получатель, ожидающий повтора
+        """
+        if not self._not_before:
+            return None
+        return max(0.0, min(self._not_before.values()) - time.monotonic())
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    taken = self._take()
+                    if taken or (self._stop and not self._queues):
+                        break
+                    self._cond.wait(self._next_wakeup() if self._queues else None)
+                if not taken:
+                    return
+                self._sending = len(taken)
+            try:
+                self._deliver(taken)
+            except Exception as e:
+                logger.error(f"Ошибка отправки сообщений: {e}")
+                self._retry(taken, e)
+            finally:
+                with self._cond:
+                    self._sending = 0
+                    self._cond.notify_all()
+
+    def _deliver(self, taken: List[tuple]):
+        """
+        Отправка сообщений одного прохода: одинаковые сообщения - через peer_ids,
+        все вызовы - одним execute.
+        Сообщения вызова с peer_ids получают общий random_id; при повторе они
+        объединяются только с сообщениями с тем же random_id.
+        """
+        # (текст, клавиатура, вложения, random_id повтора) -> [(ID получателя, сообщение)]
+        groups = OrderedDict()
+        for peer_id, message in taken:
+            key = message.key() + (message.random_id if message.attempts else None,)
+            groups.setdefault(key, []).append((peer_id, message))
+
+        calls, call_groups = [], []
+        for (text, keyboard, attachment, _), items in groups.items():
+            for start in range(0, len(items), PEER_IDS_LIMIT):
+                chunk = items[start:start + PEER_IDS_LIMIT]
+                random_id = chunk[0][1].random_id
+                for _, message in chunk:
+                    message.random_id = random_id
+                values = {'message': text, 'keyboard': keyboard, 'attachment': attachment,
+                          'random_id': random_id}
+                if len(chunk) == 1:
+                    values['peer_id'] = chunk[0][0]
+                else:
+                    values['peer_ids'] = ','.join(str(peer_id) for peer_id, _ in chunk)
+                calls.append(('messages.send', values))
+                call_groups.append(chunk)
+
+        results = self.vk_batch.call_many(calls, priority=Priority.INTERACTIVE)
+        metrics.incr('outbox.requests', -(-len(calls) // EXECUTE_LIMIT))
+
+        failed = []
+        for chunk, result in zip(call_groups, results):
+            if isinstance(result, Exception):
+                failed.extend((peer_id, message, result) for peer_id, message in chunk)
+                continue
+            chunk_failed = 0
+            if isinstance(result, list):
+                # ответ peer_ids: ошибки по отдельным получателям
+                errors = {item.get('peer_id'): item['error'] for item in result if item.get('error')}
+                for peer_id, message in chunk:
+                    if peer_id in errors:
+                        error = {'error_code': errors[peer_id].get('code'),
+                                 'error_msg': errors[peer_id].get('description')}
+                        failed.append((peer_id, message, ApiError(None, 'messages.send', {}, False, error)))
+                        chunk_failed += 1
+            if len(chunk) > chunk_failed:
+                metrics.incr('outbox.sent', len(chunk) - chunk_failed)
+        metrics.gauge('outbox.pending', self.pending())
+
+        for peer_id, message, error in failed:
+            self._retry([(peer_id, message)], error)
+
+    def _retry(self, taken: List[tuple], error: Exception):
+        """
+        Возврат неотправленных сообщений в начало очереди получателя для повторной попытки
+        """
+        with self._cond:
+            for peer_id, message in taken:
+                message.attempts += 1
+                if isinstance(error, ApiError) and error.code in PERMANENT_ERRORS or message.attempts >= self.retries:
+                    metrics.incr('outbox.dropped')
+                    logger.error(f"Сообщение пользователю {peer_id} не отправлено: {error}")
+                    continue
+                metrics.incr('outbox.retried')
+                self._queues.setdefault(peer_id, deque()).appendleft(message)
+                self._queues.move_to_end(peer_id, last=False)
+                self._not_before[peer_id] = time.monotonic() + self.backoff * 2 ** (message.attempts - 1)
+            # получатели без отложенных сообщений больше не ждут
+            for peer_id in [peer_id for peer_id in self._not_before if peer_id not in self._queues]:
+                del self._not_before[peer_id]
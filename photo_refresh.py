@@ -0,0 +1,90 @@
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List
+
+from vk_api.exceptions import ApiError
+
+from models import session_scope
+from query import get_photo_refresh_queue, sync_photos, mark_photos_refreshed, PHOTOS_TOP_K
+from vk_batch import EXECUTE_LIMIT
+from vk_ratelimit import Priority
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class PhotoRefresher:
+    """
+    Фоновое обновление фото пользователей из VK (лайки и attachment со временем меняются).
+
+    Каждый запуск берёт пользователей с устаревшими фото (старше max_age), начиная
+    с тех, кого чаще показывали другим, получает их фото через execute (до 25
+    photos.get за запрос) и записывает в БД только изменившиеся строки (sync_photos).
+    Количество запросов к VK за запуск ограничено budget, запросы идут с фоновым
+    приоритетом и не задерживают ответы пользователям.
+    """
+
+    def __init__(self, vk_batch, request: Callable[[int], Dict], select: Callable[[List[Dict], int], List[Dict]],
+                 max_age: float = None, budget: int = None):
+        """
+        Args:
+            vk_batch: Объединение запросов пользовательского токена (VkRequestBatcher)
+            request: Параметры photos.get для пользователя (VKinderBot._photos_request)
+            select: Отбор популярных фото из ответа photos.get (VKinderBot._select_popular_photos)
+            max_age: Через сколько секунд фото считаются устаревшими (PHOTO_MAX_AGE)
+            budget: Максимум запросов к VK за один запуск (PHOTO_REFRESH_BUDGET)
+        """
+        self.vk_batch = vk_batch
+        self.request = request
+        self.select = select
+        self.max_age = max_age or float(os.getenv('PHOTO_MAX_AGE', 7 * 86400))
+        self.budget = int(os.getenv('PHOTO_REFRESH_BUDGET', 2)) if budget is None else budget
+
+    def run(self) -> int:
+        """
+        Обновление фото очередной пачки пользователей
+
+        Returns:
+            Количество пользователей, фото которых изменились
+        """
+        if self.budget <= 0:
+            return 0
+        with session_scope():
+            refreshed_before = datetime.now() - timedelta(seconds=self.max_age)
+            user_ids = get_photo_refresh_queue(refreshed_before, self.budget * EXECUTE_LIMIT)
+        if not user_ids:
+            return 0
+
+        results = self.vk_batch.call_many([('photos.get', self.request(user_id)) for user_id in user_ids],
+                                          priority=Priority.BACKGROUND)
+        metrics.incr('photos.refresh.requests', -(-len(user_ids) // EXECUTE_LIMIT))
+
+        changed = unavailable = 0
+        for user_id, result in zip(user_ids, results):
+            if isinstance(result, ApiError):
+                # закрытый или удалённый профиль - сохранённые фото оставляем до следующего срока
+                with session_scope():
+                    mark_photos_refreshed([user_id])
+                unavailable += 1
+                continue
+            if isinstance(result, Exception):
+                # сетевые и прочие ошибки - повторим при следующем запуске
+                logger.error(f"Ошибка получения фотографий пользователя {user_id}: {result}")
+                continue
+            try:
+                with session_scope():
+                    added, updated, deleted = sync_photos(user_id, self.select(result['items'], PHOTOS_TOP_K))
+            except Exception as e:
+                # ошибка записи одного пользователя не прерывает обновление остальных
+                logger.error(f"Ошибка сохранения фотографий пользователя {user_id}: {e}")
+                metrics.incr('photos.refresh.errors')
+                continue
+            if added or updated or deleted:
+                changed += 1
+                metrics.incr('photos.refresh.rows', added + updated + deleted)
+
+        metrics.incr('photos.refresh.users', len(user_ids))
+        logger.info(f"Обновлены фото пользователей: {len(user_ids)}, с изменениями {changed}, "
+                    f"недоступно {unavailable}")
+        return changed
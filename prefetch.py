@@ -0,0 +1,176 @@
+import logging
+import threading
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+
+from models import session_scope
+from query import claim_prepared_matches, mark_matches_shown, release_matches
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PreparedMatch:
+    """
+    Совпадение, готовое к отправке: текст профиля и вложения уже сформированы
+    """
+    id_match: int  # ID совпадения
+    id_VK_user: int  # ID предлагаемого пользователя
+    message: str  # текст профиля
+    attachments: List[str] = field(default_factory=list)  # фото для attachment
+
+
+class MatchPrefetcher:
+    """
+    Буфер следующих совпадений для каждого пользователя бота.
+
+    В буфере держится до depth совпадений с профилем, фото и готовым текстом,
+    после выдачи буфер дополняется в фоне. Совпадения резервируются в БД
+    атомарно (match_shown = False), поэтому несколько процессов бота не покажут
+    одно совпадение дважды. Отметки о показе копятся и записываются пачками (flush).
+    """
+
+    def __init__(self, render: Callable[[Dict], str], executor, depth: int = 5, flush_size: int = 50):
+        """
+        Args:
+            render: Функция формирования текста профиля из строки claim_prepared_matches
+            executor: Пул потоков для фонового дополнения буфера
+            depth: Сколько совпадений держать готовыми
+            flush_size: Сколько отметок о показе накапливать до записи в БД
+        """
+        self.render = render
+        self.executor = executor
+        self.depth = depth
+        self.flush_size = flush_size
+        self._lock = threading.Lock()
+        self._buffers = {}  # ID пользователя -> deque[PreparedMatch]
+        self._refilling = set()  # пользователи, для которых идет фоновая загрузка
+        self._shown = []  # ID показанных совпадений, ещё не записанные в БД
+
+    def pop(self, user_id: int) -> Optional[PreparedMatch]:
+        """
+        Следующее совпадение пользователя
+
+        Args:
+            user_id: ID пользователя бота
+
+        Returns:
+            Готовое совпадение или None, если совпадений больше нет
+        """
+        with self._lock:
+            buffer = self._buffers.get(user_id)
+            prepared = buffer.popleft() if buffer else None
+
+        if prepared is None:
+            metrics.incr('prefetch.miss')
+            # буфер пуст - загружаем синхронно в сессии текущего запроса
+            self._fill(user_id)
+            with self._lock:
+                buffer = self._buffers.get(user_id)
+                prepared = buffer.popleft() if buffer else None
+            if prepared is None:
+                return None
+        else:
+            metrics.incr('prefetch.hit')
+
+        with self._lock:
+            self._shown.append(prepared.id_match)
+            need_flush = len(self._shown) >= self.flush_size
+        if need_flush:
+            self.executor.submit(self._background, self.flush)
+        self.schedule_refill(user_id)
+        return prepared
+
+    def buffered(self, user_id: int) -> int:
+        """
+        Количество готовых совпадений пользователя в буфере
+        """
+        with self._lock:
+            return len(self._buffers.get(user_id, ()))
+
+    def schedule_refill(self, user_id: int):
+        """
+        Фоновое дополнение буфера пользователя до depth совпадений
+        """
+        with self._lock:
+            if user_id in self._refilling or len(self._buffers.get(user_id, ())) >= self.depth:
+                return
+            self._refilling.add(user_id)
+        self.executor.submit(self._background, self._fill, user_id)
+
+    def _background(self, func: Callable, *args):
+        try:
+            with session_scope():
+                func(*args)
+        except Exception as e:
+            logger.error(f"Ошибка фоновой загрузки совпадений: {e}")
+
+    def _fill(self, user_id: int):
+        """
+        Загрузка совпадений в буфер
+        """
+        try:
+            with self._lock:
+                missing = self.depth - len(self._buffers.get(user_id, ()))
+            if missing <= 0:
+                return
+
+            # зарезервированные совпадения не вернутся повторно ни этому, ни другому процессу
+            rows = claim_prepared_matches(user_id, missing)
+            prepared = [PreparedMatch(row['id_match'], row['id_VK_user'], self.render(row), row['attachments'])
+                        for row in rows]
+            with self._lock:
+                self._buffers.setdefault(user_id, deque()).extend(prepared)
+        finally:
+            with self._lock:
+                self._refilling.discard(user_id)
+
+    def invalidate(self, user_id: int, target_id: int = None):
+        """
+        Удаление совпадений из буфера
+
+        Args:
+            user_id: ID пользователя бота
+            target_id: ID предлагаемого пользователя (например, добавленного в ЧС),
+                       его совпадения остаются зарезервированными и не будут показаны;
+                       None - очистить буфер пользователя целиком и вернуть совпадения в очередь
+        """
+        with self._lock:
+            buffer = self._buffers.get(user_id)
+            if not buffer:
+                return
+            if target_id is None:
+                released = [item.id_match for item in self._buffers.pop(user_id)]
+            else:
+                released = []
+                self._buffers[user_id] = deque(item for item in buffer if item.id_VK_user != target_id)
+        if released:
+            release_matches(released)
+        self.schedule_refill(user_id)
+
+    def release_all(self):
+        """
+        Возврат всех непоказанных совпадений из буферов в очередь (при остановке бота)
+        """
+        with self._lock:
+            released = [item.id_match for buffer in self._buffers.values() for item in buffer]
+            self._buffers.clear()
+        release_matches(released)
+
+    def flush(self):
+        """
+        Запись накопленных отметок о показе в БД одним запросом
+        """
+        with self._lock:
+            shown, self._shown = self._shown, []
+        if not shown:
+            return
+        try:
+            mark_matches_shown(shown)
+        except Exception:
+            # вернем отметки, чтобы записать при следующем flush
+            with self._lock:
+                self._shown.extend(shown)
+            raise
@@ -0,0 +1,111 @@
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+from typing import Callable, Dict
+
+from models import Gender, session_scope
+from query import get_stale_users, refresh_profiles
+from vk_ratelimit import Priority
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Максимум ID в одном запросе users.get
+USERS_GET_LIMIT = 1000
+
+
+class ProfileRefresher:
+    """
+    Фоновое обновление профилей пользователей из VK.
+
+    Бот работает с профилем из БД, а устаревшие профили (старше max_age)
+    ставятся в очередь и обновляются пачками: один запрос users.get на
+    до batch_size пользователей, изменения записываются одной транзакцией (refresh_profiles).
+    Кроме запрошенных ботом, каждый запуск дополняет пачку устаревшими
+    профилями из БД.
+    """
+
+    def __init__(self, vk, parse: Callable[[Dict], Dict], max_age: float = None, batch_size: int = None):
+        """
+        Args:
+            vk: Клиент API с методом method(method, values, priority=...) (RateLimitedVkApi)
+            parse: Функция разбора элемента ответа users.get (VKinderBot._parse_user_info)
+            max_age: Через сколько секунд профиль считается устаревшим (PROFILE_MAX_AGE)
+            batch_size: Максимум профилей за один запуск (PROFILE_REFRESH_BATCH)
+        """
+        self.vk = vk
+        self.parse = parse
+        self.max_age = max_age or float(os.getenv('PROFILE_MAX_AGE', 86400))
+        self.batch_size = min(USERS_GET_LIMIT, batch_size or int(os.getenv('PROFILE_REFRESH_BATCH', 500)))
+        self._lock = threading.Lock()
+        self._pending = set()
+
+    def is_stale(self, user) -> bool:
+        """
+        Устарел ли профиль пользователя (объект Users)
+        """
+        return user.refreshed_at is None or user.refreshed_at < datetime.now() - timedelta(seconds=self.max_age)
+
+    def refresh_if_stale(self, user) -> bool:
+        """
+        Постановка профиля в очередь обновления, если он устарел (без запросов к VK)
+
+        Returns:
+            True, если профиль поставлен в очередь
+        """
+        if not self.is_stale(user):
+            return False
+        with self._lock:
+            self._pending.add(user.id_VK_user)
+        return True
+
+    def run(self):
+        """
+        Обновление пачки профилей: запрошенные ботом и устаревшие из БД
+        """
+        with self._lock:
+            user_ids = list(self._pending)[:self.batch_size]
+            self._pending.difference_update(user_ids)
+
+        with session_scope():
+            if len(user_ids) < self.batch_size:
+                refreshed_before = datetime.now() - timedelta(seconds=self.max_age)
+                stale = get_stale_users(refreshed_before, self.batch_size)
+                user_ids += [user_id for user_id in stale if user_id not in user_ids][:self.batch_size - len(user_ids)]
+            if not user_ids:
+                return
+            try:
+                self.refresh(user_ids)
+            except Exception:
+                # не обновлённые профили повторим при следующем запуске
+                with self._lock:
+                    self._pending.update(user_ids)
+                raise
+
+    def refresh(self, user_ids: list) -> int:
+        """
+        Обновление профилей одним запросом users.get
+
+        Returns:
+            Количество обновлённых профилей
+        """
+        profiles = self.vk.method('users.get', {'user_ids': ','.join(map(str, user_ids)),
+                                                'fields': 'city,sex,bdate'},
+                                  priority=Priority.BACKGROUND)
+        changes = []
+        for profile in profiles:
+            # удалённые и заблокированные страницы не обновляем
+            if profile.get('deactivated'):
+                continue
+            info = self.parse(profile)
+            changes.append({'id': info['id'], 'name': info['first_name'], 'surname': info['last_name'],
+                            'age': info['age'], 'gender': (None, Gender.VALUE_TWO, Gender.VALUE_ONE)[info['sex']],
+                            # parse подставляет город по умолчанию, скрытый город оставляем прежним
+                            'city': info['city'] if profile.get('city') else None})
+
+        # отмечаем и профили, которых не оказалось в ответе, чтобы не запрашивать их постоянно
+        updated = refresh_profiles(changes, user_ids)
+        metrics.incr('profiles.refreshed', updated)
+        logger.info(f"Обновлено профилей из VK: {updated} из {len(user_ids)}")
+        return updated
@@ -1,33 +1,96 @@
-from datetime import datetime
-from dotenv import load_dotenv
-import os, logging
+from datetime import datetime, timedelta
+import heapq
+import logging
+import os
+
+from models import Users, Interests, UsersInterest, BlackList, Favorites, Photos, Matches, MatchJobs, Gender, City, \
+    Session
+from sqlalchemy import select, insert, update, delete, exists, func, case, literal, and_, or_, TIMESTAMP
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import joinedload, make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.util import identity_key
+from scoring import InterestScorer
+from candidate_index import candidate_index
+from cache import cache
+
+# Максимум значений в одном IN (...)
+IN_CHUNK = 5000
+
+# Сколько лучших по лайкам фото пользователя хранится в БД
+PHOTOS_TOP_K = 3
+
+# Через сколько секунд зарезервированное, но не показанное совпадение возвращается в очередь
+# (процесс бота упал, не показав его); должно быть больше времени жизни буфера prefetch.py
+MATCH_RESERVATION_LEASE = float(os.getenv('MATCH_RESERVATION_LEASE', 3600))
+
+# Сессия текущего запроса (своя в каждом потоке), закрывается в models.session_scope()
+session = Session
 
-from sqlalchemy.testing.suite import PrecisionIntervalTest
+logger = logging.getLogger(__name__)
 
-from models import Users, Interests, UsersInterest, BlackList, Favorites, Photos, Matches, Gender, City
-from sqlalchemy import create_engine
-from sqlalchemy.orm import declarative_base, sessionmaker
 
-# Инициализация подключения к БД
-load_dotenv()
-Base = declarative_base()
-engine = create_engine(os.getenv('DB_URL'))
-SessionLocal = sessionmaker(bind=engine)
-session = SessionLocal()
+def _insert(model):
+    """
+    INSERT с поддержкой ON CONFLICT для диалекта текущей БД
+    :param model: модель
+    :return: конструкция insert
+    """
+    dialect = session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        return pg_insert(model)
+    if dialect == 'sqlite':
+        return sqlite_insert(model)
+    raise ValueError(f'INSERT ... ON CONFLICT не поддерживается для БД {dialect}: '
+                      f'поддерживаются PostgreSQL и SQLite')
 
-logger = logging.getLogger(__name__)
+
+def _user_snapshot(user_id: int):
+    """
+    Данные пользователя и его города для кэша (без привязки к сессии)
+    :param user_id: ID пользователя
+    :return: (значения колонок Users, значения колонок City или None) / None
+    """
+    user = session.get(Users, user_id, options=[joinedload(Users.city)])
+    if user is None:
+        return None
+    values = {attr.key: getattr(user, attr.key) for attr in Users.__mapper__.column_attrs}
+    city = {attr.key: getattr(user.city, attr.key) for attr in City.__mapper__.column_attrs} if user.city else None
+    return values, city
+
+
+def _user_from_snapshot(values: dict, city: dict = None):
+    """
+    Объект Users текущей сессии из данных кэша без запроса к БД
+    """
+    user = Users(**values)
+    make_transient_to_detached(user)
+    user = session.merge(user, load=False)
+    if city:
+        city = City(**city)
+        make_transient_to_detached(city)
+        set_committed_value(user, 'city', session.merge(city, load=False))
+    return user
+
+
+def _invalidate_user(user_id: int):
+    cache.invalidate('user', user_id)
 
 
 def get_user(user_id: int):
     """
-    Получение пользователя по ID
+    Получение пользователя по ID (через кэш)
     :param user_id: ID пользователя
     :return: Объект Users
     """
     try:
-        # user = session.query(Users).filter_by(id_VK_user=user_id).first()
-        user = session.get(Users, user_id)
-        return user
+        # пользователь, уже загруженный в текущей сессии, может содержать несохранённые изменения
+        user = session.identity_map.get(identity_key(Users, user_id))
+        if user is not None:
+            return user
+        snapshot = cache.get_or_load('user', user_id, lambda: _user_snapshot(user_id))
+        return _user_from_snapshot(*snapshot) if snapshot else None
     except Exception as e:
         logger.error(f'Ошибка при получении информации о пользователе: {e}')
         raise ValueError(f'Ошибка при получении информации о пользователе: {e}')
@@ -68,12 +131,59 @@ def create_new_user(user_id: int, name: str = None, surname: str = None,
                          gender=gender, id_city=city['id'])
         session.add(new_user)
         session.commit()
+        _invalidate_user(user_id)
+        candidate_index.add(user_id, city['id'], gender, age)
         return '✅ Создан новый пользователь.'
     except Exception as e:
         logger.error(f'Ошибка при сохранении пользователя: {e}')
         raise ValueError(f'Ошибка при сохранении пользователя: {e}')
 
 
+def onboard_user(user_id: int, name: str = None, surname: str = None,
+                 age: int = None, gender: Gender = None, city: dict = None, photos: list = None):
+    """
+    Регистрация пользователя одной транзакцией: город, пользователь и фото
+    сохраняются через INSERT ... ON CONFLICT, без предварительных проверок
+    :param user_id: ID пользователя
+    :param name: имя
+    :param surname: фамилия
+    :param age: возраст
+    :param gender: пол
+    :param city: город {'id': ID, 'title': название}
+    :param photos: фото [{'url', 'likes', 'attachment'}] (можно добавить позже через add_photos)
+    :return: Информация о регистрации пользователя
+    """
+    try:
+        id_city = None
+        if city:
+            id_city = city['id']
+            session.execute(_insert(City)
+                            .values(id_city=id_city, city_name=city['title'])
+                            .on_conflict_do_nothing())
+
+        now = datetime.now()
+        user_values = dict(name=name, surname=surname, age=age, gender=gender, id_city=id_city,
+                           updated_at=now, refreshed_at=now)
+        session.execute(_insert(Users)
+                        .values(id_VK_user=user_id, **user_values)
+                        .on_conflict_do_update(index_elements=[Users.id_VK_user], set_=user_values))
+
+        if photos:
+            _insert_new_photos(user_id, photos)
+
+        session.commit()
+        _invalidate_user(user_id)
+        if city:
+            cache.invalidate('city_id', city['title'])
+            cache.invalidate('city_name', id_city)
+        candidate_index.add(user_id, id_city, gender, age)
+        return '✅ Пользователь зарегистрирован.'
+    except Exception as e:
+        session.rollback()
+        logger.error(f'Ошибка при регистрации пользователя: {e}')
+        raise ValueError(f'Ошибка при регистрации пользователя: {e}')
+
+
 def update_user(user_id: int, name: str = None, surname: str = None,
                 age: int = None, gender: str = None, city: dict = None):
     """
@@ -96,19 +206,112 @@ def update_user(user_id: int, name: str = None, surname: str = None,
         if age: user.age = age
         if gender: user.gender = gender
         if city:
-            city_id = get_city(city_name=city['title'])
-            if not city:
+            if not get_city(city_name=city['title']):
                 add_city(id_city=city['id'], city_name=city['title'])
-            user.city = city
+            user.id_city = city['id']
 
         session.add(user)
         session.commit()
+        _invalidate_user(user_id)
+        candidate_index.add(user.id_VK_user, user.id_city, user.gender, user.age)
         return '✅ Данные о пользователе обновлены.'
     except Exception as e:
         logger.error(f'Ошибка при обновлении данных пользователя: {e}')
         raise ValueError(f'Ошибка при обновлении данных пользователя: {e}')
 
 
+def get_stale_users(refreshed_before: datetime, limit: int) -> list:
+    """
+    Пользователи, профиль которых давно не обновлялся из VK
+    :param refreshed_before: профили, полученные раньше этого момента, считаются устаревшими
+    :param limit: максимум пользователей
+    :return: список ID пользователей
+    """
+    try:
+        return session.scalars(select(Users.id_VK_user)
+                               .where(or_(Users.refreshed_at == None, Users.refreshed_at < refreshed_before))
+                               .limit(limit)).all()
+    except Exception as e:
+        logger.error(f'Ошибка при получении устаревших профилей: {e}')
+        raise ValueError(f'Ошибка при получении устаревших профилей: {e}')
+
+
+def mark_profiles_refreshed(user_ids: list, refreshed_at: datetime = None) -> int:
+    """
+    Отметка об обновлении профилей из VK одним запросом
+    :param user_ids: ID пользователей
+    :param refreshed_at: метка обновления (по умолчанию текущее время)
+    :return: количество отмеченных пользователей
+    """
+    try:
+        if not user_ids:
+            return 0
+        # updated_at не меняется: изменения профиля записывает update_user
+        count = session.execute(update(Users)
+                                .where(Users.id_VK_user.in_(user_ids))
+                                .values(refreshed_at=refreshed_at or datetime.now(), updated_at=Users.updated_at)
+                                .execution_options(synchronize_session=False)).rowcount
+        session.commit()
+        cache.invalidate('user', *user_ids)
+        return count
+    except Exception as e:
+        session.rollback()
+        logger.error(f'Ошибка при отметке обновления профилей: {e}')
+        raise ValueError(f'Ошибка при отметке обновления профилей: {e}')
+
+
+def refresh_profiles(profiles: list, user_ids: list, refreshed_at: datetime = None) -> int:
+    """
+    Запись профилей, полученных из VK, одной транзакцией: новые города, изменившиеся поля
+    пользователей и отметка об обновлении всех запрошенных профилей.
+    Пустые поля (например, город, скрытый в VK) сохранённые значения не затирают,
+    updated_at меняется только у пользователей с изменениями.
+    :param profiles: профили [{'id', 'name', 'surname', 'age', 'gender', 'city'}], city - {'id': ID, 'title': название}
+    :param user_ids: ID всех запрошенных пользователей (отмечаются и те, кого нет в ответе VK)
+    :param refreshed_at: метка обновления (по умолчанию текущее время)
+    :return: количество обновлённых пользователей
+    """
+    try:
+        cities = {profile['city']['id']: profile['city']['title'] for profile in profiles if profile.get('city')}
+        if cities:
+            session.execute(_insert(City)
+                            .values([dict(id_city=id_city, city_name=title) for id_city, title in cities.items()])
+                            .on_conflict_do_nothing())
+
+        users = {user.id_VK_user: user for user in
+                 session.query(Users).filter(Users.id_VK_user.in_([profile['id'] for profile in profiles]))}
+        for profile in profiles:
+            user = users.get(profile['id'])
+            if user is None:
+                continue
+            if profile.get('name'): user.name = profile['name']
+            if profile.get('surname'): user.surname = profile['surname']
+            if profile.get('age'): user.age = profile['age']
+            if profile.get('gender'): user.gender = profile['gender']
+            if profile.get('city'): user.id_city = profile['city']['id']
+        session.flush()
+
+        if user_ids:
+            # updated_at не меняется: его уже обновил flush у изменившихся пользователей
+            session.execute(update(Users)
+                            .where(Users.id_VK_user.in_(user_ids))
+                            .values(refreshed_at=refreshed_at or datetime.now(), updated_at=Users.updated_at)
+                            .execution_options(synchronize_session=False))
+        session.commit()
+
+        cache.invalidate('user', *set(user_ids) | set(users))
+        for id_city, title in cities.items():
+            cache.invalidate('city_id', title)
+            cache.invalidate('city_name', id_city)
+        for user in users.values():
+            candidate_index.add(user.id_VK_user, user.id_city, user.gender, user.age)
+        return len(users)
+    except Exception as e:
+        session.rollback()
+        logger.error(f'Ошибка при обновлении профилей: {e}')
+        raise ValueError(f'Ошибка при обновлении профилей: {e}')
+
+
 def get_favorites(user_id: int):
     """
     Получение избранных пользователей
@@ -125,6 +328,56 @@ def get_favorites(user_id: int):
         raise ValueError(f'Ошибка при получении списка избранных: {e}')
 
 
+def _list_page(model, target_column, user_id: int, after: int = None, limit: int = 20):
+    """
+    Страница списка (избранное/ЧС) с профилями одним запросом.
+    Постраничный вывод по курсору: следующая страница начинается после ID последней записи.
+    :param model: модель списка
+    :param target_column: колонка с ID пользователя из списка
+    :param user_id: ID пользователя бота
+    :param after: курсор - ID последней записи предыдущей страницы
+    :param limit: размер страницы
+    :return: (список (ID, имя, фамилия), курсор следующей страницы или None)
+    """
+    query = (session.query(target_column.label('id_VK_user'), Users.name, Users.surname)
+             # пользователи, не зарегистрированные в боте, возвращаются без имени
+             .outerjoin(Users, Users.id_VK_user == target_column)
+             .filter(model.id_VK_user == user_id))
+    if after is not None:
+        query = query.filter(target_column > after)
+    rows = query.order_by(target_column).limit(limit + 1).all()
+    if len(rows) > limit:
+        return rows[:limit], rows[limit - 1].id_VK_user
+    return rows, None
+
+
+def get_favorites_page(user_id: int, after: int = None, limit: int = 20):
+    """
+    Страница избранных пользователей с именами
+    :param user_id: ID пользователя бота
+    :param after: курсор - ID последнего пользователя предыдущей страницы
+    :param limit: размер страницы
+    :return: (список (ID, имя, фамилия), курсор следующей страницы или None)
+    """
+    try:
+        return _list_page(Favorites, Favorites.id_target, user_id, after, limit)
+    except Exception as e:
+        logger.error(f'Ошибка при получении списка избранных: {e}')
+        raise ValueError(f'Ошибка при получении списка избранных: {e}')
+
+
+def _insert_ignore(model, rows: list) -> int:
+    """
+    Добавление строк, уже существующие по первичному ключу пропускаются (без фиксации транзакции)
+    :param model: модель
+    :param rows: строки для добавления
+    :return: количество добавленных строк
+    """
+    if not rows:
+        return 0
+    return session.execute(_insert(model).values(rows).on_conflict_do_nothing()).rowcount
+
+
 def add_favorite(user_id: int, target_id: int):
     """
     Добавление пользователя в избранные
@@ -132,24 +385,37 @@ def add_favorite(user_id: int, target_id: int):
     :param target_id: ID избранного пользователя
     :return: информация о добавлении пользователя в избранные
     """
-    # проверяем наличие избранного в избранных
     try:
-        favorites = get_favorites(user_id)
-        if isinstance(favorites, list):
-            for i in favorites:
-                if target_id == i[0]:
-                    return '⚠️ Этот пользователь уже в избранном!'
-
-        # Добавление пользователя в избранные
-        new_favorite = Favorites(id_VK_user=user_id, id_target=target_id)
-        session.add(new_favorite)
+        # повторное добавление не нарушает первичный ключ, а просто не добавляет строку
+        added = _insert_ignore(Favorites, [dict(id_VK_user=user_id, id_target=target_id)])
         session.commit()
+        if not added:
+            return '⚠️ Этот пользователь уже в избранном!'
         return '✅ Пользователь добавлен в избранное!'
     except Exception as e:
+        session.rollback()
         logger.error(f'Ошибка при сохранении пользователя в список избранных: {e}')
         raise ValueError(f'Ошибка при сохранении пользователя в список избранных: {e}')
 
 
+def add_favorites(user_id: int, target_ids: list) -> int:
+    """
+    Добавление нескольких пользователей в избранные одним запросом
+    :param user_id: ID пользователя
+    :param target_ids: ID избранных пользователей
+    :return: количество добавленных (новых) записей
+    """
+    try:
+        added = _insert_ignore(Favorites, [dict(id_VK_user=user_id, id_target=target_id)
+                                           for target_id in dict.fromkeys(target_ids)])
+        session.commit()
+        return added
+    except Exception as e:
+        session.rollback()
+        logger.error(f'Ошибка при сохранении пользователей в список избранных: {e}')
+        raise ValueError(f'Ошибка при сохранении пользователей в список избранных: {e}')
+
+
 def get_blacklist(user_id: int):
     """
     Получение избранных пользователей
@@ -168,6 +434,21 @@ def get_blacklist(user_id: int):
         raise ValueError(f'Ошибка при получении чёрного списка: {e}')
 
 
+def get_blacklist_page(user_id: int, after: int = None, limit: int = 20):
+    """
+    Страница чёрного списка с именами
+    :param user_id: ID пользователя бота
+    :param after: курсор - ID последнего пользователя предыдущей страницы
+    :param limit: размер страницы
+    :return: (список (ID, имя, фамилия), курсор следующей страницы или None)
+    """
+    try:
+        return _list_page(BlackList, BlackList.id_blocked, user_id, after, limit)
+    except Exception as e:
+        logger.error(f'Ошибка при получении чёрного списка: {e}')
+        raise ValueError(f'Ошибка при получении чёрного списка: {e}')
+
+
 def add_blacklist(user_id: int, blocked_id: int):
     """
     Добавление пользователя в черный список
@@ -175,27 +456,40 @@ def add_blacklist(user_id: int, blocked_id: int):
     :param blocked_id: ID пользователя для блокировки
     :return: информация о добавлении пользователя в ЧС
     """
-    # проверяем наличие пользователя в чёрном списке
     try:
-        blacklist = get_blacklist(user_id)
-        if isinstance(blacklist, list):
-            for i in blacklist:
-                if blocked_id == i[0]:
-                    return '⚠️ Этот пользователь уже в черном списке!'
-
-        # Добавление пользователя в избранные
-        new_black_user = BlackList(id_VK_user=user_id, id_blocked=blocked_id)
-        session.add(new_black_user)
+        # повторное добавление не нарушает первичный ключ, а просто не добавляет строку
+        added = _insert_ignore(BlackList, [dict(id_VK_user=user_id, id_blocked=blocked_id)])
         session.commit()
+        if not added:
+            return '⚠️ Этот пользователь уже в черном списке!'
         return '✅ Пользователь добавлен в чёрный список!'
     except Exception as e:
+        session.rollback()
         logger.error(f'Ошибка при сохранении пользователя в чёрный список: {e}')
         raise ValueError(f'Ошибка при сохранении пользователя в чёрный список: {e}')
 
 
+def add_blacklists(user_id: int, blocked_ids: list) -> int:
+    """
+    Добавление нескольких пользователей в черный список одним запросом
+    :param user_id: ID пользователя
+    :param blocked_ids: ID пользователей для блокировки
+    :return: количество добавленных (новых) записей
+    """
+    try:
+        added = _insert_ignore(BlackList, [dict(id_VK_user=user_id, id_blocked=blocked_id)
+                                           for blocked_id in dict.fromkeys(blocked_ids)])
+        session.commit()
+        return added
+    except Exception as e:
+        session.rollback()
+        logger.error(f'Ошибка при сохранении пользователей в чёрный список: {e}')
+        raise ValueError(f'Ошибка при сохранении пользователей в чёрный список: {e}')
+
+
 def get_photo(user_id: int, count: int = 3):
     """
-    вызов фото из БД
+    вызов лучших по лайкам фото из БД
     :param user_id: ID пользователя
     :param count: количество записей
     :return: список объектов Photos
@@ -203,7 +497,7 @@ def get_photo(user_id: int, count: int = 3):
     try:
         photos = (session.query(Photos)
                   .filter_by(id_VK_user=user_id)
-                  .order_by(Photos.likes)
+                  .order_by(Photos.likes.desc())
                   .limit(count)
                   .all())
         return photos
@@ -232,6 +526,169 @@ def add_photo(user_id: int, url: str, likes: int, attachment: str, is_profile_ph
         raise ValueError(f'Ошибка при сохранении фото: {e}')
 
 
+def _insert_new_photos(user_id: int, photos: list):
+    """
+    Добавление фото пользователя, которых ещё нет в БД (без фиксации транзакции).
+    Хранятся только PHOTOS_TOP_K лучших по лайкам фото, остальные удаляются.
+    :param user_id: ID пользователя
+    :param photos: фото [{'url', 'likes', 'attachment'}]
+    :return: количество добавленных фото
+    """
+    photos = heapq.nlargest(PHOTOS_TOP_K, photos, key=lambda photo: photo['likes'] or 0)
+    stored = set(session.scalars(select(Photos.attachment).where(Photos.id_VK_user == user_id)))
+    rows = [dict(id_VK_user=user_id, url=photo['url'], likes=photo['likes'],
+                 attachment=photo['attachment'], is_profile_photo=photo.get('is_profile_photo', False))
+            for photo in photos if photo['attachment'] not in stored]
+    if rows:
+        session.execute(insert(Photos), rows)
+        if len(stored) + len(rows) > PHOTOS_TOP_K:
+            top = (select(Photos.id_user_photo).where(Photos.id_VK_user == user_id)
+                   .order_by(Photos.likes.desc(), Photos.id_user_photo).limit(PHOTOS_TOP_K))
+            session.execute(delete(Photos).where(Photos.id_VK_user == user_id,
+                                                 Photos.id_user_photo.not_in(top)))
+    return len(rows)
+
+
+def get_top_photos(user_ids: list, count: int = 3) -> dict:
+    """
+    Лучшие по лайкам фото нескольких пользователей одним запросом (оконная функция по индексу ix_photos_user_likes)
+    :param user_ids: ID пользователей
+    :param count: количество фото каждого пользователя
+    :return: словарь {ID пользователя: [attachment, ...]} по убыванию лайков
+    """
+    try:
+        attachments = {}
+        for start in range(0, len(user_ids), IN_CHUNK):
+            ranked = (select(Photos.id_VK_user, Photos.attachment,
+                             func.row_number().over(partition_by=Photos.id_VK_user,
+                                                    order_by=(Photos.likes.desc(), Photos.id_user_photo))
+                             .label('rank'))
+                      .where(Photos.id_VK_user.in_(user_ids[start:start + IN_CHUNK]))
+                      .subquery())
+            rows = session.execute(select(ranked.c.id_VK_user, ranked.c.attachment)
+                                   .where(ranked.c.rank <= count)
+                                   .order_by(ranked.c.id_VK_user, ranked.c.rank))
+            for user_id, attachment in rows:
+                attachments.setdefault(user_id, []).append(attachment)
+        return attachments
+    except Exception as e:
+        logger.error(f'Ошибка при получении фото: {e}')
+        raise ValueError(f'Ошибка при получении фото: {e}')
+
+
+def add_photos(user_id: int, photos: list):
+    """
+    Сохранение нескольких фото пользователя одной транзакцией
+    :param user_id: ID пользователя
+    :param photos: фото [{'url', 'likes', 'attachment'}]
+    :return: информация по добавлению фото
+    """
+    try:
+        count = _insert_new_photos(user_id, photos)
+        _mark_photos_refreshed([user_id])
+        session.commit()
+        cache.invalidate('user', user_id)
+        return f'✅ Добавлено фото: {count}'
+    except Exception as e:
+        session.rollback()
+        logger.error(f'Ошибка при сохранении фото: {e}')
+        raise ValueError(f'Ошибка при сохранении фото: {e}')
+
+
+def get_photo_refresh_queue(refreshed_before: datetime, limit: int) -> list:
+    """
+    Пользователи, фото которых давно не обновлялись, начиная с чаще всего показанных другим
+    :param refreshed_before: фото, полученные раньше этого момента, считаются устаревшими
+    :param limit: максимум пользователей
+    :return: список ID пользователей
+    """
+    try:
+        shown = (select(Matches.id_target_user, func.count().label('shown'))
+                 .where(Matches.match_shown.is_(True))
+                 .group_by(Matches.id_target_user)
+                 .subquery())
+        return session.scalars(select(Users.id_VK_user)
+                               .outerjoin(shown, shown.c.id_target_user == Users.id_VK_user)
+                               .where(or_(Users.photos_refreshed_at == None,
+                                          Users.photos_refreshed_at < refreshed_before))
+                               .order_by(func.coalesce(shown.c.shown, 0).desc(), Users.id_VK_user)
+                               .limit(limit)).all()
+    except Exception as e:
+        logger.error(f'Ошибка при получении очереди обновления фото: {e}')
+        raise ValueError(f'Ошибка при получении очереди обновления фото: {e}')
+
+
+def _mark_photos_refreshed(user_ids: list, refreshed_at: datetime = None) -> int:
+    """
+    Отметка об обновлении фото из VK (без фиксации транзакции)
+    """
+    return session.execute(update(Users)
+                           .where(Users.id_VK_user.in_(user_ids))
+                           .values(photos_refreshed_at=refreshed_at or datetime.now(), updated_at=Users.updated_at)
+                           .execution_options(synchronize_session=False)).rowcount
+
+
+def mark_photos_refreshed(user_ids: list, refreshed_at: datetime = None) -> int:
+    """
+    Отметка об обновлении фото из VK без изменения самих фото (например, закрытый профиль)
+    :param user_ids: ID пользователей
+    :param refreshed_at: метка обновления (по умолчанию текущее время)
+    :return: количество отмеченных пользователей
+    """
+    try:
+        if not user_ids:
+            return 0
+        count = _mark_photos_refreshed(user_ids, refreshed_at)
+        session.commit()
+        cache.invalidate('user', *user_ids)
+        return count
+    except Exception as e:
+        session.rollback()
+        logger.error(f'Ошибка при отметке обновления фото: {e}')
+        raise ValueError(f'Ошибка при отметке обновления фото: {e}')
+
+
+def sync_photos(user_id: int, photos: list) -> tuple:
+    """
+    Синхронизация сохранённых фото пользователя с полученными из VK: изменяются только
+    отличающиеся строки (новые добавляются, изменившиеся обновляются одним запросом,
+    выпавшие из PHOTOS_TOP_K лучших удаляются), затем ставится отметка об обновлении
+    :param user_id: ID пользователя
+    :param photos: фото из VK [{'url', 'likes', 'attachment'}]
+    :return: (добавлено, обновлено, удалено)
+    """
+    try:
+        top = {photo['attachment']: photo
+               for photo in heapq.nlargest(PHOTOS_TOP_K, photos, key=lambda photo: photo['likes'] or 0)}
+        stored = {row.attachment: row for row in
+                  session.execute(select(Photos.id_user_photo, Photos.attachment, Photos.url, Photos.likes)
+                                  .where(Photos.id_VK_user == user_id))}
+
+        added = [dict(id_VK_user=user_id, url=photo['url'], likes=photo['likes'], attachment=attachment,
+                      is_profile_photo=photo.get('is_profile_photo', False))
+                 for attachment, photo in top.items() if attachment not in stored]
+        changed = [dict(id_user_photo=stored[attachment].id_user_photo, url=photo['url'], likes=photo['likes'])
+                   for attachment, photo in top.items()
+                   if attachment in stored and (stored[attachment].url, stored[attachment].likes) !=
+                   (photo['url'], photo['likes'])]
+        removed = [row.id_user_photo for attachment, row in stored.items() if attachment not in top]
+
+        if added:
+            session.execute(insert(Photos), added)
+        if changed:
+            session.execute(update(Photos), changed)
+        if removed:
+            session.execute(delete(Photos).where(Photos.id_user_photo.in_(removed)))
+        _mark_photos_refreshed([user_id])
+        session.commit()
+        cache.invalidate('user', user_id)
+        return len(added), len(changed), len(removed)
+    except Exception as e:
+        session.rollback()
+        logger.error(f'Ошибка при обновлении фото: {e}')
+        raise ValueError(f'Ошибка при обновлении фото: {e}')
+
+
 def get_match(user_id: int):
     """
     вызов совпадения из БД
@@ -239,20 +696,157 @@ def get_match(user_id: int):
     :return: совпадение
     """
     try:
-        match = (session.query(Matches)
-                 .filter(Matches.id_VK_user == user_id, Matches.match_shown == None)
-                 .first())
-        if match:
-            match.match_shown = True
-            session.add(match)
-            session.commit()
-            return match
+        matches = claim_matches(user_id, 1)
+        if matches:
+            return matches[0]
         return '😔 Никого не нашлось.'
     except Exception as e:
         logger.error(f'Ошибка при получении совпадений: {e}')
         raise ValueError(f'Ошибка при получении совпадений: {e}')
 
 
+def claim_matches(user_id: int, limit: int = 1, shown: bool = True, lease: float = None):
+    """
+    Атомарный захват непоказанных совпадений одним запросом
+    UPDATE ... WHERE id_match IN (SELECT ... FOR UPDATE SKIP LOCKED) RETURNING:
+    параллельные обработчики получают разные совпадения и не ждут друг друга.
+    Пользователи из ЧС пропускаются. Совпадения, зарезервированные дольше lease секунд назад,
+    сначала возвращаются в очередь (как задания worker.py после MATCH_JOB_LEASE).
+    :param user_id: ID пользователя
+    :param limit: количество совпадений
+    :param shown: новое значение match_shown (True - показано, False - зарезервировано для показа)
+    :param lease: срок резервирования, сек (по умолчанию MATCH_RESERVATION_LEASE)
+    :return: список совпадений (id_match, id_target_user, matched_at, score), лучшие первыми
+    """
+    try:
+        now = datetime.now()
+        expired = now - timedelta(seconds=MATCH_RESERVATION_LEASE if lease is None else lease)
+        session.execute(update(Matches)
+                        .where(Matches.id_VK_user == user_id,
+                               Matches.match_shown == False,
+                               Matches.reserved_at < expired)
+                        .values(match_shown=None, reserved_at=None)
+                        .execution_options(synchronize_session=False))
+
+        pending = (select(Matches.id_match)
+                   .where(Matches.id_VK_user == user_id,
+                          Matches.match_shown == None,
+                          ~exists().where(BlackList.id_VK_user == user_id,
+                                          BlackList.id_blocked == Matches.id_target_user))
+                   .order_by(Matches.score.desc(), Matches.matched_at, Matches.id_match)
+                   .limit(limit)
+                   .with_for_update(skip_locked=True))
+        matches = session.execute(update(Matches)
+                                  .where(Matches.id_match.in_(pending))
+                                  .values(match_shown=shown, reserved_at=None if shown else now)
+                                  .returning(Matches.id_match, Matches.id_target_user, Matches.matched_at,
+                                             Matches.score)
+                                  .execution_options(synchronize_session=False)).all()
+        session.commit()
+        # RETURNING не гарантирует порядок строк
+        return sorted(matches, key=lambda match: (-match.score, match.matched_at, match.id_match))
+    except Exception as e:
+        session.rollback()
+        logger.error(f'Ошибка при захвате совпадений: {e}')
+        raise ValueError(f'Ошибка при захвате совпадений: {e}')
+
+
+def claim_prepared_matches(user_id: int, limit: int, photos_count: int = 3):
+    """
+    Резервирование совпадений для показа вместе с профилями и фото предлагаемых пользователей
+    (три запроса независимо от количества совпадений). Совпадения с пользователями,
+    которых нет в таблице users, показать нельзя - они отмечаются показанными.
+    :param user_id: ID пользователя
+    :param limit: количество совпадений
+    :param photos_count: количество фото каждого пользователя
+    :return: список словарей id_match, id_VK_user, name, surname, age, city_name, attachments
+    """
+    try:
+        matches = claim_matches(user_id, limit, shown=False)
+        if not matches:
+            return []
+
+        target_ids = [match.id_target_user for match in matches]
+        profiles = {row.id_VK_user: row for row in
+                    session.query(Users.id_VK_user, Users.name, Users.surname, Users.age, City.city_name)
+                    .outerjoin(City, City.id_city == Users.id_city)
+                    .filter(Users.id_VK_user.in_(target_ids))}
+
+        missing = [match.id_match for match in matches if match.id_target_user not in profiles]
+        if missing:
+            mark_matches_shown(missing)
+
+        # фото всех пользователей одним запросом, лучшие по лайкам
+        attachments = get_top_photos(target_ids, photos_count)
+
+        return [dict(profiles[match.id_target_user]._mapping, id_match=match.id_match,
+                     attachments=attachments.get(match.id_target_user, []))
+                for match in matches if match.id_target_user in profiles]
+    except Exception as e:
+        logger.error(f'Ошибка при получении совпадений: {e}')
+        raise ValueError(f'Ошибка при получении совпадений: {e}')
+
+
+def release_matches(match_ids: list):
+    """
+    Возврат зарезервированных, но не показанных совпадений в очередь
+    :param match_ids: ID совпадений
+    :return: количество возвращенных совпадений
+    """
+    try:
+        if not match_ids:
+            return 0
+        count = (session.query(Matches)
+                 .filter(Matches.id_match.in_(match_ids), Matches.match_shown == False)
+                 .update({Matches.match_shown: None, Matches.reserved_at: None}, synchronize_session=False))
+        session.commit()
+        return count
+    except Exception as e:
+        session.rollback()
+        logger.error(f'Ошибка при возврате совпадений: {e}')
+        raise ValueError(f'Ошибка при возврате совпадений: {e}')
+
+
+def mark_matches_shown(match_ids: list):
+    """
+    Отметка совпадений как показанных одним запросом
+    :param match_ids: ID совпадений
+    :return: количество отмеченных совпадений
+    """
+    try:
+        if not match_ids:
+            return 0
+        count = (session.query(Matches)
+                 .filter(Matches.id_match.in_(match_ids))
+                 .update({Matches.match_shown: True, Matches.reserved_at: None}, synchronize_session=False))
+        session.commit()
+        return count
+    except Exception as e:
+        session.rollback()
+        logger.error(f'Ошибка при отметке показанных совпадений: {e}')
+        raise ValueError(f'Ошибка при отметке показанных совпадений: {e}')
+
+
+def sweep_blacklisted_matches():
+    """
+    Удаление непоказанных совпадений с пользователями, добавленными в ЧС после поиска,
+    чтобы они не занимали место в очереди и буфере показа
+    :return: количество удалённых совпадений
+    """
+    try:
+        count = session.execute(delete(Matches)
+                                .where(Matches.match_shown == None,
+                                       exists().where(BlackList.id_VK_user == Matches.id_VK_user,
+                                                      BlackList.id_blocked == Matches.id_target_user))
+                                .execution_options(synchronize_session=False)).rowcount
+        session.commit()
+        return count
+    except Exception as e:
+        session.rollback()
+        logger.error(f'Ошибка при удалении совпадений из чёрного списка: {e}')
+        raise ValueError(f'Ошибка при удалении совпадений из чёрного списка: {e}')
+
+
 def add_match(user_id: int, target_id: int, matched_at: datetime = None,
               match_shown: bool = False):
     """
@@ -278,25 +872,24 @@ def add_match(user_id: int, target_id: int, matched_at: datetime = None,
 
 def get_interest(id_interest: int = None, interest_name: str = None):
     """
-    Вызов названия/ID интереса
+    Вызов названия/ID интереса (через кэш)
     :param id_interest: ID интереса
     :param interest_name: название интереса
     :return: интерес
     """
     try:
         if id_interest:
-            # interest = (session.query(Interests.interest_name)
-            #             .filter_by(id_interest=id_interest)
-            #             .first())
-            interest = session.get(Interests.interest_name, id_interest)
+            interest = cache.get_or_load('interest_name', id_interest,
+                                         lambda: session.query(Interests.interest_name)
+                                         .filter_by(id_interest=id_interest).scalar())
             if interest:
-                return interest[0]
+                return interest
             return '😔 Интереса по ID не нашлось.'
-        interest = (session.query(Interests.id_interest)
-                    .filter_by(interest_name=interest_name)
-                    .first())
+        interest = cache.get_or_load('interest_id', interest_name,
+                                     lambda: session.query(Interests.id_interest)
+                                     .filter_by(interest_name=interest_name).scalar())
         if interest:
-            return interest[0]
+            return interest
         return '😔 Интереса по имени не нашлось.'
     except Exception as e:
         logger.error(f'Ошибка при получении интереса: {e}')
@@ -315,6 +908,7 @@ def add_interest(interest_name: str):
         new_interest = Interests(interest_name=interest_name)
         session.add(new_interest)
         session.commit()
+        cache.invalidate('interest_id', interest_name)
         return '✅ Интерес успешно добавлен в БД'
     except Exception as e:
         logger.error(f'Ошибка при сохранении интереса: {e}')
@@ -323,18 +917,17 @@ def add_interest(interest_name: str):
 
 def get_user_interest(user_id: int):
     """
-    Вызов интересов пользователя
+    Вызов интересов пользователя (через кэш)
     :param user_id: ID пользователя
     :return: интерес пользователя
     """
     try:
-        interests = (session.query(Interests.interest_name)
-                     .join(UsersInterest).
-                     filter(UsersInterest.id_VK_user == user_id).
-                     all())
+        interests = cache.get_or_load('user_interests', user_id,
+                                      lambda: tuple(name for name, in session.query(Interests.interest_name)
+                                                    .join(UsersInterest)
+                                                    .filter(UsersInterest.id_VK_user == user_id)))
         if interests:
-            interests_list = [i[0] for i in interests]
-            return interests_list
+            return list(interests)
         return '😔 У данного пользователя интересов не нашлось.'
     except Exception as e:
         logger.error(f'Ошибка при получении интересов пользователя: {e}')
@@ -368,16 +961,91 @@ def add_user_interest(user_id: int, id_interest: int = None,
             return '⚠️ Данный интерес уже добавлен пользователю в БД'
         new_interest = UsersInterest(id_VK_user=user_id, id_interest=id_interest)
         session.add(new_interest)
+        # новые интересы меняют оценки совпадений - пользователь попадёт в инкрементальный поиск
+        session.execute(update(Users).where(Users.id_VK_user == user_id).values(updated_at=datetime.now())
+                        .execution_options(synchronize_session='evaluate'))
         session.commit()
+        _invalidate_user(user_id)
+        cache.invalidate('user_interests', user_id)
         return '✅ Интерес пользователя успешно добавлен в БД'
     except Exception as e:
         logger.error(f'Ошибка при сохранении интересов пользователя: {e}')
         raise ValueError(f'Ошибка при сохранении интереса пользователя: {e}')
 
 
+def _db_candidates(user_id: int, id_city: int, gender: Gender, age_from: int, age_to: int,
+                   since: datetime = None):
+    """
+    Кандидаты для find_match из БД
+    :param since: только пользователи, изменившиеся после этого момента (инкрементальный поиск)
+    :return: (список (ID кандидата, совпадение уже найдено), строки (ID пользователя, ID интереса))
+    """
+    # Кандидаты без учёта интересов, кроме пользователей из ЧС и уже добавленных в избранное
+    blocked = exists().where(BlackList.id_VK_user == user_id, BlackList.id_blocked == Users.id_VK_user)
+    favorite = exists().where(Favorites.id_VK_user == user_id, Favorites.id_target == Users.id_VK_user)
+    candidate_filter = and_(Users.gender == gender,
+                            Users.age >= age_from,
+                            Users.age <= age_to,
+                            Users.id_city == id_city,
+                            ~blocked,
+                            ~favorite)
+    if since is not None:
+        candidate_filter = and_(candidate_filter, Users.updated_at > since)
+
+    # Кандидаты с отметкой "совпадение уже найдено"
+    already_matched = (exists()
+                       .where(Matches.id_VK_user == user_id,
+                              Matches.id_target_user == Users.id_VK_user))
+    candidates = session.execute(select(Users.id_VK_user, already_matched.label('matched'))
+                                 .where(candidate_filter)).all()
+    if not candidates:
+        return [], []
+
+    # Интересы пользователя и всех кандидатов одним запросом
+    candidate_ids = select(Users.id_VK_user).where(candidate_filter)
+    interest_rows = session.execute(
+        select(UsersInterest.id_VK_user, UsersInterest.id_interest)
+        .where(or_(UsersInterest.id_VK_user == user_id, UsersInterest.id_VK_user.in_(candidate_ids)))
+    ).all()
+    return [tuple(candidate) for candidate in candidates], interest_rows
+
+
+def _indexed_candidates(user_id: int, target_ids: list):
+    """
+    Кандидаты для find_match из индекса в памяти: из БД читаются только списки
+    пользователя (ЧС, избранное, найденные совпадения) и интересы кандидатов
+    :param target_ids: ID кандидатов из candidate_index
+    :return: (список (ID кандидата, совпадение уже найдено), строки (ID пользователя, ID интереса))
+    """
+    excluded = set(session.scalars(
+        select(BlackList.id_blocked).where(BlackList.id_VK_user == user_id)
+        .union(select(Favorites.id_target).where(Favorites.id_VK_user == user_id))
+    ))
+    excluded.add(user_id)
+    candidates = [target_id for target_id in target_ids if target_id not in excluded]
+    if not candidates:
+        return [], []
+    matched = set(session.scalars(select(Matches.id_target_user).where(Matches.id_VK_user == user_id)))
+
+    interest_rows = session.execute(select(UsersInterest.id_VK_user, UsersInterest.id_interest)
+                                    .where(UsersInterest.id_VK_user == user_id)).all()
+    for start in range(0, len(candidates), IN_CHUNK):
+        interest_rows += session.execute(
+            select(UsersInterest.id_VK_user, UsersInterest.id_interest)
+            .where(UsersInterest.id_VK_user.in_(candidates[start:start + IN_CHUNK]))
+        ).all()
+    return [(target_id, target_id in matched) for target_id in candidates], interest_rows
+
+
 def find_match(user_id: int):
     """
     Поиск совпадений по базе данных
+    Повторный поиск инкрементальный: рассматриваются только пользователи, изменившиеся
+    после прошлого поиска (last_search_at). Полный поиск берёт кандидатов из индекса в памяти
+    (candidate_index.py), а пока он не построен - из БД, в обоих случаях без пользователей из ЧС и избранного,
+    оценка по общим интересам (scoring.py) - за один проход по кандидатам,
+    новые совпадения сохраняются одним пакетным INSERT вместе с оценкой,
+    поэтому количество запросов не зависит от количества кандидатов.
     :param user_id: ID пользователя
     :return: None / информацию об отсутствии совпадений
     """
@@ -387,68 +1055,322 @@ def find_match(user_id: int):
         if not user:
             return '😔 Не удалось получить информацию о вашем профиле'
 
-        # получаем информацию об интересах пользователя
-        user_interests = get_user_interest(user_id)
-
         # Определяем параметры поиска
-        search_sex = (Gender.VALUE_TWO, Gender.VALUE_ONE)[user.gender == Gender.VALUE_TWO]
+        search_sex = _search_gender(user.gender)
         age_from = max(18, user.age - 5) if user.age else 18
         age_to = min(80, user.age + 5) if user.age else 35
-        city = user.city
-
-        # Поиск пользователей без учёта интересов
-        found_users = session.query(Users).filter(Users.gender == search_sex,
-                                                  Users.age >= age_from,
-                                                  Users.age <= age_to,
-                                                  Users.city == city).all()
-        if not found_users:
-            return '😔 Никого не нашлось. Попробуйте позже'
-
-        # Составляем список из найденных пользователей со схожими интересами
-        if '😔' in user_interests:
-            interest_users = found_users
+
+        # После прошлого поиска новые совпадения могут дать только пользователи, изменившиеся позже него.
+        # Если изменился профиль или интересы самого пользователя - полный поиск
+        search_started = datetime.now()
+        since = user.last_search_at
+        if since is not None and user.updated_at is not None and user.updated_at > since:
+            since = None
+
+        if since is not None:
+            candidates, interest_rows = _db_candidates(user_id, user.id_city, search_sex, age_from, age_to, since)
         else:
-            interest_users = []
-            for found_user in found_users:
-                for found_user_interest in get_user_interest(found_user.id_VK_user):
-                    if found_user_interest in user_interests:
-                        interest_users.append(found_user)
-                        break
-        if not interest_users:
-            return '😔 С Вашими интересами никого не нашлось. Попробуйте позже'
-
-        # Сохраняем результат в БД
-        for found_user in interest_users:  # Можно сохранить пользователей без учёта интересов заменив interest_users на found_users
-            # проверяем наличие аналогичных записей, сделанных ранее
-
-            match = session.query(Matches).filter(Matches.id_VK_user == user_id,
-                                                  Matches.id_target_user == found_user.id_VK_user).first()
-            if not match:
-                add_match(user_id, found_user.id_VK_user, datetime.now(), False)
+            indexed = candidate_index.range(user.id_city, search_sex, age_from, age_to)
+            if indexed is None:
+                candidates, interest_rows = _db_candidates(user_id, user.id_city, search_sex, age_from, age_to)
+            else:
+                candidates, interest_rows = _indexed_candidates(user_id, indexed)
+        if not candidates:
+            _mark_searched(user_id, search_started)
+            # при инкрементальном поиске очередь совпадений остаётся прежней
+            return None if since is not None else '😔 Никого не нашлось. Попробуйте позже'
+
+        # Оценка всех кандидатов за один проход
+        scorer = InterestScorer(interest_rows)
+        scores = scorer.score_many(user_id, [target_id for target_id, _ in candidates])
+
+        # Без интересов у пользователя подходят все найденные кандидаты,
+        # иначе - только с хотя бы одним общим интересом
+        has_interests = scorer.has_interests(user_id)
+        if has_interests and not any(scores.values()):
+            _mark_searched(user_id, search_started)
+            return None if since is not None else '😔 С Вашими интересами никого не нашлось. Попробуйте позже'
+
+        # Сохраняем результат в БД с оценкой, пропуская совпадения, сделанные ранее
+        matched_at = datetime.now()
+        new_matches = [dict(id_VK_user=user_id, id_target_user=target_id, matched_at=matched_at,
+                            score=scores[target_id])
+                       for target_id, matched in candidates
+                       if not matched and (scores[target_id] or not has_interests)]
+        if new_matches:
+            session.execute(insert(Matches), new_matches)
+        _mark_searched(user_id, search_started)
 
         # Возвращаем первое совпадение
         # return get_match(user_id)
     except Exception as e:
+        session.rollback()
         logger.error(f'Ошибка при поиске совпадений: {e}')
         raise ValueError(f'Ошибка при поиске совпадений: {e}')
 
 
+def _search_gender(gender: Gender) -> Gender:
+    """
+    Пол кандидатов для пользователя с полом gender
+    """
+    return (Gender.VALUE_TWO, Gender.VALUE_ONE)[gender == Gender.VALUE_TWO]
+
+
+def _mark_searched(user_id: int, searched_at: datetime):
+    """
+    Сохранение метки поиска совпадений и фиксация транзакции
+    :param user_id: ID пользователя
+    :param searched_at: время начала поиска (изменения после него попадут в следующий поиск)
+    """
+    # updated_at не меняется: метка поиска не является изменением профиля
+    session.execute(update(Users)
+                    .where(Users.id_VK_user == user_id)
+                    .values(last_search_at=searched_at, updated_at=Users.updated_at)
+                    .execution_options(synchronize_session='evaluate'))
+    session.commit()
+    _invalidate_user(user_id)
+
+
+def push_new_user_matches(user_id: int) -> int:
+    """
+    Добавление нового пользователя в очереди совпадений пользователей, которым он подходит
+    (обратные критерии find_match), без повторного поиска с их стороны.
+    Учитываются только пользователи, уже выполнявшие поиск.
+    :param user_id: ID нового пользователя
+    :return: количество добавленных совпадений
+    """
+    try:
+        user = get_user(user_id)
+        if not user or user.age is None or user.gender is None or user.id_city is None:
+            return 0
+        if not 18 <= user.age <= 80:
+            return 0
+
+        # пользователь ищет кандидатов с возрастом +-5 лет (без возраста или с нулевым - от 18 до 35, как в find_match)
+        age_filter = Users.age.between(user.age - 5, user.age + 5)
+        if user.age <= 35:
+            age_filter = or_(age_filter, Users.age.is_(None), Users.age == 0)
+        if user.gender == Gender.VALUE_ONE:
+            gender_filter = Users.gender == Gender.VALUE_TWO
+        else:
+            gender_filter = or_(Users.gender != Gender.VALUE_TWO, Users.gender.is_(None))
+
+        owners_filter = and_(Users.id_city == user.id_city,
+                             gender_filter,
+                             age_filter,
+                             Users.last_search_at.is_not(None),
+                             Users.id_VK_user != user_id,
+                             ~exists().where(BlackList.id_VK_user == Users.id_VK_user,
+                                             BlackList.id_blocked == user_id),
+                             ~exists().where(Favorites.id_VK_user == Users.id_VK_user,
+                                             Favorites.id_target == user_id),
+                             ~exists().where(Matches.id_VK_user == Users.id_VK_user,
+                                             Matches.id_target_user == user_id))
+        owners = session.scalars(select(Users.id_VK_user).where(owners_filter)).all()
+        if not owners:
+            return 0
+
+        # оценка симметрична: интересы нового пользователя сравниваются с интересами каждого
+        scorer = InterestScorer(session.execute(
+            select(UsersInterest.id_VK_user, UsersInterest.id_interest)
+            .where(or_(UsersInterest.id_VK_user == user_id,
+                       UsersInterest.id_VK_user.in_(select(Users.id_VK_user).where(owners_filter))))
+        ).all())
+        scores = scorer.score_many(user_id, owners)
+
+        matched_at = datetime.now()
+        new_matches = [dict(id_VK_user=owner_id, id_target_user=user_id, matched_at=matched_at,
+                            score=scores[owner_id])
+                       for owner_id in owners
+                       if scores[owner_id] or not scorer.has_interests(owner_id)]
+        if new_matches:
+            session.execute(insert(Matches), new_matches)
+        session.commit()
+        return len(new_matches)
+    except Exception as e:
+        session.rollback()
+        logger.error(f'Ошибка при добавлении нового пользователя в совпадения: {e}')
+        raise ValueError(f'Ошибка при добавлении нового пользователя в совпадения: {e}')
+
+
+def has_pending_matches(user_id: int) -> bool:
+    """
+    Есть ли у пользователя непоказанные совпадения в очереди
+    :param user_id: ID пользователя
+    :return: True / False
+    """
+    try:
+        return session.query(exists().where(Matches.id_VK_user == user_id, Matches.match_shown == None)).scalar()
+    except Exception as e:
+        logger.error(f'Ошибка при проверке очереди совпадений: {e}')
+        raise ValueError(f'Ошибка при проверке очереди совпадений: {e}')
+
+
+def _enqueue_jobs(stmt, now: datetime) -> int:
+    """
+    Постановка заданий поиска совпадений: новое задание попадает в очередь,
+    выполняемое - будет выполнено повторно после завершения (requested_at > started_at),
+    завершившееся ошибкой - возвращается в очередь
+    """
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[MatchJobs.id_VK_user],
+        set_=dict(requested_at=now,
+                  status=case((MatchJobs.status == 'running', MatchJobs.status), else_='queued'),
+                  attempts=case((MatchJobs.status == 'running', MatchJobs.attempts), else_=0))
+    )
+    count = session.execute(stmt).rowcount
+    session.commit()
+    return count
+
+
+def enqueue_match_jobs(user_ids: list) -> int:
+    """
+    Постановка в очередь заданий поиска совпадений для пользователей (выполняет worker.py)
+    :param user_ids: ID пользователей
+    :return: количество поставленных заданий
+    """
+    try:
+        if not user_ids:
+            return 0
+        now = datetime.now()
+        return _enqueue_jobs(_insert(MatchJobs).values([dict(id_VK_user=user_id, status='queued', requested_at=now,
+                                                             attempts=0)
+                                                        for user_id in dict.fromkeys(user_ids)]), now)
+    except Exception as e:
+        session.rollback()
+        logger.error(f'Ошибка при постановке заданий поиска совпадений: {e}')
+        raise ValueError(f'Ошибка при постановке заданий поиска совпадений: {e}')
+
+
+def enqueue_active_match_jobs(active_since: datetime) -> int:
+    """
+    Постановка в очередь заданий для всех пользователей, искавших совпадения после active_since
+    (одним INSERT ... SELECT)
+    :param active_since: начало периода активности
+    :return: количество поставленных заданий
+    """
+    try:
+        now = datetime.now()
+        active = select(Users.id_VK_user, literal('queued'), literal(now, TIMESTAMP), literal(0)) \
+            .where(Users.last_search_at >= active_since)
+        return _enqueue_jobs(_insert(MatchJobs).from_select(['id_VK_user', 'status', 'requested_at', 'attempts'],
+                                                            active), now)
+    except Exception as e:
+        session.rollback()
+        logger.error(f'Ошибка при постановке заданий поиска совпадений: {e}')
+        raise ValueError(f'Ошибка при постановке заданий поиска совпадений: {e}')
+
+
+def claim_match_jobs(limit: int, lease: float) -> list:
+    """
+    Атомарный захват заданий поиска совпадений (UPDATE ... FOR UPDATE SKIP LOCKED RETURNING),
+    несколько обработчиков получают разные задания. Задания, захваченные дольше lease секунд назад
+    (обработчик упал), захватываются повторно.
+    :param limit: количество заданий
+    :param lease: время, на которое захватывается задание, сек
+    :return: список (id_VK_user, started_at, attempts)
+    """
+    try:
+        now = datetime.now()
+        ready = (select(MatchJobs.id_VK_user)
+                 .where(or_(MatchJobs.status == 'queued',
+                            and_(MatchJobs.status == 'running', MatchJobs.started_at < now - timedelta(seconds=lease))))
+                 .order_by(MatchJobs.requested_at)
+                 .limit(limit)
+                 .with_for_update(skip_locked=True))
+        jobs = session.execute(update(MatchJobs)
+                               .where(MatchJobs.id_VK_user.in_(ready))
+                               .values(status='running', started_at=now, attempts=MatchJobs.attempts + 1)
+                               .returning(MatchJobs.id_VK_user, MatchJobs.started_at, MatchJobs.attempts)
+                               .execution_options(synchronize_session=False)).all()
+        session.commit()
+        return jobs
+    except Exception as e:
+        session.rollback()
+        logger.error(f'Ошибка при захвате заданий поиска совпадений: {e}')
+        raise ValueError(f'Ошибка при захвате заданий поиска совпадений: {e}')
+
+
+def finish_match_job(user_id: int, started_at: datetime, error: str = None, max_attempts: int = 3):
+    """
+    Завершение задания поиска совпадений
+    :param user_id: ID пользователя
+    :param started_at: метка захвата задания (задание, захваченное заново после истечения, не трогается)
+    :param error: текст ошибки, если задание не выполнено
+    :param max_attempts: после стольких неудачных попыток задание помечается failed
+    """
+    try:
+        own_job = and_(MatchJobs.id_VK_user == user_id, MatchJobs.status == 'running',
+                       MatchJobs.started_at == started_at)
+        if error is None:
+            # задание, поставленное повторно во время выполнения, остаётся в очереди
+            done = session.execute(delete(MatchJobs).where(own_job, MatchJobs.requested_at <= started_at)).rowcount
+            if not done:
+                session.execute(update(MatchJobs).where(own_job).values(status='queued', attempts=0)
+                                .execution_options(synchronize_session=False))
+        else:
+            session.execute(update(MatchJobs)
+                            .where(own_job)
+                            .values(status=case((MatchJobs.attempts >= max_attempts, 'failed'), else_='queued'),
+                                    requested_at=datetime.now(), error=error)
+                            .execution_options(synchronize_session=False))
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        logger.error(f'Ошибка при завершении задания поиска совпадений: {e}')
+        raise ValueError(f'Ошибка при завершении задания поиска совпадений: {e}')
+
+
+def release_match_jobs(jobs: list):
+    """
+    Возврат захваченных, но не выполненных заданий в очередь (при остановке обработчика)
+    :param jobs: список (id_VK_user, started_at)
+    """
+    try:
+        for user_id, started_at in jobs:
+            session.execute(update(MatchJobs)
+                            .where(MatchJobs.id_VK_user == user_id, MatchJobs.status == 'running',
+                                   MatchJobs.started_at == started_at)
+                            .values(status='queued', attempts=MatchJobs.attempts - 1)
+                            .execution_options(synchronize_session=False))
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        logger.error(f'Ошибка при возврате заданий поиска совпадений: {e}')
+        raise ValueError(f'Ошибка при возврате заданий поиска совпадений: {e}')
+
+
+def match_job_stats() -> dict:
+    """
+    Количество заданий поиска совпадений по статусам
+    :return: словарь {статус: количество}
+    """
+    try:
+        counts = dict.fromkeys(('queued', 'running', 'failed'), 0)
+        counts.update(session.execute(select(MatchJobs.status, func.count()).group_by(MatchJobs.status)).all())
+        return counts
+    except Exception as e:
+        logger.error(f'Ошибка при получении статистики заданий: {e}')
+        raise ValueError(f'Ошибка при получении статистики заданий: {e}')
+
+
 def get_city(id_city: int = None, city_name: str = None) -> str:
     """
-    Получение названия города по id
+    Получение названия города по id (через кэш)
     :param id_city: ID города
     :param city_name: название города
     :return: противоположный передаваемому параметр города
     """
     try:
         if id_city:
-            # city_name = session.get(City.city_name, id_city)
-            city_name = session.query(City.id_city).filter_by(id_city=id_city).first()
-            if city_name:
-                return city_name[0]
-        id_city = session.query(City.id_city).filter_by(city_name=city_name).first()
-        if id_city:
-            return id_city[0]
+            name = cache.get_or_load('city_name', id_city,
+                                     lambda: session.query(City.city_name).filter_by(id_city=id_city).scalar())
+            if name:
+                return name
+        if city_name is None:
+            return None
+        return cache.get_or_load('city_id', city_name,
+                                 lambda: session.query(City.id_city).filter_by(city_name=city_name).scalar())
 
     except Exception as e:
         logger.error(f'Ошибка при получении города: {e}')
@@ -471,6 +1393,8 @@ def add_city(id_city: int, city_name: str):
             new_city = City(city_name=city_name)
         session.add(new_city)
         session.commit()
+        cache.invalidate('city_id', city_name)
+        cache.invalidate('city_name', new_city.id_city)
         return '✅ Город успешно добавлен в БД'
     except Exception as e:
         logger.error(f'Ошибка при сохранении города: {e}')
@@ -0,0 +1,106 @@
+import math
+import os
+from typing import Dict, Iterable, List, Tuple
+
+# Способ оценки совпадений: jaccard - доля общих интересов,
+# idf - то же с весами, редкие интересы ценятся выше частых
+SCORING_METHOD = os.getenv('MATCH_SCORING', 'jaccard')
+
+
+class InterestScorer:
+    """
+    Оценка совпадения пользователей по общим интересам.
+
+    Интересы каждого пользователя хранятся битовым множеством (int): каждому ID
+    интереса из загруженных строк назначается свой бит, поэтому пересечение
+    и объединение считаются одной операцией & / | и bit_count().
+    """
+
+    def __init__(self, rows: Iterable[Tuple[int, int]], method: str = None):
+        """
+        Args:
+            rows: Строки users_interest (ID пользователя, ID интереса)
+            method: jaccard или idf (по умолчанию MATCH_SCORING)
+        """
+        self.method = method or SCORING_METHOD
+        if self.method not in ('jaccard', 'idf'):
+            raise ValueError(f'Неизвестный способ оценки совпадений: {self.method}')
+
+        self._bits = {}  # ID интереса -> номер бита
+        self.bitsets = {}  # ID пользователя -> битовое множество интересов
+        frequency = []  # номер бита -> количество пользователей с интересом
+        for user_id, interest_id in rows:
+            bit = self._bits.get(interest_id)
+            if bit is None:
+                bit = self._bits[interest_id] = len(frequency)
+                frequency.append(0)
+            mask = 1 << bit
+            bitset = self.bitsets.get(user_id, 0)
+            if not bitset & mask:
+                self.bitsets[user_id] = bitset | mask
+                frequency[bit] += 1
+
+        # IDF по загруженным пользователям: интерес, который есть у всех, почти ничего не весит
+        total = len(self.bitsets)
+        self._weights = [math.log((1 + total) / (1 + count)) + 1 for count in frequency]
+
+    def has_interests(self, user_id: int) -> bool:
+        """
+        Есть ли у пользователя интересы
+        """
+        return bool(self.bitsets.get(user_id))
+
+    def _weight(self, bitset: int) -> float:
+        """
+        Сумма весов интересов битового множества
+        """
+        total = 0.0
+        while bitset:
+            low = bitset & -bitset
+            total += self._weights[low.bit_length() - 1]
+            bitset ^= low
+        return total
+
+    def score(self, user_id: int, candidate_id: int) -> float:
+        """
+        Оценка кандидата для пользователя
+
+        Returns:
+            Число от 0 (нет общих интересов) до 1 (интересы совпадают)
+        """
+        return self.score_many(user_id, [candidate_id])[candidate_id]
+
+    def score_many(self, user_id: int, candidate_ids: List[int]) -> Dict[int, float]:
+        """
+        Оценка кандидатов для пользователя за один проход
+
+        Args:
+            user_id: ID пользователя
+            candidate_ids: ID кандидатов
+
+        Returns:
+            Словарь {ID кандидата: оценка от 0 до 1}
+        """
+        user_bits = self.bitsets.get(user_id, 0)
+        bitsets = self.bitsets
+        if not user_bits:
+            return dict.fromkeys(candidate_ids, 0.0)
+
+        scores = {}
+        if self.method == 'jaccard':
+            user_count = user_bits.bit_count()
+            for candidate_id in candidate_ids:
+                bits = bitsets.get(candidate_id, 0)
+                common = (user_bits & bits).bit_count()
+                scores[candidate_id] = common / (user_count + bits.bit_count() - common) if common else 0.0
+        else:
+            user_weight = self._weight(user_bits)
+            for candidate_id in candidate_ids:
+                bits = bitsets.get(candidate_id, 0)
+                common_bits = user_bits & bits
+                if not common_bits:
+                    scores[candidate_id] = 0.0
+                    continue
+                common = self._weight(common_bits)
+                scores[candidate_id] = common / (user_weight + self._weight(bits) - common)
+        return scores
@@ -0,0 +1,214 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import select, delete, insert
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class MemorySessionBackend:
+    """
+    Сессии в памяти процесса: LRU с ограничением количества и временем жизни
+    """
+
+    def __init__(self, max_size: int = 10000):
+        """
+        Args:
+            max_size: Максимум сессий, при превышении вытесняются давно не использованные
+        """
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._data = OrderedDict()  # ID пользователя -> (срок действия, JSON)
+
+    def __len__(self):
+        return len(self._data)
+
+    def load(self, user_id: int) -> Optional[str]:
+        with self._lock:
+            item = self._data.get(user_id)
+            if item is None:
+                return None
+            expires, data = item
+            if expires < time.time():
+                del self._data[user_id]
+                return None
+            self._data.move_to_end(user_id)
+            return data
+
+    def save(self, user_id: int, data: str, ttl: float):
+        with self._lock:
+            self._data[user_id] = (time.time() + ttl, data)
+            self._data.move_to_end(user_id)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                metrics.incr('sessions.evicted')
+
+    def delete(self, user_id: int):
+        with self._lock:
+            self._data.pop(user_id, None)
+
+    def cleanup(self) -> int:
+        now = time.time()
+        with self._lock:
+            expired = [user_id for user_id, (expires, _) in self._data.items() if expires < now]
+            for user_id in expired:
+                del self._data[user_id]
+        return len(expired)
+
+
+class DbSessionBackend:
+    """
+    Сессии в таблице bot_sessions: общие для нескольких процессов бота и переживают перезапуск.
+    Каждая операция выполняется в отдельной транзакции на engine, не затрагивая сессию query.py.
+    """
+
+    def __init__(self, bind=None):
+        """
+        Args:
+            bind: engine БД (по умолчанию engine из models)
+        """
+        from models import engine
+
+        self.bind = bind or engine
+
+    def _upsert(self, row: dict):
+        from models import BotSessions
+
+        dialect = self.bind.dialect.name
+        if dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        elif dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        else:
+            # без ON CONFLICT: удаляем и вставляем в одной транзакции
+            return [delete(BotSessions).where(BotSessions.id_VK_user == row['id_VK_user']),
+                    insert(BotSessions).values(row)]
+        statement = dialect_insert(BotSessions).values(row)
+        return [statement.on_conflict_do_update(
+            index_elements=[BotSessions.id_VK_user],
+            set_={'data': statement.excluded.data, 'expires_at': statement.excluded.expires_at})]
+
+    def load(self, user_id: int) -> Optional[str]:
+        from models import BotSessions
+
+        with self.bind.connect() as conn:
+            return conn.execute(select(BotSessions.data).where(BotSessions.id_VK_user == user_id,
+                                                               BotSessions.expires_at > datetime.now())).scalar()
+
+    def save(self, user_id: int, data: str, ttl: float):
+        row = dict(id_VK_user=user_id, data=data, expires_at=datetime.now() + timedelta(seconds=ttl))
+        with self.bind.begin() as conn:
+            for statement in self._upsert(row):
+                conn.execute(statement)
+
+    def delete(self, user_id: int):
+        from models import BotSessions
+
+        with self.bind.begin() as conn:
+            conn.execute(delete(BotSessions).where(BotSessions.id_VK_user == user_id))
+
+    def cleanup(self) -> int:
+        from models import BotSessions
+
+        with self.bind.begin() as conn:
+            return conn.execute(delete(BotSessions).where(BotSessions.expires_at <= datetime.now())).rowcount
+
+
+class SessionStore:
+    """
+    Состояние диалога пользователей бота (текущий показанный пользователь, результаты поиска).
+
+    Сессия - словарь из простых значений (ID, числа, строки), хранится в JSON:
+    ORM-объекты и ответы VK в неё не попадают, поэтому сессии компактны и могут
+    храниться в общей БД для нескольких процессов бота. Сессия истекает через ttl
+    после последнего изменения.
+    """
+
+    def __init__(self, backend=None, ttl: float = 86400):
+        """
+        Args:
+            backend: Хранилище с методами load/save/delete/cleanup (по умолчанию MemorySessionBackend)
+            ttl: Время жизни сессии, сек
+        """
+        self.backend = MemorySessionBackend() if backend is None else backend
+        self.ttl = ttl
+
+    def get(self, user_id: int) -> dict:
+        """
+        Сессия пользователя
+
+        Returns:
+            Словарь состояния (пустой, если сессии нет или она истекла)
+        """
+        try:
+            data = self.backend.load(user_id)
+        except Exception as e:
+            logger.error(f"Ошибка чтения сессии {user_id}: {e}")
+            data = None
+        metrics.incr('sessions.hit' if data is not None else 'sessions.miss')
+        return json.loads(data) if data is not None else {}
+
+    def set(self, user_id: int, state: dict):
+        """
+        Сохранение сессии пользователя
+
+        Args:
+            user_id: ID пользователя бота
+            state: Словарь состояния, сериализуемый в JSON
+        """
+        self.backend.save(user_id, json.dumps(state, ensure_ascii=False, separators=(',', ':')), self.ttl)
+
+    def update(self, user_id: int, **fields) -> dict:
+        """
+        Изменение отдельных полей сессии
+
+        Returns:
+            Новое состояние сессии
+        """
+        state = self.get(user_id)
+        state.update(fields)
+        self.set(user_id, state)
+        return state
+
+    def delete(self, user_id: int):
+        """
+        Удаление сессии пользователя
+        """
+        self.backend.delete(user_id)
+
+    def cleanup(self) -> int:
+        """
+        Удаление истёкших сессий
+
+        Returns:
+            Количество удалённых сессий
+        """
+        count = self.backend.cleanup()
+        if count:
+            metrics.incr('sessions.expired', count)
+            logger.info(f"Удалено истёкших сессий: {count}")
+        return count
+
+
+def create_session_store() -> SessionStore:
+    """
+    Хранилище сессий с настройками из переменных окружения:
+    SESSION_STORE - memory (по умолчанию) или db (таблица bot_sessions);
+    SESSION_TTL - время жизни сессии, сек; SESSION_MAX_SIZE - максимум сессий в памяти
+    """
+    kind = os.getenv('SESSION_STORE', 'memory')
+    if kind == 'db':
+        backend = DbSessionBackend()
+    elif kind == 'memory':
+        backend = MemorySessionBackend(int(os.getenv('SESSION_MAX_SIZE', 10000)))
+    else:
+        raise ValueError(f'Неизвестное хранилище сессий: {kind}')
+    return SessionStore(backend, ttl=float(os.getenv('SESSION_TTL', 86400)))
@@ -0,0 +1,37 @@
+import os
+import sys
+import tempfile
+
+import pytest
+from sqlalchemy import BIGINT
+from sqlalchemy.ext.compiler import compiles
+
+# Тесты работают на временной SQLite БД: DB_URL задаётся до импорта models (engine создаётся при импорте)
+_db_dir = tempfile.mkdtemp(prefix='vkinder-tests-')
+os.environ['DB_URL'] = f"sqlite:///{os.path.join(_db_dir, 'test.db')}"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@compiles(BIGINT, 'sqlite')
+def _sqlite_bigint(type_, compiler, **kw):
+    # в SQLite автоинкремент работает только у INTEGER PRIMARY KEY
+    return 'INTEGER'
+
+
+@pytest.fixture
+def db():
+    """
+    Пустая БД со всеми миграциями, кэш и индекс кандидатов процесса сброшены
+    """
+    from models import Base, engine, session_scope
+    from migrations import migrations_metadata, upgrade
+    from cache import cache
+    from candidate_index import candidate_index
+
+    Base.metadata.drop_all(engine)
+    migrations_metadata.drop_all(engine)
+    upgrade(engine)
+    cache.clear()
+    candidate_index.rebuild(engine)
+    with session_scope() as session:
+        yield session
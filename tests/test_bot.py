@@ -0,0 +1,66 @@
+import json
+from types import SimpleNamespace
+
+from bot import VKinderBot
+from session_store import MemorySessionBackend, SessionStore
+
+
+class FakeVk:
+    """
+    Запись вызовов VK API вместо отправки
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    def method(self, method, values=None, **kwargs):
+        self.calls.append((method, values))
+        return 1
+
+
+def _bot(max_sessions: int = 100):
+    bot = VKinderBot.__new__(VKinderBot)
+    bot.vk_group = FakeVk()
+    bot.sessions = SessionStore(MemorySessionBackend(max_sessions))
+    bot.favorites = {}
+    return bot
+
+
+def _profile(target_id: int) -> dict:
+    return {'id': target_id, 'first_name': f'Имя{target_id}', 'last_name': 'Фамилия', 'city': 'Москва', 'age': 30,
+            'profile_url': f'https://vk.com/id{target_id}'}
+
+
+def _press(bot, user_id: int, payload: str):
+    bot.handle_button_click(SimpleNamespace(user_id=user_id, payload=json.dumps(payload)))
+
+
+def test_profiles_come_from_session():
+    bot = _bot()
+    bot.sessions.set(1, {'search_results': [_profile(2), _profile(3)], 'photos': {'2': ['photo2_1'], '3': []},
+                         'current_index': 0, 'current_user': None})
+
+    _press(bot, 1, 'next_user')
+    _press(bot, 1, 'add_favorite')
+    _press(bot, 1, 'show_favorites')
+
+    methods = [method for method, _ in bot.vk_group.calls]
+    assert methods == ['messages.send'] * 3
+    profile, _, favorites = (values for _, values in bot.vk_group.calls)
+    assert profile['message'].startswith('👤 Имя2 Фамилия\n📍 Москва\n🎂 30 лет')
+    assert profile['attachment'] == 'photo2_1'
+    assert 'https://vk.com/id2' in favorites['message']
+
+
+def test_favorites_survive_session_eviction():
+    bot = _bot(max_sessions=1)
+    bot.sessions.set(1, {'search_results': [_profile(2)], 'photos': {'2': []}, 'current_index': 0})
+    _press(bot, 1, 'next_user')
+    _press(bot, 1, 'add_favorite')
+
+    # сессия пользователя 1 вытеснена сессией другого пользователя
+    bot.sessions.set(5, {})
+    assert bot.sessions.get(1) == {}
+
+    _press(bot, 1, 'show_favorites')
+    assert 'Имя2 Фамилия' in bot.vk_group.calls[-1][1]['message']
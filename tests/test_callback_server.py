@@ -0,0 +1,126 @@
+import json
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+from callback_server import CallbackServer, DbEventLog
+from dispatcher import KeyedDispatcher
+from models import engine
+
+EVENTS = os.path.join(os.path.dirname(__file__), 'callback_events.jsonl')
+
+
+def _post(server, body) -> tuple:
+    url = f'http://127.0.0.1:{server.address[1]}/'
+    data = body if isinstance(body, bytes) else json.dumps(body).encode('utf-8')
+    request = urllib.request.Request(url, data=data, headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return response.status, response.read().decode('utf-8')
+    except urllib.error.HTTPError as e:
+        return e.code, e.read().decode('utf-8')
+
+
+@pytest.fixture
+def serve():
+    servers = []
+
+    def start(submit):
+        server = CallbackServer(submit, confirmation='abc123', secret='secret', group_id=1, host='127.0.0.1', port=0)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        servers.append((server, thread))
+        return server
+
+    yield start
+    for server, thread in servers:
+        server.shutdown()
+        thread.join(5)
+
+
+def test_secret_is_required():
+    with pytest.raises(ValueError):
+        CallbackServer(lambda user_id, event: True, confirmation='abc', secret='', host='127.0.0.1', port=0)
+
+
+def test_db_event_log_is_shared(db):
+    first, second = DbEventLog(engine), DbEventLog(engine)
+
+    assert first.add('event-1')
+    assert not second.add('event-1')
+    second.forget('event-1')
+    assert first.add('event-1')
+    assert DbEventLog(engine, ttl=-1).cleanup() == 1
+
+
+def test_shutdown_before_serve_forever():
+    server = CallbackServer(lambda user_id, event: True, confirmation='abc', secret='secret', host='127.0.0.1', port=0)
+    server.shutdown()
+
+
+def test_recorded_events(serve):
+    received = []
+
+    def submit(user_id, event):
+        received.append((user_id, event.text, getattr(event, 'payload', None)))
+        return True
+
+    server = serve(submit)
+
+    with open(EVENTS, encoding='utf-8') as file:
+        responses = [_post(server, line.encode('utf-8')) for line in file if line.strip()]
+
+    assert responses == [
+        (200, 'abc123'),  # подтверждение адреса
+        (200, 'ok'),
+        (200, 'ok'),  # повторная доставка e1 подтверждается, но не обрабатывается
+        (200, 'ok'),
+        (403, 'forbidden'),  # неверный секретный ключ
+        (403, 'forbidden'),  # чужое сообщество
+        (200, 'ok'),  # необрабатываемое событие
+    ]
+    assert received == [(11, 'Привет', None), (11, '', '"next_user"')]
+    assert _post(server, b'[1, 2]') == (400, 'bad request')
+
+
+def test_busy_queue(serve):
+    release = threading.Event()
+    handled = []
+
+    def handle(event):
+        release.wait(5)
+        handled.append(event.text)
+
+    dispatcher = KeyedDispatcher(handle, workers=1, max_pending=1)
+    server = serve(lambda user_id, event: dispatcher.submit(user_id, event, timeout=0.1))
+    event = {'type': 'message_new', 'group_id': 1, 'secret': 'secret',
+             'object': {'message': {'from_id': 11, 'peer_id': 11, 'text': 'первое'}}}
+    try:
+        assert _post(server, dict(event, event_id='e1')) == (200, 'ok')
+        busy = dict(event, event_id='e2', object={'message': {'from_id': 12, 'peer_id': 12, 'text': 'второе'}})
+        assert _post(server, busy) == (503, 'busy')
+
+        release.set()
+        # отклонённое событие не запомнено как принятое: повторная доставка VK обрабатывается
+        for _ in range(50):
+            status = _post(server, busy)
+            if status != (503, 'busy'):
+                break
+            time.sleep(0.1)
+        assert status == (200, 'ok')
+    finally:
+        release.set()
+        dispatcher.shutdown()
+    assert handled == ['первое', 'второе']
+
+
+def test_non_ascii_secret_is_forbidden(serve):
+    server = serve(lambda user_id, event: True)
+    event = {'type': 'message_new', 'group_id': 1, 'event_id': 'e1', 'secret': 'секрет',
+             'object': {'message': {'from_id': 11, 'peer_id': 11, 'text': 'Привет'}}}
+
+    assert _post(server, event) == (403, 'forbidden')
@@ -0,0 +1,97 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, select, update
+
+from models import Gender, Matches, Users
+from query import onboard_user, add_match, claim_matches, claim_prepared_matches, release_matches, find_match, \
+    push_new_user_matches
+
+MOSCOW = {'id': 1, 'title': 'Москва'}
+
+
+def _users(*user_ids):
+    for user_id in user_ids:
+        onboard_user(user_id, f'Имя{user_id}', 'Фамилия', 30, Gender.VALUE_TWO, MOSCOW)
+
+
+def test_reserved_match_is_not_claimed_again(db):
+    _users(1, 2)
+    add_match(1, 2)
+
+    assert [match.id_target_user for match in claim_matches(1, 5, shown=False)] == [2]
+    assert claim_matches(1, 5) == []
+
+
+def test_expired_reservation_returns_to_queue(db):
+    _users(1, 2, 3)
+    add_match(1, 2)
+    add_match(1, 3)
+    claim_matches(1, 5, shown=False)
+    # резервирование 2 "зависло" в упавшем процессе, 3 - свежее
+    db.execute(update(Matches).where(Matches.id_target_user == 2)
+               .values(reserved_at=datetime.now() - timedelta(hours=2)))
+    db.commit()
+
+    assert [match.id_target_user for match in claim_matches(1, 5, lease=3600)] == [2]
+    assert claim_matches(1, 5, lease=3600) == []
+
+
+def test_release_matches(db):
+    _users(1, 2)
+    add_match(1, 2)
+    claimed = claim_matches(1, 1, shown=False)
+
+    assert release_matches([match.id_match for match in claimed]) == 1
+    assert [match.id_target_user for match in claim_matches(1, 1)] == [2]
+
+
+def test_prepared_matches_skip_unknown_users(db):
+    _users(1, 2)
+    add_match(1, 2)
+    add_match(1, 99)  # пользователя 99 нет в таблице users
+
+    prepared = claim_prepared_matches(1, 5)
+
+    assert [row['id_VK_user'] for row in prepared] == [2]
+    shown = {match.id_target_user: match.match_shown for match in db.query(Matches)}
+    assert shown == {2: False, 99: True}
+    # после истечения срока в очередь возвращается только совпадение с известным пользователем
+    db.execute(update(Matches).values(reserved_at=datetime.now() - timedelta(hours=2)))
+    db.commit()
+    assert [match.id_target_user for match in claim_matches(1, 5, lease=3600)] == [2]
+
+
+def _matched_owners(session, target_id):
+    return set(session.scalars(select(Matches.id_VK_user).where(Matches.id_target_user == target_id)))
+
+
+def test_push_new_user_matches_agrees_with_find_match(db):
+    # владельцы очередей: с нулевым возрастом, без возраста, подходящего и неподходящего возраста, другого пола
+    owners = {1: 0, 2: None, 3: 28, 4: 50}
+    for owner_id, age in owners.items():
+        onboard_user(owner_id, 'Имя', 'Фамилия', age, Gender.VALUE_ONE, MOSCOW)
+    onboard_user(5, 'Имя', 'Фамилия', 25, Gender.VALUE_TWO, MOSCOW)
+    for owner_id in [*owners, 5]:
+        find_match(owner_id)
+    db.execute(delete(Matches))
+    db.commit()
+
+    onboard_user(10, 'Имя', 'Фамилия', 25, Gender.VALUE_TWO, MOSCOW)
+    push_new_user_matches(10)
+    pushed = _matched_owners(db, 10)
+    assert pushed == {1, 2, 3}
+
+    # инкрементальный поиск (since) находит тех же владельцев
+    db.execute(delete(Matches))
+    db.commit()
+    for owner_id in owners:
+        find_match(owner_id)
+    assert _matched_owners(db, 10) == pushed
+
+    # полный поиск - тоже
+    db.execute(delete(Matches))
+    db.execute(update(Users).values(last_search_at=None))
+    db.commit()
+    for owner_id in owners:
+        find_match(owner_id)
+    assert _matched_owners(db, 10) == pushed
@@ -0,0 +1,120 @@
+import pytest
+from sqlalchemy import func, inspect, select, text
+
+from migrations import MIGRATIONS, current_version, explain_hot_queries, schema_version, upgrade
+from models import Base, create_db_engine
+
+LATEST = MIGRATIONS[-1][0]
+
+# Таблицы исходного models.py (до версионных миграций), как их создавал create_all в SQLite
+BASELINE_SCHEMA = [
+    'CREATE TABLE city (id_city BIGINT NOT NULL, city_name VARCHAR, PRIMARY KEY (id_city))',
+    'CREATE TABLE interests (id_interest BIGINT NOT NULL, interest_name VARCHAR, PRIMARY KEY (id_interest))',
+    'CREATE TABLE users ("id_VK_user" BIGINT NOT NULL, name VARCHAR, surname VARCHAR, age SMALLINT, '
+    'gender VARCHAR(9), id_city BIGINT, PRIMARY KEY ("id_VK_user"), FOREIGN KEY(id_city) REFERENCES city (id_city))',
+    'CREATE TABLE users_interest ("id_VK_user" BIGINT NOT NULL, id_interest BIGINT NOT NULL, '
+    'PRIMARY KEY ("id_VK_user", id_interest), FOREIGN KEY("id_VK_user") REFERENCES users ("id_VK_user"), '
+    'FOREIGN KEY(id_interest) REFERENCES interests (id_interest))',
+    'CREATE TABLE blacklist ("id_VK_user" BIGINT NOT NULL, id_blocked BIGINT NOT NULL, '
+    'PRIMARY KEY ("id_VK_user", id_blocked), FOREIGN KEY("id_VK_user") REFERENCES users ("id_VK_user"))',
+    'CREATE TABLE favorites ("id_VK_user" BIGINT NOT NULL, id_target BIGINT NOT NULL, '
+    'PRIMARY KEY ("id_VK_user", id_target), FOREIGN KEY("id_VK_user") REFERENCES users ("id_VK_user"))',
+    'CREATE TABLE photos (id_user_photo BIGINT NOT NULL, "id_VK_user" BIGINT, url TEXT, likes SMALLINT, '
+    'attachment TEXT, is_profile_photo BOOLEAN, PRIMARY KEY (id_user_photo), '
+    'FOREIGN KEY("id_VK_user") REFERENCES users ("id_VK_user"))',
+    'CREATE TABLE matches (id_match BIGINT NOT NULL, "id_VK_user" BIGINT, id_target_user BIGINT, '
+    'matched_at TIMESTAMP, match_shown BOOLEAN, PRIMARY KEY (id_match), '
+    'FOREIGN KEY("id_VK_user") REFERENCES users ("id_VK_user"))',
+]
+BASELINE_DATA = [
+    "INSERT INTO city VALUES (1, 'Москва')",
+    "INSERT INTO users VALUES (1, 'Имя', 'Фамилия', 30, 'VALUE_TWO', 1), (2, 'Имя', 'Фамилия', 31, 'VALUE_ONE', 1)",
+    "INSERT INTO photos VALUES (1, 2, 'https://vk.com/photo2_1', 5, 'photo2_1', 1)",
+    "INSERT INTO matches VALUES (1, 1, 2, '2024-01-01 00:00:00', NULL), (2, 1, 3, '2024-01-02 00:00:00', 1)",
+]
+
+
+@pytest.fixture
+def bind(tmp_path):
+    engine = create_db_engine(f"sqlite:///{tmp_path / 'migrations.db'}")
+    yield engine
+    engine.dispose()
+
+
+def _schema(bind) -> dict:
+    """
+    Колонки и индексы таблиц БД: {таблица: (колонки, индексы)}
+    """
+    inspector = inspect(bind)
+    return {table: ({column['name'] for column in inspector.get_columns(table)},
+                    {index['name'] for index in inspector.get_indexes(table)})
+            for table in inspector.get_table_names() if table != 'schema_version'}
+
+
+def test_upgrade_fresh_database(bind):
+    assert upgrade(bind) == LATEST
+    # повторный запуск ничего не применяет
+    assert upgrade(bind) == LATEST
+    with bind.connect() as conn:
+        assert conn.execute(select(func.count()).select_from(schema_version)).scalar() == len(MIGRATIONS)
+
+
+def test_migrations_match_models(bind, tmp_path):
+    upgrade(bind)
+    models_bind = create_db_engine(f"sqlite:///{tmp_path / 'models.db'}")
+    Base.metadata.create_all(models_bind)
+
+    # изменение модели без миграции здесь заметно
+    assert _schema(bind) == _schema(models_bind)
+    models_bind.dispose()
+
+
+def test_upgrade_baseline_database(bind, tmp_path):
+    with bind.begin() as conn:
+        for statement in BASELINE_SCHEMA + BASELINE_DATA:
+            conn.execute(text(statement))
+
+    assert upgrade(bind) == LATEST
+
+    models_bind = create_db_engine(f"sqlite:///{tmp_path / 'models.db'}")
+    Base.metadata.create_all(models_bind)
+    assert _schema(bind) == _schema(models_bind)
+    models_bind.dispose()
+    with bind.connect() as conn:
+        assert conn.execute(text('SELECT name, age, gender FROM users WHERE "id_VK_user" = 1')).one() == \
+               ('Имя', 30, 'VALUE_TWO')
+        assert conn.execute(text('SELECT id_match, score, reserved_at FROM matches ORDER BY id_match')).all() == \
+               [(1, 0, None), (2, 0, None)]
+        assert conn.execute(text('SELECT attachment FROM photos')).scalar() == 'photo2_1'
+
+
+def test_migrations_are_idempotent(bind):
+    upgrade(bind)
+    before = _schema(bind)
+
+    # повторное применение любой миграции не меняет схему
+    for _, _, apply in MIGRATIONS:
+        with bind.begin() as conn:
+            apply(conn)
+
+    assert _schema(bind) == before
+
+
+def test_upgrade_step_by_step(bind):
+    assert upgrade(bind, target=9) == 9
+    with bind.connect() as conn:
+        assert current_version(conn) == 9
+    assert 'reserved_at' not in _schema(bind)['matches'][0]
+    assert 'callback_events' not in _schema(bind)
+
+    assert upgrade(bind) == LATEST
+    columns, indexes = _schema(bind)['matches']
+    assert 'reserved_at' in columns and 'ix_matches_user_reserved' in indexes
+
+
+def test_hot_queries_use_indexes(bind):
+    upgrade(bind)
+
+    plans = explain_hot_queries(bind)
+
+    assert {name: plan for name, (uses_index, plan) in plans.items() if not uses_index} == {}
@@ -0,0 +1,84 @@
+from vk_api.exceptions import ApiError
+
+from metrics import metrics
+from outbox import Outbox
+
+
+class FakeBatcher:
+    """
+    VkRequestBatcher, отвечающий заранее заданными результатами
+    """
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.calls = []
+
+    def call_many(self, calls, priority=None):
+        self.calls.append(calls)
+        respond = self.responses.pop(0) if self.responses else None
+        return [respond(values) if respond else 1 for _, values in calls]
+
+
+def _send_all(outbox):
+    outbox.start()
+    assert outbox.flush(5)
+    outbox.stop()
+
+
+def test_coalesced_message_gets_new_random_id():
+    batcher = FakeBatcher()
+    outbox = Outbox(batcher)
+    outbox.send(1, 'a')
+    outbox.send(1, 'b')
+    queued = [message.random_id for message in outbox._queues[1]]
+
+    _send_all(outbox)
+
+    [[(method, values)]] = batcher.calls
+    assert values['message'] == 'a\n\nb'
+    assert values['random_id'] not in queued
+
+
+def test_retry_reuses_random_id():
+    batcher = FakeBatcher(lambda values: TimeoutError('нет ответа'))
+    outbox = Outbox(batcher, backoff=0)
+    outbox.send(1, 'a')
+    random_id = outbox._queues[1][0].random_id
+
+    _send_all(outbox)
+
+    assert [calls[0][1]['random_id'] for calls in batcher.calls] == [random_id, random_id]
+
+
+def test_peer_ids_partial_failure():
+    def partial(values):
+        return [{'peer_id': 1, 'message_id': 10},
+                {'peer_id': 2, 'error': {'code': 10, 'description': 'internal'}},
+                {'peer_id': 3, 'error': {'code': 901, 'description': 'cant send'}}]
+
+    batcher = FakeBatcher(partial)
+    outbox = Outbox(batcher, backoff=0)
+    for peer_id in (1, 2, 3):
+        outbox.send(peer_id, 'same')
+    sent, dropped = metrics.counter('outbox.sent'), metrics.counter('outbox.dropped')
+
+    _send_all(outbox)
+
+    first, retry = batcher.calls
+    assert first[0][1]['peer_ids'] == '1,2,3'
+    # повтор только получателю с временной ошибкой и с тем же random_id
+    assert retry[0][1]['peer_id'] == 2
+    assert retry[0][1]['random_id'] == first[0][1]['random_id']
+    assert metrics.counter('outbox.sent') - sent == 2
+    assert metrics.counter('outbox.dropped') - dropped == 1
+
+
+def test_permanent_error_is_not_retried():
+    error = ApiError(None, 'messages.send', {}, False, {'error_code': 901, 'error_msg': 'cant send'})
+    batcher = FakeBatcher(lambda values: error)
+    outbox = Outbox(batcher, backoff=0)
+    outbox.send(1, 'a')
+
+    _send_all(outbox)
+
+    assert len(batcher.calls) == 1
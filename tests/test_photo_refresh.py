@@ -0,0 +1,41 @@
+from vk_api.exceptions import ApiError
+
+from models import Gender, Users
+from photo_refresh import PhotoRefresher
+from query import onboard_user, get_top_photos
+
+
+class FakeBatcher:
+    def __init__(self, results):
+        self.results = results
+
+    def call_many(self, calls, priority=None):
+        return [self.results[values['owner_id']] for _, values in calls]
+
+
+def _select(items, count):
+    return [{'url': item['url'], 'likes': item['likes'], 'attachment': item['attachment']} for item in items][:count]
+
+
+def _photo(owner_id, likes):
+    return {'url': f'https://vk.com/photo{owner_id}_{likes}', 'likes': likes, 'attachment': f'photo{owner_id}_{likes}'}
+
+
+def test_errors_do_not_stop_other_users(db):
+    for user_id in (1, 2, 3, 4):
+        onboard_user(user_id, 'Имя', 'Фамилия', 30, Gender.VALUE_TWO, {'id': 1, 'title': 'Москва'})
+    results = {
+        1: {'items': [_photo(1, 5)]},
+        2: {'items': [{'likes': 1}]},  # некорректный ответ - ошибка при сохранении
+        3: ApiError(None, 'photos.get', {}, False, {'error_code': 30, 'error_msg': 'This profile is private'}),
+        4: {'items': [_photo(4, 7), _photo(4, 9)]},
+    }
+    refresher = PhotoRefresher(FakeBatcher(results), lambda user_id: {'owner_id': user_id}, _select,
+                               max_age=3600, budget=1)
+
+    assert refresher.run() == 2
+
+    assert get_top_photos([1, 2, 3, 4], 3) == {1: ['photo1_5'], 4: ['photo4_9', 'photo4_7']}
+    refreshed = {user.id_VK_user: user.photos_refreshed_at is not None for user in db.query(Users)}
+    # пользователя 2 повторим при следующем запуске
+    assert refreshed == {1: True, 2: False, 3: True, 4: True}
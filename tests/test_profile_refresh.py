@@ -0,0 +1,58 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, update
+
+from models import City, Gender, Session, Users
+from profile_refresh import ProfileRefresher
+from query import onboard_user
+
+KAZAN = {'id': 2, 'title': 'Казань'}
+
+
+class FakeVk:
+    def __init__(self, profiles):
+        self.profiles = profiles
+        self.calls = []
+
+    def method(self, method, values=None, priority=None):
+        self.calls.append((method, values))
+        return self.profiles
+
+
+def _parse(user_info):
+    # как VKinderBot._parse_user_info: без города в ответе подставляется город по умолчанию
+    return {'id': user_info['id'], 'first_name': user_info.get('first_name'), 'last_name': user_info.get('last_name'),
+            'city': user_info.get('city', {'id': 1, 'title': 'Москва'}), 'age': 0, 'sex': user_info.get('sex', 0)}
+
+
+def test_refresh_keeps_hidden_city_in_one_transaction(db):
+    for user_id in (1, 2, 3):
+        onboard_user(user_id, 'Имя', 'Фамилия', 30, Gender.VALUE_TWO, KAZAN)
+    old = datetime.now() - timedelta(days=2)
+    db.execute(update(Users).values(updated_at=old, refreshed_at=old))
+    db.commit()
+
+    vk = FakeVk([
+        {'id': 1, 'first_name': 'Новое', 'last_name': 'Фамилия', 'sex': 1},  # город скрыт
+        {'id': 2, 'first_name': 'Имя', 'last_name': 'Фамилия', 'sex': 1, 'city': {'id': 3, 'title': 'Самара'}},
+        {'id': 4, 'first_name': 'Нет в БД', 'last_name': 'Фамилия', 'sex': 1},
+    ])
+    commits = []
+
+    def on_commit(session):
+        commits.append(session)
+
+    event.listen(Session.session_factory, 'after_commit', on_commit)
+    try:
+        assert ProfileRefresher(vk, _parse, max_age=3600).refresh([1, 2, 3, 4]) == 2
+    finally:
+        event.remove(Session.session_factory, 'after_commit', on_commit)
+
+    assert len(commits) == 1
+    users = {user.id_VK_user: user for user in db.query(Users)}
+    assert (users[1].name, users[1].id_city) == ('Новое', 2)
+    assert users[2].id_city == 3 and db.get(City, 3).city_name == 'Самара'
+    assert all(user.refreshed_at > old for user in users.values())
+    # пользователь 3 не вернулся из VK - профиль не изменился
+    assert users[3].updated_at == old
+    assert users[1].updated_at > old
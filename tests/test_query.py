@@ -0,0 +1,25 @@
+from types import SimpleNamespace
+
+import pytest
+
+import query
+from models import Gender, Users
+
+
+def test_insert_requires_on_conflict_support(monkeypatch):
+    monkeypatch.setattr(query.session, 'get_bind', lambda: SimpleNamespace(dialect=SimpleNamespace(name='mysql')))
+
+    with pytest.raises(ValueError, match='mysql'):
+        query._insert(Users)
+
+
+def test_onboard_user_is_idempotent(db):
+    city = {'id': 1, 'title': 'Москва'}
+    photos = [{'url': 'https://vk.com/photo1_1', 'likes': 1, 'attachment': 'photo1_1'}]
+
+    query.onboard_user(1, 'Имя', 'Фамилия', 30, Gender.VALUE_TWO, city, photos)
+    query.onboard_user(1, 'Имя', 'Новая', 31, Gender.VALUE_TWO, city, photos)
+
+    user = db.get(Users, 1)
+    assert (user.surname, user.age) == ('Новая', 31)
+    assert query.get_top_photos([1], 3) == {1: ['photo1_1']}
@@ -0,0 +1,132 @@
+import asyncio
+
+import pytest
+from aiohttp import web
+from vk_api.exceptions import ApiError
+from vk_api.longpoll import VkEventType
+
+from vk_async import AsyncVkApi, AsyncVkLongPoll
+from vk_ratelimit import Priority, RateLimitedVkApi
+
+
+class FakeVkServer:
+    """
+    Тестовый сервер VK API и LongPoll на aiohttp (адрес API задаётся как VK_API_URL)
+    """
+
+    def __init__(self):
+        self.requests = []
+        self.checks = []
+        # ответы longpoll по очереди: события, устаревший ключ, снова события
+        self.longpoll = [
+            {'ts': 2, 'updates': [[4, 100, 1, 11, 1700000000, 'Привет', {}, {}]]},
+            {'failed': 2},
+            {'ts': 3, 'updates': [[4, 101, 1, 12, 1700000001, '/start', {}, {}]]},
+        ]
+        self.app = web.Application()
+        self.app.router.add_post('/method/{method}', self.method)
+        self.app.router.add_get('/longpoll', self.check)
+
+    async def method(self, request):
+        method = request.match_info['method']
+        data = dict(await request.post())
+        self.requests.append((method, data))
+        if method == 'messages.getLongPollServer':
+            return web.json_response({'response': {'key': f"key{len(self.requests)}", 'ts': 1,
+                                                   'server': f'http://{request.host}/longpoll'}})
+        if method == 'users.get':
+            return web.json_response({'response': [{'id': int(data['user_ids']), 'first_name': 'Имя'}]})
+        return web.json_response({'error': {'error_code': 3, 'error_msg': 'Unknown method passed'}})
+
+    async def check(self, request):
+        self.checks.append(dict(request.query))
+        return web.json_response(self.longpoll.pop(0) if self.longpoll else {'ts': 3, 'updates': []})
+
+    async def __aenter__(self):
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        self.url = f'http://127.0.0.1:{self.runner.addresses[0][1]}/method/'
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.runner.cleanup()
+
+
+def test_call_and_errors():
+    async def scenario():
+        async with FakeVkServer() as server:
+            api = AsyncVkApi('token', api_url=server.url)
+            try:
+                assert await api.call('users.get', {'user_ids': 5, 'fields': ['city', 'sex'], 'skip': None}) == \
+                       [{'id': 5, 'first_name': 'Имя'}]
+                with pytest.raises(ApiError) as error:
+                    await api.call('unknown.method')
+                assert error.value.code == 3
+                # синхронный вызов из потока-обработчика выполняется в цикле событий клиента
+                result = await asyncio.get_running_loop().run_in_executor(
+                    None, api.method, 'users.get', {'user_ids': 7})
+                assert result == [{'id': 7, 'first_name': 'Имя'}]
+            finally:
+                await api.close()
+            return server.requests
+
+    requests = asyncio.run(scenario())
+    assert requests[0][1] == {'user_ids': '5', 'fields': 'city,sex', 'v': '5.92', 'access_token': 'token'}
+
+
+def test_method_requires_started_client():
+    with pytest.raises(RuntimeError):
+        AsyncVkApi('token').method('users.get')
+
+
+def test_longpoll_events_and_key_refresh():
+    async def scenario():
+        async with FakeVkServer() as server:
+            api = AsyncVkApi('token', api_url=server.url)
+            longpoll = AsyncVkLongPoll(api, wait=1, group_id=1)
+            events = []
+            try:
+                async for event in longpoll.listen():
+                    events.append(event)
+                    if len(events) == 2:
+                        break
+            finally:
+                await api.close()
+            return server, events
+
+    server, events = asyncio.run(scenario())
+    assert [(event.type, event.user_id, event.text, event.to_me) for event in events] == [
+        (VkEventType.MESSAGE_NEW, 11, 'Привет', True),
+        (VkEventType.MESSAGE_NEW, 12, '/start', True),
+    ]
+    # failed=2: ключ обновлён, ts сохранён
+    assert [method for method, _ in server.requests] == ['messages.getLongPollServer'] * 2
+    assert [(check['key'], check['ts']) for check in server.checks] == [('key1', '1'), ('key1', '2'), ('key2', '2')]
+
+
+def test_longpoll_server_requests_go_through_rate_limiter():
+    class CountingVkApi(RateLimitedVkApi):
+        def __init__(self, vk):
+            super().__init__(vk, rate=100, name='test')
+            self.methods = []
+
+        def method(self, method, values=None, raw=False, priority=None):
+            self.methods.append((method, priority))
+            return super().method(method, values, raw=raw, priority=priority)
+
+    async def scenario():
+        async with FakeVkServer() as server:
+            api = AsyncVkApi('token', api_url=server.url)
+            limited = CountingVkApi(api)
+            longpoll = AsyncVkLongPoll(api, wait=1, group_id=1, api=limited)
+            try:
+                async for event in longpoll.listen():
+                    if event.user_id == 12:
+                        break
+            finally:
+                await api.close()
+            return limited.methods
+
+    assert asyncio.run(scenario()) == [('messages.getLongPollServer', Priority.INTERACTIVE)] * 2
@@ -0,0 +1,194 @@
+import asyncio
+import functools
+import logging
+import os
+from typing import Dict, List, Optional
+
+import aiohttp
+from vk_api.exceptions import ApiError
+from vk_api.longpoll import Event, DEFAULT_MODE
+
+from vk_ratelimit import Priority
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncVkApi:
+    """
+    Асинхронный клиент VK API на aiohttp.
+
+    Соединения с api.vk.com переиспользуются (keep-alive пул aiohttp),
+    поэтому запросы не открывают новые TCP/TLS соединения.
+    Для обработчиков, работающих в потоках, есть синхронный метод method()
+    с той же сигнатурой, что и у vk_api.VkApi. Обработчики бота остаются синхронными:
+    поток ждёт результат, поэтому одновременных запросов от обработчиков
+    не больше числа потоков диспетчера (BOT_WORKERS).
+    """
+
+    def __init__(self, token: str, api_version: str = '5.92', api_url: str = None,
+                 limit: int = 100, timeout: float = 30):
+        """
+        Args:
+            token: Токен доступа
+            api_version: Версия API (как у vk_api.VkApi по умолчанию)
+            api_url: Адрес API (VK_API_URL, например адрес тестового сервера)
+            limit: Максимум одновременных соединений
+            timeout: Таймаут запроса, сек
+        """
+        self.token = token
+        self.api_version = api_version
+        self.api_url = (api_url or os.getenv('VK_API_URL', 'https://api.vk.com/method/')).rstrip('/') + '/'
+        self.limit = limit
+        self.timeout = timeout
+
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    async def start(self):
+        """
+        Открытие пула соединений в текущем цикле событий
+        """
+        if self.session is None:
+            self.loop = asyncio.get_running_loop()
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.limit, keepalive_timeout=60),
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+
+    async def close(self):
+        """
+        Закрытие пула соединений
+        """
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def call(self, method: str, values: Dict = None, raw: bool = False):
+        """
+        Вызов метода API
+
+        Args:
+            method: Название метода
+            values: Параметры
+            raw: Вернуть ответ целиком (нужно для execute_errors)
+
+        Returns:
+            response['response'] (или весь ответ при raw=True)
+        """
+        await self.start()
+        values = dict(values or {})
+        values.setdefault('v', self.api_version)
+        values.setdefault('access_token', self.token)
+        # aiohttp не принимает None и списки в параметрах формы
+        data = {key: ','.join(map(str, value)) if isinstance(value, (list, tuple, set)) else str(value)
+                for key, value in values.items() if value is not None}
+
+        async with self.session.post(self.api_url + method, data=data) as response:
+            response.raise_for_status()
+            result = await response.json(content_type=None)
+
+        if 'error' in result:
+            raise ApiError(self, method, values, raw, result['error'])
+        return result if raw else result['response']
+
+    def method(self, method: str, values: Dict = None, raw: bool = False):
+        """
+        Синхронный вызов метода API из потока-обработчика.
+        Запрос выполняется в цикле событий клиента, поток ждёт результат.
+        """
+        if self.loop is None:
+            raise RuntimeError('AsyncVkApi не запущен: вызовите start() в цикле событий')
+        return asyncio.run_coroutine_threadsafe(self.call(method, values, raw), self.loop).result()
+
+
+class AsyncVkLongPoll:
+    """
+    Асинхронный User LongPoll (аналог vk_api.longpoll.VkLongPoll).
+    События разбираются классом vk_api.longpoll.Event, поэтому обработчики
+    бота работают с ними так же, как с событиями синхронного longpoll.
+
+    Запросы к API (messages.getLongPollServer) идут через ограничитель частоты токена,
+    если он передан в api; запросы к longpoll серверу (a_check) в лимит VK API не входят.
+    """
+
+    def __init__(self, vk: AsyncVkApi, wait: int = 25, mode: int = DEFAULT_MODE, group_id: int = None,
+                 api=None):
+        """
+        Args:
+            vk: Асинхронный клиент API
+            wait: Время ожидания событий на сервере, сек
+            mode: Дополнительные опции ответа
+            group_id: ID сообщества (для токена сообщества)
+            api: Клиент с ограничением частоты над тем же токеном (RateLimitedVkApi над vk)
+        """
+        self.vk = vk
+        self.api = api
+        self.wait = wait
+        self.mode = getattr(mode, 'value', mode)
+        self.group_id = group_id
+
+        self.url = None
+        self.key = None
+        self.ts = None
+
+    async def update_longpoll_server(self, update_ts: bool = True):
+        """
+        Получение адреса и ключа longpoll сервера
+        """
+        values = {'lp_version': 3}
+        if self.group_id:
+            values['group_id'] = self.group_id
+
+        if self.api is not None:
+            # ожидание очереди ограничителя - в потоке, чтобы не блокировать цикл событий
+            response = await asyncio.get_running_loop().run_in_executor(
+                None, functools.partial(self.api.method, 'messages.getLongPollServer', values,
+                                        priority=Priority.INTERACTIVE))
+        else:
+            response = await self.vk.call('messages.getLongPollServer', values)
+        self.key = response['key']
+        server = response['server']
+        self.url = server if '://' in server else f'https://{server}'
+        if update_ts:
+            self.ts = response['ts']
+
+    async def check(self) -> List[Event]:
+        """
+        Получение событий от сервера один раз
+        """
+        if self.url is None:
+            await self.update_longpoll_server()
+
+        params = {'act': 'a_check', 'key': self.key, 'ts': self.ts,
+                  'wait': self.wait, 'mode': self.mode, 'version': 3}
+        timeout = aiohttp.ClientTimeout(total=self.wait + 10)
+        async with self.vk.session.get(self.url, params=params, timeout=timeout) as response:
+            result = await response.json(content_type=None)
+
+        if 'failed' not in result:
+            self.ts = result['ts']
+            return [Event(raw_event) for raw_event in result['updates']]
+
+        if result['failed'] == 1:
+            self.ts = result['ts']
+        elif result['failed'] == 2:
+            await self.update_longpoll_server(update_ts=False)
+        else:
+            await self.update_longpoll_server()
+        return []
+
+    async def listen(self):
+        """
+        Слушать сервер
+
+        Yields:
+            События vk_api.longpoll.Event
+        """
+        await self.vk.start()
+        while True:
+            try:
+                for event in await self.check():
+                    yield event
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning(f"Ошибка longpoll, переподключение: {e}")
+                await asyncio.sleep(1)
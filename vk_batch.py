@@ -0,0 +1,153 @@
+import json
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Dict, List, Tuple
+
+from vk_api.exceptions import ApiError
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Максимум вызовов API в одном execute
+EXECUTE_LIMIT = 25
+
+
+def build_execute_code(calls: List[Tuple[str, Dict]]) -> str:
+    """
+    Код VKScript для метода execute, возвращающий массив результатов вызовов
+
+    Args:
+        calls: Список (метод, параметры)
+
+    Returns:
+        Код для параметра code метода execute
+    """
+    parts = []
+    for method, values in calls:
+        values = {key: value for key, value in (values or {}).items() if value is not None}
+        parts.append(f'API.{method}({json.dumps(values, ensure_ascii=False)})')
+    return f'return [{",".join(parts)}];'
+
+
+class VkRequestBatcher:
+    """
+    Объединение вызовов VK API в execute (до 25 методов за один HTTP запрос).
+
+    method() ставит вызов в общую очередь и ждет результат: вызовы из разных
+    потоков, пришедшие в пределах max_delay, уходят одним execute.
+    call_many() сразу отправляет переданный набор вызовов пачками по 25.
+    Ошибка отдельного метода возвращается только его вызывающему.
+    """
+
+    def __init__(self, vk, max_delay: float = 0.02):
+        """
+        Args:
+            vk: Клиент API с методом method() (vk_api.VkApi, AsyncVkApi и т.п.)
+            max_delay: Сколько ждать других вызовов перед отправкой пачки, сек
+        """
+        self.vk = vk
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        self._pending = []  # (метод, параметры, Future)
+        self._timer = None
+
+    def method(self, method: str, values: Dict = None):
+        """
+        Вызов метода API через общую очередь (сигнатура как у vk_api.VkApi.method)
+        """
+        return self.submit(method, values).result()
+
+    def submit(self, method: str, values: Dict = None) -> Future:
+        """
+        Постановка вызова в очередь
+
+        Returns:
+            Future с результатом вызова
+        """
+        future = Future()
+        batch = None
+        with self._lock:
+            self._pending.append((method, values, future))
+            if len(self._pending) >= EXECUTE_LIMIT:
+                # пачка заполнена - отправляем сразу из текущего потока
+                batch, self._pending = self._pending[:EXECUTE_LIMIT], self._pending[EXECUTE_LIMIT:]
+            elif self._timer is None:
+                self._timer = threading.Timer(self.max_delay, self._flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if batch:
+            self._execute(batch)
+        return future
+
+    def call_many(self, calls: List[Tuple[str, Dict]], priority: int = None) -> List:
+        """
+        Выполнение набора вызовов минимальным числом запросов
+
+        Args:
+            calls: Список (метод, параметры)
+            priority: Приоритет запросов для RateLimitedVkApi (vk_ratelimit.Priority)
+
+        Returns:
+            Список результатов в порядке вызовов (исключение на месте неудачного вызова)
+        """
+        batch = [(method, values, Future()) for method, values in calls]
+        for start in range(0, len(batch), EXECUTE_LIMIT):
+            self._execute(batch[start:start + EXECUTE_LIMIT], priority)
+        return [future.exception() or future.result() for _, _, future in batch]
+
+    def _flush(self):
+        """
+        Отправка накопившихся вызовов по таймеру
+        """
+        with self._lock:
+            pending, self._pending = self._pending, []
+            self._timer = None
+        for start in range(0, len(pending), EXECUTE_LIMIT):
+            self._execute(pending[start:start + EXECUTE_LIMIT])
+
+    def _execute(self, batch: List[Tuple[str, Dict, Future]], priority: int = None):
+        """
+        Выполнение пачки вызовов и раздача результатов
+        """
+        if not batch:
+            return
+        # приоритет передаётся только клиенту с ограничителем частоты
+        options = {} if priority is None else {'priority': priority}
+        metrics.incr('vk.batch.requests')
+        metrics.incr('vk.batch.calls', len(batch))
+
+        if len(batch) == 1:
+            # одиночный вызов не оборачиваем в execute
+            method, values, future = batch[0]
+            try:
+                future.set_result(self.vk.method(method, values, **options))
+            except Exception as e:
+                future.set_exception(e)
+            return
+
+        calls = [(method, values) for method, values, _ in batch]
+        try:
+            response = self.vk.method('execute', {'code': build_execute_code(calls)}, raw=True, **options)
+        except Exception as e:
+            # ошибка всего запроса (сеть, лимит запросов и т.п.) - у всех вызовов
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+
+        # execute_errors перечислены в порядке неудачных вызовов, на их месте в ответе false
+        errors = iter(response.get('execute_errors', []))
+        for (method, values, future), result in zip(batch, response.get('response') or []):
+            if result is False:
+                error = next(errors, None)
+                if error is not None:
+                    future.set_exception(ApiError(self.vk, method, values, False, error))
+                    continue
+            future.set_result(result)
+        for method, values, future in batch:
+            if not future.done():
+                future.set_exception(
+                    ApiError(self.vk, method, values, False,
+                             {'error_code': 0, 'error_msg': 'Нет результата в ответе execute'})
+                )
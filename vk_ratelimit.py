@@ -0,0 +1,163 @@
+import enum
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+from typing import Dict
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Код ошибки VK API "Too many requests per second"
+TOO_MANY_REQUESTS = 6
+
+
+class Priority(enum.IntEnum):
+    """
+    Класс приоритета запроса: меньшее значение обслуживается раньше
+    """
+    INTERACTIVE = 0  # ответы пользователю
+    DEFAULT = 1
+    BACKGROUND = 2  # фоновые загрузки (фотографии и т.п.)
+
+
+# Приоритет по умолчанию для методов API
+METHOD_PRIORITY = {
+    'messages.send': Priority.INTERACTIVE,
+    'photos.get': Priority.BACKGROUND,
+}
+
+
+class TokenBucket:
+    """
+    Ограничитель частоты запросов (token bucket) с очередью по приоритетам.
+    Ожидающие запросы получают токены в порядке (приоритет, время постановки).
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        """
+        Args:
+            rate: Запросов в секунду
+            capacity: Максимальный запас токенов (по умолчанию rate, не меньше 1)
+        """
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._cond = threading.Condition()
+        self._waiters = []  # куча (приоритет, порядковый номер)
+        self._counter = itertools.count()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, priority: int = Priority.DEFAULT, timeout: float = None) -> bool:
+        """
+        Получение токена на один запрос
+
+        Args:
+            priority: Приоритет запроса
+            timeout: Максимальное время ожидания, сек (None - без ограничения)
+
+        Returns:
+            True, если токен получен
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            entry = (int(priority), next(self._counter))
+            heapq.heappush(self._waiters, entry)
+            try:
+                while True:
+                    self._refill()
+                    first = self._waiters[0] == entry
+                    if first and self._tokens >= 1:
+                        heapq.heappop(self._waiters)
+                        self._tokens -= 1
+                        self._cond.notify_all()
+                        return True
+
+                    # первый в очереди ждёт следующий токен, остальные - своей очереди
+                    wait = (1 - self._tokens) / self.rate if first else None
+                    if deadline is not None:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            return False
+                        wait = remaining if wait is None else min(wait, remaining)
+                    self._cond.wait(wait)
+            finally:
+                if entry in self._waiters:
+                    self._waiters.remove(entry)
+                    heapq.heapify(self._waiters)
+                    self._cond.notify_all()
+
+    def pending(self) -> int:
+        """
+        Количество ожидающих запросов
+        """
+        with self._cond:
+            return len(self._waiters)
+
+
+class RateLimitedVkApi:
+    """
+    Клиент VK API с ограничением частоты запросов одного токена.
+
+    Все вызовы method() проходят через общий TokenBucket, интерактивные
+    запросы (messages.send) обслуживаются раньше фоновых. При ошибке 6
+    "Too many requests per second" запрос повторяется с экспоненциальной
+    задержкой со случайным разбросом.
+    """
+
+    def __init__(self, vk, rate: float, retries: int = 5, backoff: float = 0.5, max_backoff: float = 10,
+                 name: str = 'vk'):
+        """
+        Args:
+            vk: Клиент API с методом method() (vk_api.VkApi, AsyncVkApi)
+            rate: Разрешенное количество запросов в секунду для токена
+            retries: Количество повторов при ошибке 6
+            backoff: Начальная задержка повтора, сек
+            max_backoff: Максимальная задержка повтора, сек
+            name: Название для метрик и логов
+        """
+        self.vk = vk
+        self.bucket = TokenBucket(rate)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.name = name
+
+        # собственная пауза vk_api между запросами больше не нужна
+        if hasattr(vk, 'RPS_DELAY'):
+            vk.RPS_DELAY = 0
+
+    def method(self, method: str, values: Dict = None, raw: bool = False, priority: int = None):
+        """
+        Вызов метода API (сигнатура как у vk_api.VkApi.method)
+
+        Args:
+            method: Название метода
+            values: Параметры
+            raw: Вернуть ответ целиком
+            priority: Приоритет запроса (по умолчанию по названию метода)
+        """
+        if priority is None:
+            priority = METHOD_PRIORITY.get(method, Priority.DEFAULT)
+
+        for attempt in range(self.retries + 1):
+            start = time.perf_counter()
+            self.bucket.acquire(priority)
+            metrics.observe(f'{self.name}.ratelimit_wait', time.perf_counter() - start)
+            try:
+                return self.vk.method(method, values, raw=raw)
+            except Exception as e:
+                if getattr(e, 'code', None) != TOO_MANY_REQUESTS or attempt == self.retries:
+                    raise
+                delay = min(self.max_backoff, self.backoff * 2 ** attempt) * random.uniform(0.5, 1.5)
+                metrics.incr(f'{self.name}.throttled')
+                logger.warning(f"{self.name}: превышен лимит запросов ({method}), повтор через {delay:.2f} с")
+                time.sleep(delay)
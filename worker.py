@@ -0,0 +1,202 @@
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta
+
+from dotenv import load_dotenv
+
+from metrics import metrics
+from models import engine, session_scope
+from query import find_match, enqueue_active_match_jobs, claim_match_jobs, finish_match_job, release_match_jobs, \
+    match_job_stats
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+
+def _init_process():
+    """
+    Инициализация процесса пула: соединения, унаследованные от родительского процесса, не используются
+    """
+    engine.dispose(close=False)
+
+
+def compute_matches(user_id: int):
+    """
+    Поиск совпадений пользователя в процессе пула
+
+    Returns:
+        Результат find_match (None или сообщение об отсутствии совпадений)
+    """
+    with session_scope():
+        return find_match(user_id)
+
+
+class MatchWorker:
+    """
+    Фоновый поиск совпадений (вместо поиска по нажатию кнопки в боте).
+
+    Задания хранятся в таблице match_jobs: бот ставит задание при регистрации
+    и при пустой очереди совпадений, планировщик - для всех активных пользователей.
+    Задания захватываются атомарно (SKIP LOCKED), поэтому можно запустить несколько
+    обработчиков. Задание, захваченное упавшим обработчиком, снова выполняется
+    после истечения lease.
+    """
+
+    def __init__(self, processes: int = None, lease: float = None, max_attempts: int = None,
+                 active_days: float = None, schedule_interval: float = None, report_interval: float = 30,
+                 poll_interval: float = 1):
+        """
+        Args:
+            processes: Количество процессов поиска (MATCH_WORKER_PROCESSES, по умолчанию число ядер)
+            lease: Время захвата задания, сек (MATCH_JOB_LEASE)
+            max_attempts: Попыток до пометки задания failed (MATCH_JOB_MAX_ATTEMPTS)
+            active_days: Пользователи, искавшие за столько дней, считаются активными (MATCH_ACTIVE_DAYS)
+            schedule_interval: Период постановки заданий для активных пользователей, сек
+                               (MATCH_SCHEDULE_INTERVAL, 0 - не ставить)
+            report_interval: Период отчёта о ходе работы, сек
+            poll_interval: Пауза при пустой очереди, сек
+        """
+        self.processes = processes or int(os.getenv('MATCH_WORKER_PROCESSES', os.cpu_count() or 1))
+        self.lease = lease or float(os.getenv('MATCH_JOB_LEASE', 300))
+        self.max_attempts = max_attempts or int(os.getenv('MATCH_JOB_MAX_ATTEMPTS', 3))
+        self.active_days = active_days or float(os.getenv('MATCH_ACTIVE_DAYS', 7))
+        self.schedule_interval = float(os.getenv('MATCH_SCHEDULE_INTERVAL', 3600)) \
+            if schedule_interval is None else schedule_interval
+        self.report_interval = report_interval
+        self.poll_interval = poll_interval
+
+        self._stop = threading.Event()
+        self._running = {}  # Future -> (ID пользователя, метка захвата)
+        self._next_schedule = 0.0
+        self._last_report = time.monotonic()
+        self._done = 0  # выполнено заданий с последнего отчёта
+
+    def stop(self):
+        """
+        Остановка после завершения выполняемых заданий
+        """
+        self._stop.set()
+
+    def schedule(self) -> int:
+        """
+        Постановка заданий для активных пользователей
+        """
+        with session_scope():
+            count = enqueue_active_match_jobs(datetime.now() - timedelta(days=self.active_days))
+        logger.info(f"Поставлено заданий для активных пользователей: {count}")
+        return count
+
+    def run(self):
+        """
+        Основной цикл обработчика
+        """
+        logger.info(f"Запуск поиска совпадений: процессов {self.processes}")
+        pool = ProcessPoolExecutor(self.processes, initializer=_init_process)
+        try:
+            while not self._stop.is_set():
+                if self.schedule_interval and time.monotonic() >= self._next_schedule:
+                    self._next_schedule = time.monotonic() + self.schedule_interval
+                    self.schedule()
+
+                # в пуле держим по два задания на процесс, чтобы процессы не простаивали
+                free = self.processes * 2 - len(self._running)
+                if free > 0:
+                    with session_scope():
+                        jobs = claim_match_jobs(free, self.lease)
+                    for user_id, started_at, _ in jobs:
+                        self._running[pool.submit(compute_matches, user_id)] = (user_id, started_at)
+
+                if self._running:
+                    done, _ = wait(self._running, timeout=self.poll_interval, return_when=FIRST_COMPLETED)
+                    if self._complete(done):
+                        # упавший процесс ломает весь пул - создаём новый
+                        pool.shutdown(wait=False, cancel_futures=True)
+                        pool = ProcessPoolExecutor(self.processes, initializer=_init_process)
+                else:
+                    self._stop.wait(self.poll_interval)
+                self._report()
+        except KeyboardInterrupt:
+            logger.info("Поиск совпадений остановлен пользователем")
+        finally:
+            # невыполненные задания возвращаем в очередь, выполняемые дожидаемся
+            cancelled = [future for future in self._running if future.cancel()]
+            if cancelled:
+                with session_scope():
+                    release_match_jobs([self._running.pop(future) for future in cancelled])
+            pool.shutdown(wait=True)
+            self._complete(list(self._running))
+            self._report(force=True)
+
+    def _complete(self, futures) -> bool:
+        """
+        Запись результатов выполненных заданий
+
+        Returns:
+            True, если пул процессов сломан
+        """
+        broken = False
+        for future in futures:
+            user_id, started_at = self._running.pop(future)
+            error = future.exception()
+            if isinstance(error, BrokenProcessPool):
+                broken = True
+            if error is None:
+                metrics.incr('worker.jobs.done')
+                metrics.observe('worker.job', (datetime.now() - started_at).total_seconds())
+                self._done += 1
+            else:
+                metrics.incr('worker.jobs.failed')
+                logger.error(f"Ошибка поиска совпадений для пользователя {user_id}: {error}")
+            try:
+                with session_scope():
+                    finish_match_job(user_id, started_at, None if error is None else str(error),
+                                     self.max_attempts)
+            except Exception as e:
+                # задание вернётся в очередь после истечения lease
+                logger.error(f"Ошибка завершения задания {user_id}: {e}")
+        return broken
+
+    def _report(self, force: bool = False):
+        """
+        Отчёт о ходе работы: выполнено, скорость, размер очереди
+        """
+        now = time.monotonic()
+        elapsed = now - self._last_report
+        if not force and elapsed < self.report_interval:
+            return
+        self._last_report = now
+        try:
+            with session_scope():
+                stats = match_job_stats()
+        except Exception as e:
+            logger.error(f"Ошибка получения статистики заданий: {e}")
+            return
+        for status, count in stats.items():
+            metrics.gauge(f'worker.queue.{status}', count)
+        throughput = self._done / elapsed if elapsed > 0 else 0.0
+        metrics.gauge('worker.throughput', throughput)
+        logger.info(f"Поиск совпадений: выполнено {self._done} заданий ({throughput:.1f}/с), "
+                    f"в очереди {stats['queued']}, выполняется {stats['running']}, с ошибкой {stats['failed']}, "
+                    f"всего выполнено {metrics.counter('worker.jobs.done')}")
+        self._done = 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    command = sys.argv[1] if len(sys.argv) > 1 else 'run'
+    if command == 'run':
+        MatchWorker().run()
+    elif command == 'schedule':
+        MatchWorker().schedule()
+    elif command == 'stats':
+        with session_scope():
+            print(match_job_stats())
+    else:
+        print('Использование: python worker.py [run|schedule|stats]')
+        sys.exit(2)